@@ -3,10 +3,704 @@
 
 # Python standard library
 from __future__ import print_function
-import time
+from collections import Counter
+from contextlib import contextmanager
+import os, sys, json, time, threading
 
 # Local imports
-from utils import err
+from utils import err, hashers, checksum, fadvised
+from throttle import waited
+
+# Process-wide counters of expensive operations,
+# i.e. metadata lookups, made while running a sub
+# command. Counters are incremented by each stage
+# with count(), for example: count('stat_calls').
+# Each thread increments its own counters without
+# a lock, and they are summed by tallied().
+_local = threading.local()
+_threads = {}        # {thread: Counter, ...} of threads that counted
+_retired = Counter() # counters of threads that exited
+_counters_lock = threading.Lock()
+
+
+def _registered():
+    # Counters of the calling thread, the counters
+    # of threads that exited are folded together,
+    # so pools of short lived threads stay cheap
+    local = _local.counters = Counter()
+    with _counters_lock:
+        for thread in [t for t in _threads if not t.is_alive()]:
+            _retired.update(_threads.pop(thread))
+        _threads[threading.current_thread()] = local
+    return local
+
+
+def count(key, value = 1):
+    """Increments a process-wide counter. Counters can be updated from 
+    multiple threads, i.e. workers listing directories.
+    @param key <str>:
+        Name of the counter
+    @param value <int>:
+        Amount to increment the counter by
+    """
+    try:
+        local = _local.counters
+    except AttributeError:
+        local = _registered()
+    local[key] += value
+
+
+def tallied():
+    """Sums the counters of every thread, see count().
+    @return counters <Counter>:
+        Value of each process-wide counter
+    """
+    with _counters_lock:
+        counters = Counter(_retired)
+        threads = list(_threads.values())
+    for local in threads:
+        # Copying a dict is atomic, the
+        # thread can keep counting
+        counters.update(dict(local))
+    return counters
+
+
+def report(title = 'counters'):
+    """Prints the value of each process-wide counter to standard error.
+    @param title <str>:
+        Name to prefix each line of the report
+    """
+    for key, value in sorted(tallied().items()):
+        err('{}\t{}\t{}'.format(title, key, value))
+
+
+# Process-wide wall time, CPU time, bytes read
+# and peak memory of each stage of a sub command,
+# stages are recorded with timed(), for example:
+# with timed('ls.traverse'): ...
+stages = {}
+_open_stages = []   # [[name, peak], ...] of running stages
+_stages_lock = threading.Lock()
+_measured = False   # peak memory is sampled, see measure()
+_started = time.perf_counter()
+
+
+def _rss_peak():
+    # Peak resident set size in KiB since the
+    # last reset, or of the whole process if
+    # /proc is not available
+    try:
+        with open('/proc/self/status') as fh:
+            for line in fh:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except (OSError, ValueError):
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _rss_reset():
+    # Resets the peak resident set size
+    # of the process, linux 4.0 or later
+    try:
+        with open('/proc/self/clear_refs', 'w') as fh:
+            fh.write('5')
+    except OSError:
+        pass
+
+
+def measure(enabled = True):
+    """Enables sampling the peak memory of each stage, see timed(). Sampling
+    resets the peak resident set size of the process at the start of each
+    stage, so it is only enabled when metrics are requested.
+    @param enabled <bool>:
+        True to sample the peak memory of each stage
+    """
+    global _measured
+    _measured = enabled
+
+
+@contextmanager
+def timed(name):
+    """Records the wall time, CPU time, bytes read and peak memory of a stage.
+    Stages are entered from the thread consuming a sub command, the CPU time 
+    and bytes read include worker threads, i.e. hashing files. The time of a 
+    stage that yields listings includes writing them. Stages can be nested or
+    interleaved, i.e. generators of different stages, and the peak memory of
+    a stage includes the peaks of every stage that ran while it was open. The
+    peak memory is only sampled once measure() is called.
+    @param name <str>:
+        Name of the stage, i.e. ls.traverse or df.totals
+    """
+    state = [name, 0]   # name and peak of this stage
+    with _stages_lock:
+        if _measured:
+            # Resetting the peak of the process
+            # loses it for every open stage
+            peak = _rss_peak()
+            for other in _open_stages:
+                other[1] = max(other[1], peak)
+            _rss_reset()
+        _open_stages.append(state)
+    nbytes = bytes_read()
+    cpu = time.process_time()
+    ts = time.perf_counter()
+    try:
+        yield
+    finally:
+        wall = time.perf_counter() - ts
+        cpu = time.process_time() - cpu
+        after = bytes_read()
+        with _stages_lock:
+            _open_stages[:] = [other for other in _open_stages if other is not state]
+            peak = max(state[1], _rss_peak()) if _measured else state[1]
+        metrics = stages.setdefault(name, {'calls': 0, 'wall_s': 0.0, 'cpu_s': 0.0, 
+            'read_bytes': 0, 'peak_rss_mib': 0.0})
+        metrics['calls'] += 1
+        metrics['wall_s'] += wall
+        metrics['cpu_s'] += cpu
+        if nbytes is not None and after is not None:
+            metrics['read_bytes'] += after - nbytes
+        metrics['peak_rss_mib'] = max(metrics['peak_rss_mib'], round(peak / 1024.0, 1))
+
+
+def phase():
+    """Gets the name of the stage that started last and is still running, see 
+    timed().
+    @return name <str>:
+        Name of the stage, or None outside of a stage
+    """
+    try:
+        return _open_stages[-1][0]
+    except IndexError:
+        return None
+
+
+def metrics(command = None):
+    """Gets the counters and stages of the process. Wall and CPU times of each
+    stage are rounded, and its read throughput is added in MB/s.
+    @param command <str>:
+        Name of the sub command
+    @return metrics <dict>:
+        Counters, stages, wall time and peak memory of the process, and the
+        time spent throttled by each rate limit
+    """
+    import resource
+    results = {}
+    for name, stage in stages.items():
+        stage = dict(stage)
+        stage['read_mb_per_s'] = round(stage['read_bytes'] / 1e6 / max(stage['wall_s'], 1e-9), 1)
+        stage['wall_s'] = round(stage['wall_s'], 4)
+        stage['cpu_s'] = round(stage['cpu_s'], 4)
+        results[name] = stage
+    return {
+        'command': command,
+        'wall_s': round(time.perf_counter() - _started, 4),
+        'peak_rss_mib': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0, 1),
+        'counters': dict(sorted(tallied().items())),
+        'stages': results,
+        'throttle': waited()
+    }
+
+
+def dumped(filename, command = None, extra = None):
+    """Writes the counters and stages of the process to a JSON file.
+    @param filename <str>:
+        Path of the JSON file
+    @param command <str>:
+        Name of the sub command
+    @param extra <dict>:
+        Additional results, i.e. from profiled()
+    """
+    results = metrics(command)
+    results.update(extra or {})
+    with open(filename, 'w') as fh:
+        json.dump(results, fh, indent = 2)
+        fh.write('\n')
+
+
+def profiled(func, *args, **kwargs):
+    """Runs a function with cProfile and tracemalloc. The functions with the
+    most cumulative time and the lines with the largest allocations are printed
+    to standard error. Only the calling thread is profiled by cProfile, worker
+    threads are not.
+    @param func <function>:
+        Function to profile, i.e. the handler of a sub command
+    @param args <any>:
+        Arguments of the function
+    @return results <dict>:
+        Peak memory traced by tracemalloc in MiB
+    """
+    import cProfile, pstats, tracemalloc, io
+    profile = cProfile.Profile()
+    tracemalloc.start()
+    profile.enable()
+    try:
+        func(*args, **kwargs)
+    finally:
+        profile.disable()
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        sys.stdout.flush()
+        stream = io.StringIO()
+        pstats.Stats(profile, stream = stream).sort_stats('cumulative').print_stats(30)
+        err(stream.getvalue())
+        err('tracemalloc\tpeak\t{} MiB'.format(round(peak / 1048576.0, 1)))
+        for statistic in snapshot.statistics('lineno')[:15]:
+            err('tracemalloc\t{}'.format(statistic))
+    return {'tracemalloc_peak_mib': round(peak / 1048576.0, 1)}
+
+
+def evicted(filename):
+    """Drops a file's data from the page cache, so the next read of the file
+    is served from disk. Only clean pages can be dropped.
+    @param filename <str>:
+        File to drop from the page cache
+    """
+    with open(filename, 'rb') as fh:
+        try:
+            # Flush any dirty pages 
+            os.fsync(fh.fileno())
+        except OSError:
+            pass
+        fadvised(fh.fileno(), 0, 0, 'DONTNEED')
+
+
+def throughput(filenames, blocksizes = (65536, 1048576, 4194304), algorithm = 'md5'):
+    """Micro-benchmark to compare the read throughput of hashing files with the
+    original read() loop against the re-used buffer of utils.blocks(). Each file 
+    is evicted from the page cache before every run. The results are printed to
+    standard error in MB/s.
+    @param filenames list[<str>]:
+        Large files to read
+    @param blocksizes list[<int>]:
+        Sizes of each read in bytes
+    @param algorithm <str>:
+        Name of a hashing algorithm in utils.hashers
+    """
+    def original(filename, blocksize):
+        # Implementation of md5sum() prior 
+        # to re-using a buffer with readinto
+        hasher = hashers[algorithm]()
+        with open(filename, 'rb') as fh:
+            buf = fh.read(blocksize)
+            while len(buf) > 0:
+                hasher.update(buf)
+                buf = fh.read(blocksize)
+        return hasher.digest()
+
+    def buffered(filename, blocksize):
+        return checksum(filename, algorithm, blocksize = blocksize)
+
+    nbytes = sum(os.path.getsize(f) for f in filenames)
+    for blocksize in blocksizes:
+        for label, reader in (('read', original), ('readinto', buffered)):
+            ts = time.time()
+            for filename in filenames:
+                evicted(filename)
+                reader(filename, blocksize)
+            te = time.time()
+            err('{}\t{}\t{}\t{} MB/s'.format(label, algorithm, blocksize, 
+                round(nbytes / 1e6 / max(te - ts, 1e-9), 1)))
+
+
+def footprint(nfiles, layout = 'index', max_memory = 268435456, files_per_dir = 100, seed = 42):
+    """Micro-benchmark to measure the peak memory usage of grouping the files
+    of a synthetic directory tree by size, i.e. the first pass of ls. The 'list'
+    layout keeps a python string and stat record per file, like ls did prior to 
+    index.FileIndex, the 'index' layout keeps integer file ids in an index, and
+    the 'two-pass' layout only indexes files with a shared size, like ls --two-pass,
+    and the 'spill' layout spills groups to disk past a limit, like ls --max-memory.
+    Each layout should be run in its own process. The peak resident set size 
+    is printed to standard error in MiB.
+    @param nfiles <int>:
+        Number of files in the synthetic directory tree
+    @param layout <str>:
+        Layout of the groups of files, either 'list', 'index', 'two-pass', or 'spill'
+    @param max_memory <int>:
+        Approximate memory limit of the 'spill' layout in bytes
+    @param files_per_dir <int>:
+        Number of files in each directory
+    @param seed <int>:
+        Seed of the random file sizes, about one in ten sizes is shared
+    """
+    import random, resource
+    from index import FileIndex, SizeSketch, Record
+    from spill import SpillingGroups
+
+    def synthetic():
+        # Re-seeded so each pass over the
+        # tree yields the same files
+        rng = random.Random(seed)
+        for i in range(nfiles):
+            d = i // files_per_dir
+            file = '/data/group{}/project{}/run{}/sample_{:09d}.fastq.gz'.format(
+                d // 100000, d // 1000, d, i)
+            size = rng.randint(0, 1 << 40) if rng.random() > 0.1 else rng.randint(0, 1 << 10)
+            yield file, Record(1000000000 + i, 64768, size, 1600000000000000000 + i, 1000, 1000, 33188)
+
+    index = FileIndex()
+    sizes = {}
+    if layout == 'spill':
+        sizes = SpillingGroups(max_memory)
+    sketch = None
+    if layout == 'two-pass':
+        # Only count sizes in the first pass
+        sketch = SizeSketch()
+        for file, record in synthetic():
+            sketch.add(record.size)
+    for file, record in synthetic():
+        size = record.size
+        if sketch is not None and sketch.count(size) < 2:
+            continue   # listed while traversing
+        if layout == 'spill':
+            sizes.add(size, (file, record))
+        elif layout == 'list':
+            if size not in sizes:
+                sizes[size] = []
+            sizes[size].append((file, record))
+        else:
+            fid = index.add(file, record)
+            if size not in sizes:
+                sizes[size] = fid
+            elif isinstance(sizes[size], int):
+                sizes[size] = [sizes[size], fid]
+            else:
+                sizes[size].append(fid)
+    if layout == 'spill':
+        # Regroup files with an external merge
+        for size, files in sizes.items():
+            pass
+        sizes.close()
+    # Peak resident set size in KiB on linux
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    err('{}\t{} files\t{} MiB\t{} bytes per file'.format(layout, nfiles, 
+        round(peak / 1024.0, 1), int(peak * 1024.0 / max(nfiles, 1))))
+
+
+def distribution(parser, spec):
+    """Parses the distribution of file sizes of a synthetic tree, i.e.
+    'fixed:SIZE', 'uniform:MIN:MAX' or 'loguniform:MIN:MAX'. Sizes can be
+    human readable, like 64K or 4M, see utils.sized().
+    @param parser <argparse.ArgumentParser() object>:
+        Argparse parser object
+    @param spec <str>:
+        Name of the distribution and its sizes
+    @return (kind, low, high) <tuple(str, int, int)>:
+        Name of the distribution, and its smallest and largest size
+    """
+    from utils import sized
+    kind, _, sizes = spec.partition(':')
+    sizes = [sized(parser, size) for size in sizes.split(':') if size]
+    if kind == 'fixed' and len(sizes) == 1:
+        return kind, sizes[0], sizes[0]
+    if kind in ('uniform', 'loguniform') and len(sizes) == 2 and sizes[0] <= sizes[1]:
+        return kind, sizes[0], sizes[1]
+    parser.error("Size distribution '{}' is not valid! Please use fixed:SIZE, uniform:MIN:MAX, or loguniform:MIN:MAX.".format(spec))
+
+
+def synthesized(root, nfiles = 10000, depth = 3, width = 8, files_per_dir = 100,
+        sizes = ('loguniform', 1024, 262144), duplicates = 0.2, near_duplicates = 0.05,
+        hardlinks = 0.01, symlinks = 0.01, header = 65536, seed = 42):
+    """Creates a reproducible synthetic directory tree to benchmark ls, df and
+    ln. The same parameters always create the same paths, contents, sizes and
+    modification times. Each entry of the tree is either a unique file, an
+    exact copy of an earlier file, a near-duplicate that has the size and the
+    first header bytes of an earlier file but a different tail, a hard link,
+    or a symbolic link to an earlier file.
+    @param root <str>:
+        Directory to create the tree in, it must not contain files
+    @param nfiles <int>:
+        Number of entries in the tree
+    @param depth <int>:
+        Number of nested directories of each file
+    @param width <int>:
+        Number of sub directories per directory
+    @param files_per_dir <int>:
+        Number of entries in each leaf directory
+    @param sizes <tuple(str, int, int)>:
+        Distribution of file sizes, see distribution()
+    @param duplicates <float>:
+        Fraction of entries that are exact copies of an earlier file
+    @param near_duplicates <float>:
+        Fraction of entries that share the size and header of an earlier file
+    @param hardlinks <float>:
+        Fraction of entries that are hard links to an earlier file
+    @param symlinks <float>:
+        Fraction of entries that are symbolic links to an earlier file
+    @param header <int>:
+        Number of leading bytes near-duplicates share, i.e. a mini hash block
+    @param seed <int>:
+        Seed of the random layout, sizes and contents
+    @return tree <dict>:
+        Parameters of the tree and the number of entries and bytes by kind
+    """
+    import random, math
+    rng = random.Random(seed)
+    # Shared random filler, every file
+    # starts with a 16 byte token, and
+    # ends with one if it fits
+    pattern = rng.getrandbits(8 << 20).to_bytes(1 << 20, 'little')
+    kind, low, high = sizes
+    t0 = 1600000000
+
+    def sampled():
+        if kind == 'uniform':
+            return rng.randint(low, high)
+        if kind == 'loguniform':
+            return int(math.exp(rng.uniform(math.log(max(low, 1)), math.log(max(high, 1)))))
+        return low
+
+    def written(file, size, head, tail, mtime):
+        with open(file, 'wb') as fh:
+            if size < len(head) + len(tail):
+                fh.write((head + tail)[:size])
+            else:
+                fh.write(head)
+                remaining = size - len(head) - len(tail)
+                while remaining > 0:
+                    chunk = pattern[:min(remaining, len(pattern))]
+                    fh.write(chunk)
+                    remaining -= len(chunk)
+                fh.write(tail)
+        os.utime(file, (mtime, mtime))
+
+    counts = Counter()
+    originals = []   # [(size, head, tail, path), ...]
+    for i in range(nfiles):
+        leaf = i // files_per_dir
+        parts = ['d{}'.format(leaf // width ** k) for k in reversed(range(depth))]
+        directory = os.path.join(root, *parts)
+        os.makedirs(directory, exist_ok = True)
+        file = os.path.join(directory, 'f{:09d}.dat'.format(i))
+        mtime = t0 - rng.randint(0, 5 * 365 * 86400)
+        choice = rng.random()
+        head = 'head{:012d}'.format(i).encode()
+        tail = 'tail{:012d}'.format(i).encode()
+        entry = 'unique'
+        if originals and choice < duplicates:
+            size, head, tail, _ = rng.choice(originals)
+            entry = 'duplicates'
+        elif originals and choice < duplicates + near_duplicates:
+            # Shares the header of an earlier
+            # file, files that are not at least
+            # one block larger than the header
+            # are replaced by a unique file
+            size, shared, _, _ = rng.choice(originals)
+            if size >= header + 4096:
+                head = shared
+                entry = 'near_duplicates'
+        elif originals and choice < duplicates + near_duplicates + hardlinks:
+            os.link(rng.choice(originals)[3], file)
+            counts['hardlinks'] += 1
+            continue
+        elif originals and choice < duplicates + near_duplicates + hardlinks + symlinks:
+            os.symlink(rng.choice(originals)[3], file)
+            counts['symlinks'] += 1
+            continue
+        if entry == 'unique':
+            size = sampled()
+            originals.append((size, head, tail, file))
+        if entry == 'near_duplicates':
+            # Different tail after the
+            # shared header of the file
+            written(file, size, head, tail, mtime)
+            with open(file, 'r+b') as fh:
+                fh.seek(header)
+                fh.write(tail)
+        else:
+            written(file, size, head, tail, mtime)
+        counts[entry] += 1
+        counts['bytes'] += size
+
+    tree = {
+        'files': nfiles, 'depth': depth, 'width': width, 'files_per_dir': files_per_dir,
+        'sizes': list(sizes), 'duplicates': duplicates, 'near_duplicates': near_duplicates,
+        'hardlinks': hardlinks, 'symlinks': symlinks, 'header': header, 'seed': seed
+    }
+    tree['created'] = dict(sorted(counts.items()))
+    return tree
+
+
+def bytes_read():
+    """Gets the number of bytes read by this process, including reads served
+    by the page cache, i.e. rchar of /proc/self/io.
+    @return nbytes <int>:
+        Bytes read by this process, or None if /proc is not available
+    """
+    try:
+        with open('/proc/self/io') as fh:
+            for line in fh:
+                if line.startswith('rchar:'):
+                    return int(line.split()[1])
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def staged(stage, *args):
+    """Runs a stage of the benchmark suite in a forked child process, so the
+    peak memory of each stage is measured on its own. The child reports the
+    wall time, bytes read, stat calls and counters of the stage.
+    @param stage <function>:
+        Stage to run, returns the number of files it processed
+    @param args <any>:
+        Arguments of the stage
+    @return metrics <dict>:
+        Metrics of the stage, or the error it raised
+    """
+    import multiprocessing, resource, traceback
+    # Counters of the commands module, this
+    # module may be running as __main__
+    from benchmark import tallied, metrics as measured, measure
+    context = multiprocessing.get_context('fork')
+    reader, writer = context.Pipe(duplex = False)
+
+    def child():
+        measure()
+        before = tallied()
+        nbytes = bytes_read()
+        ts = time.perf_counter()
+        try:
+            nfiles = stage(*args)
+        except Exception as e:
+            writer.send({'error': '{}: {}'.format(type(e).__name__, e),
+                'traceback': traceback.format_exc()})
+            return
+        wall = time.perf_counter() - ts
+        after = bytes_read()
+        delta = dict(sorted((tallied() - before).items()))
+        # Peak resident set size in KiB on linux
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        writer.send({
+            'wall_s': round(wall, 4),
+            'files': nfiles,
+            'files_per_s': round(nfiles / max(wall, 1e-9), 1),
+            'mb_read': round((after - nbytes) / 1e6, 3) if nbytes is not None else None,
+            'stat_calls': delta.get('stat_calls', 0),
+            'peak_rss_mib': round(peak / 1024.0, 1),
+            'counters': delta,
+            'stages': measured()['stages']
+        })
+
+    process = context.Process(target = child)
+    process.start()
+    writer.close()
+    try:
+        metrics = reader.recv()
+    except EOFError:
+        metrics = {'error': 'stage exited with code {}'.format(process.exitcode)}
+    process.join()
+    return metrics
+
+
+def suite(root, workdir, stages = ('ls', 'df', 'ln'), jobs = 1, walk_threads = 1,
+        algorithm = 'md5', minimum_size = 0):
+    """Benchmarks the stages of spacesavers against a directory tree, i.e. one
+    created by synthesized(). The listing of ls is written to the working
+    directory and read back by df and ln, like the cron job does. Each stage
+    runs in its own process, see staged().
+    @param root <str>:
+        Directory tree to benchmark
+    @param workdir <str>:
+        Directory to write the listing of ls
+    @param stages list[<str>]:
+        Stages to run: ls, df and ln
+    @param jobs <int>:
+        Number of threads to hash files with in ls
+    @param walk_threads <int>:
+        Number of threads to list directories with in ls
+    @param algorithm <str>:
+        Name of a hashing algorithm in utils.hashers
+    @param minimum_size <int>:
+        Minimum size of a file to be hard linked by ln
+    @return results <dict>:
+        Metrics of each stage
+    """
+    from commands import _ls, _df, _ln, listings
+    from output import TableWriter
+    from utils import opened
+    listing = os.path.join(workdir, 'ls.tsv')
+
+    def ls():
+        nfiles = 0
+        with opened(listing, 'wt') as fh:
+            table = TableWriter(fh)
+            table.write(['Inode', 'Permissions', 'Owner', 'Group', 'Bytes',
+                'Size', 'MDate', 'Age', 'File', 'NDuplicates', 'BDuplicates',
+                'SDuplicates', 'DOwners', 'Duplicates'])
+            for file_listing in _ls(root, walk_threads = walk_threads, jobs = jobs,
+                    algorithm = algorithm):
+                table.write(file_listing)
+                nfiles += 1 + int(file_listing[9])
+            table.close()
+        return nfiles
+
+    def df():
+        with opened(listing) as fh:
+            next(fh)
+            _df(fh, root, True)
+        with opened(listing) as fh:
+            return sum(1 for line in fh) - 1
+
+    def ln():
+        # Duplicates are found in the listing
+        # of ls, like ln --from-ls, if it ran
+        npairs = 0
+        rows = listings(listing) if os.path.exists(listing) else None
+        for pair in _ln(root, minimum_size, rows):
+            npairs += 1
+        return npairs
+
+    functions = {'ls': ls, 'df': df, 'ln': ln}
+    results = {}
+    for stage in stages:
+        if stage == 'df' and not os.path.exists(listing):
+            results[stage] = {'error': 'df requires the listing of the ls stage'}
+            continue
+        results[stage] = staged(functions[stage])
+    return results
+
+
+def regressions(results, baseline, tolerance = 0.25, min_wall = 0.05):
+    """Compares the results of the benchmark suite against a saved baseline.
+    A metric regresses if it is worse than the baseline by more than the
+    given tolerance. Stages that ran for less than min_wall seconds are only
+    checked for stat calls, as their timings are mostly noise.
+    @param results <dict>:
+        Results of the benchmark suite
+    @param baseline <dict>:
+        Saved results of a previous run of the suite
+    @param tolerance <float>:
+        Allowed relative increase of each metric
+    @param min_wall <float>:
+        Minimum wall time of a stage in the baseline to compare timings
+    @return messages list[<str>]:
+        Description of each regression, empty if there are none
+    """
+    messages = []
+    if results.get('tree') != baseline.get('tree'):
+        messages.append('tree: parameters differ from the baseline, results are not comparable')
+    for stage, metrics in sorted(results.get('stages', {}).items()):
+        expected = baseline.get('stages', {}).get(stage)
+        if expected is None or 'error' in expected:
+            continue
+        if 'error' in metrics:
+            messages.append('{}: failed with {}'.format(stage, metrics['error']))
+            continue
+        keys = ['stat_calls']
+        if expected['wall_s'] >= min_wall:
+            keys += ['wall_s', 'peak_rss_mib', 'mb_read']
+        for key in keys:
+            old, new = expected.get(key), metrics.get(key)
+            if old is None or new is None:
+                continue
+            if new > old * (1 + tolerance) and new - old > 0:
+                messages.append('{}: {} regressed from {} to {} (+{}%)'.format(stage, key,
+                    old, new, round(100.0 * (new - old) / max(old, 1e-9), 1)))
+    return messages
 
 
 def timer(func):
@@ -28,5 +722,111 @@ def timer(func):
 
 
 if __name__ == '__main__':
-    # Add test later
-    pass
\ No newline at end of file
+    import sys
+    if sys.argv[1:2] == ['read']:
+        # Compare read throughput of hashing large 
+        # files with and without a re-used buffer:
+        # $ python3 src/benchmark.py read /path/to/large.bam
+        throughput(sys.argv[2:])
+        sys.exit(0)
+    if sys.argv[1:2] == ['memory']:
+        # Compare peak memory usage of grouping files
+        # by size with lists of paths and stat records
+        # vs. an index of file ids, run separately:
+        # $ python3 src/benchmark.py memory 10000000 list
+        # $ python3 src/benchmark.py memory 10000000 index
+        # $ python3 src/benchmark.py memory 10000000 two-pass
+        # $ python3 src/benchmark.py memory 10000000 spill 512M
+        import argparse
+        from utils import sized
+        parser = argparse.ArgumentParser(prog = 'benchmark.py memory',
+            description = 'Measure the peak memory of grouping files by size.')
+        parser.add_argument('nfiles', type = int, help = 'Number of files in the synthetic tree')
+        parser.add_argument('layout', choices = ['list', 'index', 'two-pass', 'spill'], help = 'Layout of the groups of files')
+        parser.add_argument('max_memory', nargs = '?', type = lambda s: sized(parser, s), default = 268435456,
+            help = 'Memory limit of the spill layout, default: 256M')
+        args = parser.parse_args(sys.argv[2:])
+        footprint(args.nfiles, args.layout, args.max_memory)
+        sys.exit(0)
+
+    if sys.argv[1:2] == ['suite']:
+        # Benchmark ls, df and ln against a reproducible
+        # synthetic tree, results are printed as JSON:
+        # $ python3 src/benchmark.py suite --files 100000 --save baseline.json
+        # $ python3 src/benchmark.py suite --files 100000 --baseline baseline.json
+        import argparse, json, shutil, tempfile, platform
+        from utils import sized
+        parser = argparse.ArgumentParser(prog = 'benchmark.py suite',
+            description = 'Benchmark ls, df and ln against a synthetic tree.')
+        parser.add_argument('--files', type = int, default = 10000, help = 'Number of entries in the tree')
+        parser.add_argument('--depth', type = int, default = 3, help = 'Nested directories of each file')
+        parser.add_argument('--width', type = int, default = 8, help = 'Sub directories per directory')
+        parser.add_argument('--files-per-dir', type = int, default = 100, help = 'Entries in each leaf directory')
+        parser.add_argument('--sizes', type = lambda s: distribution(parser, s), default = ('loguniform', 1024, 262144),
+            help = 'Size distribution: fixed:SIZE, uniform:MIN:MAX, or loguniform:MIN:MAX, default: loguniform:1K:256K')
+        parser.add_argument('--duplicates', type = float, default = 0.2, help = 'Fraction of exact copies')
+        parser.add_argument('--near-duplicates', type = float, default = 0.05, help = 'Fraction of copies with a shared header')
+        parser.add_argument('--hardlinks', type = float, default = 0.01, help = 'Fraction of hard links')
+        parser.add_argument('--symlinks', type = float, default = 0.01, help = 'Fraction of symbolic links')
+        parser.add_argument('--seed', type = int, default = 42, help = 'Seed of the synthetic tree')
+        parser.add_argument('--stages', default = 'ls,df,ln', help = 'Comma separated stages to run, default: ls,df,ln')
+        parser.add_argument('--jobs', type = int, default = 1, help = 'Threads to hash files with in ls')
+        parser.add_argument('--walk-threads', type = int, default = 1, help = 'Threads to list directories with in ls')
+        parser.add_argument('--hash', default = 'md5', choices = sorted(hashers), help = 'Hashing algorithm of ls')
+        parser.add_argument('--dir', default = None, help = 'Keep the tree and listing in this directory')
+        parser.add_argument('--save', default = None, help = 'Save the results as a baseline to this file')
+        parser.add_argument('--baseline', default = None, help = 'Compare the results against this baseline')
+        parser.add_argument('--tolerance', type = float, default = 0.25, help = 'Allowed relative regression, default: 0.25')
+        args = parser.parse_args(sys.argv[2:])
+        stages = [stage for stage in args.stages.split(',') if stage]
+        if set(stages) - {'ls', 'df', 'ln'}:
+            parser.error('Stages must be one of: ls, df, ln')
+
+        workdir = args.dir or tempfile.mkdtemp(prefix = 'spacesavers_benchmark_')
+        root = os.path.join(workdir, 'tree')
+        try:
+            if os.path.isdir(root) and os.listdir(root):
+                parser.error('Directory "{}" already contains a tree, please remove it'.format(root))
+            ts = time.perf_counter()
+            tree = synthesized(root, args.files, args.depth, args.width, args.files_per_dir,
+                args.sizes, args.duplicates, args.near_duplicates, args.hardlinks,
+                args.symlinks, seed = args.seed)
+            err('created\t{} entries\t{} s'.format(args.files, round(time.perf_counter() - ts, 2)))
+            created = tree.pop('created')
+            results = {
+                'version': 1,
+                'python': platform.python_version(),
+                'tree': tree,
+                'created': created,
+                'stages': suite(root, workdir, stages, args.jobs, args.walk_threads, args.hash)
+            }
+        finally:
+            if args.dir is None:
+                shutil.rmtree(workdir, ignore_errors = True)
+
+        print(json.dumps(results, indent = 2))
+        if args.save:
+            with open(args.save, 'w') as fh:
+                json.dump(results, fh, indent = 2)
+                fh.write('\n')
+        if args.baseline:
+            with open(args.baseline) as fh:
+                messages = regressions(results, json.load(fh), args.tolerance)
+            for message in messages:
+                err('REGRESSION: {}'.format(message))
+            sys.exit(1 if messages else 0)
+        sys.exit(0)
+
+    # Report the number of metadata calls made per
+    # file while listing a directory with ls, usage:
+    # $ python3 src/benchmark.py /path/to/directory
+    # Import counters via module name, this module is
+    # running as __main__ and commands uses benchmark
+    from benchmark import tallied
+    from commands import _ls
+    nfiles = 0
+    for path in sys.argv[1:]:
+        for file_listing in _ls(path):
+            nfiles += 1 + int(file_listing[9])
+    for key, value in sorted(tallied().items()):
+        err('{}\t{}\t{} per file'.format(key, value, round(value / float(max(nfiles, 1)), 3)))
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+# Python standard library
+from __future__ import print_function
+import sqlite3
+
+# Local imports
+from utils import err
+from benchmark import count
+
+
+class HashCache(object):
+    """Persistent on-disk cache of file checksums backed by SQLite. Checksums
+    are stored per (device, inode) and kind of hash, i.e. 'md5:head' or 'md5:full',
+    so the hashing algorithm that produced each raw digest is recorded. A
+    cached checksum is only returned if the size and the modification time (ns)
+    of the file still match, otherwise the file has changed since it was hashed,
+    and its entry is replaced the next time the file is hashed. The same cache
+    can be shared across runs and across concurrent swarm jobs.
+    @param path <str>:
+        Path to the SQLite database, created if it does not exist
+    @param timeout <float>:
+        Seconds to wait on a lock held by another process
+    @param batch <int>:
+        Number of new checksums to buffer before writing them to disk
+    """
+    def __init__(self, path, timeout = 600.0, batch = 1000):
+        self.path = path
+        self.batch = batch
+        self.pending = []
+        self.connection = sqlite3.connect(path, timeout = timeout)
+        with self.connection:
+            self.connection.execute(
+                """CREATE TABLE IF NOT EXISTS hashes (
+                    dev INTEGER NOT NULL,
+                    ino INTEGER NOT NULL,
+                    kind TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    mtime_ns INTEGER NOT NULL,
+                    digest BLOB NOT NULL,
+                    PRIMARY KEY (dev, ino, kind)
+                )"""
+            )
+
+    def get(self, record, kind):
+        """Looks up the checksum of a file.
+        @param record <Record>:
+            Stat record of the file
+        @param kind <str>:
+            Algorithm and type of checksum, i.e. 'md5:head' or 'md5:full'
+        @return digest <bytes>:
+            Cached checksum, or None if the file was never hashed or has changed
+        """
+        row = self.connection.execute(
+            "SELECT digest FROM hashes WHERE dev = ? AND ino = ? AND kind = ? AND size = ? AND mtime_ns = ?",
+            (record.dev, record.ino, kind, record.size, record.mtime_ns)
+        ).fetchone()
+        if row is None:
+            count('hash_cache_misses')
+            return None
+        count('hash_cache_hits')
+        return row[0]
+
+    def put(self, record, kind, digest):
+        """Adds or replaces the checksum of a file. New checksums are buffered
+        and written to disk in batches to reduce locking of the database.
+        @param record <Record>:
+            Stat record of the file
+        @param kind <str>:
+            Algorithm and type of checksum, i.e. 'md5:head' or 'md5:full'
+        @param digest <bytes>:
+            Checksum of the file
+        """
+        self.pending.append((record.dev, record.ino, kind, record.size, record.mtime_ns, digest))
+        if len(self.pending) >= self.batch:
+            self.flush()
+
+    def flush(self):
+        """Writes any buffered checksums to disk in a single transaction."""
+        if not self.pending:
+            return
+        try:
+            with self.connection:
+                self.connection.executemany(
+                    "INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?)",
+                    self.pending
+                )
+        except sqlite3.Error as e:
+            # A cache that cannot be updated only
+            # costs re-hashing files the next time
+            err('WARNING: Failed to update hash cache "{}" due to "{}" error!'.format(self.path, e))
+        self.pending = []
+
+    def close(self):
+        """Writes any buffered checksums and closes the database."""
+        self.flush()
+        self.connection.close()
@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+# Python standard library
+from __future__ import print_function
+import os, time, pickle, struct, datetime, threading, zlib
+
+# Local imports
+from utils import err
+from benchmark import count
+
+# Each record of a journal is framed
+# by its length and a CRC32 checksum
+_FRAME = struct.Struct('<II')
+_VERSION = 1
+
+
+class Checkpoint(object):
+    """Append-only journal of an ls scan, so an interrupted scan, i.e. a swarm
+    job that hit its walltime, resumes where it stopped instead of starting
+    over. The listing of each directory, the checksum of each file, and the
+    groups of each byte by byte comparison are appended as they complete, and
+    the journal is written to disk in batches and synced every interval
+    seconds. Records are keyed by the inode, size and modification time (ns)
+    of their directory or files, so a record of something that changed since
+    it was journaled is never re-used. Each record is framed with a checksum,
+    and a torn record at the end of the journal, i.e. from a killed job, is
+    dropped, so any prefix of the journal is a consistent point to resume
+    from. The groups of files by size and fingerprints are rebuilt from the
+    journaled listings and checksums, as they only depend on them. Files are
+    aged against the start of the first attempt, so a resumed scan lists the
+    same output as a scan that was never interrupted. The journal is removed
+    once the scan is complete.
+    @param directory <str>:
+        Directory of the journal, created if it does not exist
+    @param paths list[<str>]:
+        Absolute paths of the scanned directories, a journal of other paths
+        is discarded
+    @param interval <float>:
+        Seconds between syncing the journal to disk
+    @param batch <int>:
+        Number of records to buffer before writing them to the journal
+    @param max_age <float>:
+        Days before a journal is too old to resume from
+    """
+    def __init__(self, directory, paths, interval = 60.0, batch = 10000, max_age = 7.0):
+        os.makedirs(directory, exist_ok = True)
+        self.path = os.path.join(directory, 'ls.journal')
+        self.paths = list(paths)
+        self.interval = interval
+        self.batch = batch
+        self.lock = threading.Lock()
+        self.pending = []
+        self.synced = time.time()
+        self.closed = False
+        self.dirs = {}      # {pdir: (ino, nlink, mtime_ns, blob), ...}
+        self.hashes = {}    # {(kind, dev, ino): (size, mtime_ns, digest), ...}
+        self.compares = {}  # {(key, identities): subgroups, ...}
+        self.started = None
+        end = self._load(max_age)
+        self.fh = open(self.path, 'r+b' if end else 'wb')
+        self.fh.truncate(end)
+        self.fh.seek(end)
+        if not end:
+            self.started = datetime.datetime.today()
+            self._append(('scan', _VERSION, self.paths, self.started))
+            self.flush()
+
+    def _load(self, max_age):
+        # Reads each record of a previous attempt
+        # up to the first torn or corrupt record,
+        # returns the offset to append from
+        try:
+            fh = open(self.path, 'rb')
+        except OSError:
+            return 0
+        records, end = [], 0
+        with fh:
+            while True:
+                frame = fh.read(_FRAME.size)
+                if len(frame) < _FRAME.size:
+                    break
+                length, crc = _FRAME.unpack(frame)
+                data = fh.read(length)
+                if len(data) < length or zlib.crc32(data) != crc:
+                    break
+                try:
+                    records.append(pickle.loads(data))
+                except Exception:
+                    break
+                end = fh.tell()
+            if end != fh.seek(0, os.SEEK_END):
+                count('checkpoint.truncated')
+        if not records or records[0][:3] != ('scan', _VERSION, self.paths):
+            if records:
+                err('WARNING: Discarding checkpoint "{}" of a different scan!'.format(self.path))
+            return 0
+        started = records[0][3]
+        if (datetime.datetime.today() - started).total_seconds() > max_age * 86400:
+            err('WARNING: Discarding checkpoint "{}" started on {}!'.format(self.path, started))
+            return 0
+        self.started = started
+        for record in records[1:]:
+            kind = record[0]
+            if kind == 'dir':
+                self.dirs[record[1]] = record[2:]
+            elif kind == 'hash':
+                self.hashes[record[1:4]] = record[4:]
+            elif kind == 'compare':
+                self.compares[record[1]] = record[2]
+        count('checkpoint.resumed')
+        count('checkpoint.records', len(records) - 1)
+        return end
+
+    def _append(self, record):
+        # Buffers a record, the journal is written
+        # in batches and synced every interval
+        data = pickle.dumps(record, pickle.HIGHEST_PROTOCOL)
+        with self.lock:
+            self.pending.append(_FRAME.pack(len(data), zlib.crc32(data)) + data)
+            if len(self.pending) >= self.batch or time.time() - self.synced >= self.interval:
+                self._flush()
+
+    def _flush(self):
+        # Writes buffered records and syncs
+        # them, caller must hold the lock
+        if self.closed:
+            return
+        if self.pending:
+            self.fh.write(b''.join(self.pending))
+            self.pending = []
+        self.fh.flush()
+        os.fsync(self.fh.fileno())
+        self.synced = time.time()
+
+    def flush(self):
+        """Writes and syncs any buffered records to the journal."""
+        with self.lock:
+            self._flush()
+
+    def listing(self, pdir, stat_res):
+        """Looks up the journaled listing of a directory.
+        @param pdir <str>:
+            Absolute path of the directory
+        @param stat_res <os.stat_result>:
+            Results of stat-ing the directory
+        @return listing <tuple(list[tuple(str, tuple)], list[str])>:
+            Names and stat fields of its files, and names of its child
+            directories, or None if it was not listed or has changed
+        """
+        entry = self.dirs.get(pdir)
+        if entry is None or entry[:3] != (stat_res.st_ino, stat_res.st_nlink, stat_res.st_mtime_ns):
+            return None
+        count('checkpoint.listings.reused')
+        return pickle.loads(zlib.decompress(entry[3]))
+
+    def listed(self, pdir, stat_res, listing):
+        """Journals the listing of a directory.
+        @param pdir <str>:
+            Absolute path of the directory
+        @param stat_res <os.stat_result>:
+            Results of stat-ing the directory before it was listed
+        @param listing <tuple(list[tuple(str, tuple)], list[str])>:
+            Names and stat fields of its files, and names of its child directories
+        """
+        blob = zlib.compress(pickle.dumps(listing, pickle.HIGHEST_PROTOCOL))
+        self._append(('dir', pdir, stat_res.st_ino, stat_res.st_nlink, stat_res.st_mtime_ns, blob))
+
+    def checksum(self, record, kind):
+        """Looks up the journaled checksum of a file.
+        @param record <Record>:
+            Stat record of the file
+        @param kind <str>:
+            Algorithm and type of checksum, i.e. 'md5:head' or 'md5:full'
+        @return digest <bytes>:
+            Checksum of the file, or None if it was not hashed or has changed
+        """
+        entry = self.hashes.get((kind, record.dev, record.ino))
+        if entry is None or entry[:2] != (record.size, record.mtime_ns):
+            return None
+        count('checkpoint.hashes.reused')
+        return entry[2]
+
+    def hashed(self, record, kind, digest):
+        """Journals the checksum of a file.
+        @param record <Record>:
+            Stat record of the file
+        @param kind <str>:
+            Algorithm and type of checksum, i.e. 'md5:head' or 'md5:full'
+        @param digest <bytes>:
+            Checksum of the file
+        """
+        self._append(('hash', kind, record.dev, record.ino, record.size, record.mtime_ns, digest))
+
+    def comparison(self, key, records):
+        """Looks up the journaled groups of a byte by byte comparison.
+        @param key <tuple>:
+            Key of the group of candidate duplicates, i.e. size and fingerprints
+        @param records list[<Record>]:
+            Stat records of the candidate duplicates in order
+        @return groups <list[list[int]]>:
+            Groups of identical files as indices into records, or None
+        """
+        groups = self.compares.get((key, self._identities(records)))
+        if groups is not None:
+            count('checkpoint.compares.reused')
+        return groups
+
+    def compared(self, key, records, groups):
+        """Journals the groups of a byte by byte comparison.
+        @param key <tuple>:
+            Key of the group of candidate duplicates, i.e. size and fingerprints
+        @param records list[<Record>]:
+            Stat records of the candidate duplicates in order
+        @param groups <list[list[int]]>:
+            Groups of identical files as indices into records
+        """
+        self._append(('compare', (key, self._identities(records)), groups))
+
+    @staticmethod
+    def _identities(records):
+        return tuple((r.dev, r.ino, r.size, r.mtime_ns) for r in records)
+
+    def close(self, complete = True):
+        """Writes any buffered records and closes the journal. Once the scan is
+        complete, the journal is removed.
+        @param complete <bool>:
+            True if the scan of every path is complete
+        """
+        with self.lock:
+            if self.closed:
+                return
+            self._flush()
+            self.closed = True
+            self.fh.close()
+        if complete:
+            os.remove(self.path)
+
+
+class JournaledState(object):
+    """Looks up the listing of a directory in a checkpoint first, and falls
+    back to the state of a previous scan. New listings are journaled and
+    passed on, so the new state is complete like it would be without a
+    checkpoint. It can be used in place of a ScanState.
+    @param checkpoint <Checkpoint>:
+        Journal of the scan
+    @param state <ScanState>:
+        Optional state of a previous scan, see state.ScanState
+    """
+    def __init__(self, checkpoint, state = None):
+        self.checkpoint = checkpoint
+        self.state = state
+
+    def get(self, pdir, stat_res):
+        """Looks up the listing of a directory, see ScanState.get()."""
+        listing = self.checkpoint.listing(pdir, stat_res)
+        if listing is not None:
+            if self.state is not None:
+                # Carry over to the new state
+                self.state.put(pdir, stat_res, listing)
+            return listing
+        if self.state is not None:
+            listing = self.state.get(pdir, stat_res)
+            if listing is not None:
+                self.checkpoint.listed(pdir, stat_res, listing)
+        return listing
+
+    def put(self, pdir, stat_res, listing):
+        """Records the listing of a directory, see ScanState.put()."""
+        self.checkpoint.listed(pdir, stat_res, listing)
+        if self.state is not None:
+            self.state.put(pdir, stat_res, listing)
+
+    def close(self, complete = True):
+        """Syncs the checkpoint and closes the state, see ScanState.close()."""
+        self.checkpoint.flush()
+        if self.state is not None:
+            self.state.close(complete)
+
+
+class JournaledCache(object):
+    """Looks up the checksum of a file in a checkpoint first, and falls back
+    to a persistent hash cache. New checksums are journaled and passed on to
+    the cache. It can be used in place of a HashCache.
+    @param checkpoint <Checkpoint>:
+        Journal of the scan
+    @param cache <HashCache>:
+        Optional persistent cache of previously calculated checksums
+    """
+    def __init__(self, checkpoint, cache = None):
+        self.checkpoint = checkpoint
+        self.cache = cache
+
+    def get(self, record, kind):
+        """Looks up the checksum of a file, see HashCache.get()."""
+        digest = self.checkpoint.checksum(record, kind)
+        if digest is None and self.cache is not None:
+            digest = self.cache.get(record, kind)
+            if digest is not None:
+                self.checkpoint.hashed(record, kind, digest)
+        return digest
+
+    def put(self, record, kind, digest):
+        """Adds the checksum of a file, see HashCache.put()."""
+        self.checkpoint.hashed(record, kind, digest)
+        if self.cache is not None:
+            self.cache.put(record, kind, digest)
+
+    def flush(self):
+        """Syncs the checkpoint and writes buffered checksums to the cache."""
+        self.checkpoint.flush()
+        if self.cache is not None:
+            self.cache.flush()
+
+    def close(self):
+        """Syncs the checkpoint and closes the cache, see HashCache.close()."""
+        self.checkpoint.flush()
+        if self.cache is not None:
+            self.cache.close()
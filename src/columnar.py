@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+# Python standard library
+from __future__ import print_function
+from array import array
+import sys, json, zlib, struct
+
+# Binary columnar tables, i.e. the listing of ls
+# or a partial index, start with a magic number
+# followed by a JSON header of the columns
+MAGIC = b'SSCOLv1\n'
+
+# Column names and types of the listing of ls,
+# owners, groups and other low cardinality
+# columns are dictionary encoded
+LS_COLUMNS = [
+    ('Inode', 'uint'), ('Permissions', 'dict'), ('Owner', 'dict'),
+    ('Group', 'dict'), ('Bytes', 'int'), ('Size', 'dict'), ('MDate', 'dict'),
+    ('Age', 'int'), ('File', 'str'), ('NDuplicates', 'int'),
+    ('BDuplicates', 'int'), ('SDuplicates', 'dict'), ('DOwners', 'dict'),
+    ('Duplicates', 'str')
+]
+
+# Integer columns are stored as little-endian
+# 64-bit arrays on every platform
+_typecodes = {'int': 'q', 'uint': 'Q'}
+_swapped = sys.byteorder != 'little'
+_count = struct.Struct('<I')
+
+
+def _packed(values, typecode):
+    """Packs integers into little-endian bytes.
+    @param values <list[int]>:
+        Values of a column
+    @param typecode <str>:
+        Type code of the array, see array.array
+    @return data <bytes>:
+        Packed values
+    """
+    values = array(typecode, values)
+    if _swapped:
+        values.byteswap()
+    return values.tobytes()
+
+
+def _unpacked(data, typecode):
+    """Unpacks little-endian bytes into a list of integers.
+    @param data <bytes>:
+        Packed values
+    @param typecode <str>:
+        Type code of the array, see array.array
+    @return values <list[int]>:
+        Values of a column
+    """
+    values = array(typecode)
+    values.frombytes(data)
+    if _swapped:
+        values.byteswap()
+    return values.tolist()
+
+
+def _encoded(values, kind):
+    """Encodes the values of a column in a block. Strings and bytes are stored
+    as an array of their lengths followed by their contents. Dictionary encoded
+    columns store the distinct values of the block, followed by a code per row.
+    @param values <list>:
+        Values of a column
+    @param kind <str>:
+        Type of the column: int, uint, str, bytes or dict
+    @return payload <bytes>:
+        Uncompressed contents of the column
+    """
+    if kind in _typecodes:
+        return _packed([int(v) for v in values], _typecodes[kind])
+    if kind == 'dict':
+        codes, distinct = [], {}
+        for value in values:
+            try:
+                codes.append(distinct[value])
+            except KeyError:
+                distinct[value] = len(distinct)
+                codes.append(distinct[value])
+        return _count.pack(len(distinct)) + _encoded(list(distinct), 'str') + _packed(codes, 'I')
+    if kind == 'str':
+        values = [v.encode('utf-8', 'surrogateescape') for v in values]
+    else:
+        values = [v if v is not None else b'' for v in values]
+    return _packed([len(v) for v in values], 'I') + b''.join(values)
+
+
+def _decoded(payload, kind, nrows, offset = 0):
+    """Decodes the values of a column in a block.
+    @param payload <bytes>:
+        Uncompressed contents of the column
+    @param kind <str>:
+        Type of the column: int, uint, str, bytes or dict
+    @param nrows <int>:
+        Number of values in the block
+    @param offset <int>:
+        Position of the column in the payload
+    @return (values, offset) <tuple(list, int)>:
+        Values of a column, and the position following them
+    """
+    if kind in _typecodes:
+        end = offset + 8 * nrows
+        return _unpacked(payload[offset:end], _typecodes[kind]), end
+    if kind == 'dict':
+        ndistinct, = _count.unpack_from(payload, offset)
+        distinct, offset = _decoded(payload, 'str', ndistinct, offset + 4)
+        end = offset + 4 * nrows
+        return [distinct[c] for c in _unpacked(payload[offset:end], 'I')], end
+    end = offset + 4 * nrows
+    lengths = _unpacked(payload[offset:end], 'I')
+    values = []
+    for length in lengths:
+        values.append(payload[end:end + length])
+        end += length
+    if kind == 'str':
+        values = [v.decode('utf-8', 'surrogateescape') for v in values]
+    else:
+        values = [v if v else None for v in values]
+    return values, end
+
+
+class ColumnarWriter(object):
+    """Writes rows to a binary columnar table. Rows are buffered into blocks,
+    and each column of a block is encoded by its type and compressed with zlib.
+    Integers are stored as typed 64-bit arrays instead of text, and low
+    cardinality strings, like owners or groups, as codes into a dictionary of
+    the block. An empty block marks the end of the table, so a truncated table
+    is detected by its reader.
+    @param fh <file>:
+        File object opened in binary mode
+    @param kind <str>:
+        Type of table, i.e. ls or index
+    @param columns <list[tuple(str, str)]>:
+        Name and type of each column: int, uint, str, bytes or dict
+    @param meta <dict>:
+        Additional information stored in the header
+    @param block_rows <int>:
+        Number of rows in each block
+    @param level <int>:
+        zlib compression level
+    """
+    def __init__(self, fh, kind, columns, meta = None, block_rows = 65536, level = 6):
+        self.fh = fh
+        self.columns = [(name, kind) for name, kind in columns]
+        self.block_rows = block_rows
+        self.level = level
+        self.rows = []
+        header = json.dumps({
+            'kind': kind,
+            'columns': self.columns,
+            'meta': meta or {}
+        }).encode('utf-8')
+        self.fh.write(MAGIC + _count.pack(len(header)) + header)
+
+    def add(self, row):
+        """Adds a row to the table.
+        @param row <list>:
+            Values of each column
+        """
+        self.rows.append(row)
+        if len(self.rows) >= self.block_rows:
+            self._flush()
+
+    def _flush(self):
+        # Writes buffered rows as a block,
+        # each column is compressed with a
+        # length prefix
+        if not self.rows:
+            return
+        values = zip(*self.rows)
+        chunks = [_count.pack(len(self.rows))]
+        for (name, kind), column in zip(self.columns, values):
+            payload = zlib.compress(_encoded(column, kind), self.level)
+            chunks.append(_count.pack(len(payload)))
+            chunks.append(payload)
+        self.fh.write(b''.join(chunks))
+        self.rows = []
+
+    def close(self):
+        """Writes any buffered rows and the end of the table."""
+        self._flush()
+        self.fh.write(_count.pack(0))
+        self.fh.flush()
+
+
+def is_columnar(fh):
+    """Checks if a file object contains a columnar table without consuming it.
+    @param fh <file>:
+        Buffered file object opened in binary mode, i.e. sys.stdin.buffer
+    @return columnar <bool>:
+        True if the file starts with the magic number of a columnar table
+    """
+    try:
+        return fh.peek(len(MAGIC))[:len(MAGIC)] == MAGIC
+    except (AttributeError, OSError, ValueError):
+        return False
+
+
+def is_columnar_file(filename):
+    """Checks if a file contains a columnar table.
+    @param filename <str>:
+        Path of the file
+    @return columnar <bool>:
+        True if the file starts with the magic number of a columnar table
+    """
+    with open(filename, 'rb') as fh:
+        return fh.read(len(MAGIC)) == MAGIC
+
+
+def read_header(fh):
+    """Reads the header of a columnar table.
+    @param fh <file>:
+        File object opened in binary mode
+    @return info <dict>:
+        Type of table, names and types of its columns, and its meta data
+    """
+    if fh.read(len(MAGIC)) != MAGIC:
+        raise ValueError('Not a columnar table written by spacesaver')
+    length, = _count.unpack(fh.read(4))
+    info = json.loads(fh.read(length).decode('utf-8'))
+    info['columns'] = [tuple(c) for c in info['columns']]
+    return info
+
+
+def _read(fh, size):
+    # Reads exactly size bytes
+    data = fh.read(size)
+    if len(data) != size:
+        raise ValueError('Columnar table is truncated')
+    return data
+
+
+def read_blocks(fh, info):
+    """Generator to read the blocks of a columnar table after its header.
+    @param fh <file>:
+        File object opened in binary mode, positioned after the header
+    @param info <dict>:
+        Header of the table, see read_header()
+    @yields columns <list[list]>:
+        Values of each column of a block
+    """
+    while True:
+        nrows, = _count.unpack(_read(fh, 4))
+        if nrows == 0:
+            return
+        columns = []
+        for name, kind in info['columns']:
+            length, = _count.unpack(_read(fh, 4))
+            payload = zlib.decompress(_read(fh, length))
+            columns.append(_decoded(payload, kind, nrows)[0])
+        yield columns
+
+
+def read_rows(fh, info = None):
+    """Generator to read the rows of a columnar table. Integer columns are
+    returned as int, and all other columns as str, or bytes.
+    @param fh <file>:
+        File object opened in binary mode
+    @param info <dict>:
+        Header of the table if it was already read, see read_header()
+    @yields row <list>:
+        Values of each column of a row
+    """
+    if info is None:
+        info = read_header(fh)
+    for columns in read_blocks(fh, info):
+        for row in zip(*columns):
+            yield list(row)
@@ -3,14 +3,56 @@
 
 # Python standard library
 from __future__ import print_function, division
-import os, stat, datetime, math
-from pwd import getpwuid  # convert uid to user name
-from grp import getgrgid  # convert gid to group name  
+from itertools import groupby, islice, repeat
+from functools import lru_cache
+import os, stat, math, uuid, heapq, queue, threading, datetime
+
+# NumPy is an optional pypi dependency,
+# the totals of df are vectorized over
+# batches of files if it is installed
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 # Local imports
-from utils import fatal, err, md5sum
+from utils import fatal, err, opened, checksum, sampled, compared, pooled
 from shells import bash
-from benchmark import timer
+from benchmark import timer, timed, count, report, dumped, profiled, measure
+from cache import HashCache
+from index import FileIndex, SizeSketch, Record, header, indexed, started
+from columnar import is_columnar_file, read_header, read_rows
+from spill import SpillingGroups
+from state import ScanState
+from resolver import names
+from output import Timestamps
+from progress import Progress
+from throttle import limit, throttled
+from checkpoint import Checkpoint, JournaledState, JournaledCache
+
+
+def recorded(stat_res):
+    """Converts the results of os.stat() or os.DirEntry.stat() into a 
+    light-weight stat record that can be passed between each stage of ls. 
+    @param stat_res <os.stat_result>:
+        Results of stat-ing a file
+    @return record <Record>:
+        Inode, device, size, modification time in ns, uid, gid, and mode
+    """
+    return Record(stat_res.st_ino, stat_res.st_dev, stat_res.st_size, 
+        stat_res.st_mtime_ns, stat_res.st_uid, stat_res.st_gid, stat_res.st_mode)
+
+
+def modified(record):
+    """Gets the modification time of a stat record in seconds. The value
+    is identical to os.stat().st_mtime, i.e. seconds + nanoseconds * 1e-9.
+    @param record <Record>:
+        Stat record of a file
+    @return mtime <float>:
+        Modification time in seconds since the epoch
+    """
+    sec, nsec = divmod(record.mtime_ns, 1000000000)
+    return sec + nsec * 1e-9
 
 
 def normalized(path):
@@ -29,9 +71,11 @@ def normalized(path):
     return npath 
 
 
+@lru_cache(maxsize = 65536)
 def readable_size(sbytes):
     """Converts bytes into a human readable size. Size is reported in units
-    based on powers of 2 (where one KiB is 1024 bytes).
+    based on powers of 2 (where one KiB is 1024 bytes). Results are memoized,
+    as duplicate files and files of a listing often share the same size.
     @param sbytes <int>:
         Size in bytes
     @return size <str>:
@@ -50,72 +94,20 @@ def readable_size(sbytes):
     return size
 
 
-def _name(uid, uid_type):
-    """Handler to name() to get the name of a given id. If a uid/gid of 
-    an inactive account is provided the original uid or gid is returned.
-    @params uid <int>:
-        A uid/gid of a file or path, etc.
-    @param uid_type <int>:
-        Type of identifer, either 'user' or 'group'.
-    @return name <str>:
-        Returns the name of the user_id or group_id
-    """
-    try:
-        # Search for id in the unix database
-        if uid_type == 'user':
-            name = getpwuid(uid).pw_name
-        elif uid_type == 'group':
-            name = getgrgid(uid).gr_name
-    except KeyError:
-        # The uid or gid does not exist in unix database.
-        # This could be an old user or group that does not
-        # exist anymore; however, the file will still 
-        # will use the uid or gid in listings with ls.
-        # Example:
-        # -rw-rw---- 1 39452 CCBR 24931746426 Feb  5  2020 ./rawdata/file.bam
-        name = str(uid)  # convert potential int to string 
-    return name
-
-
-def name(uid, uid_type, uid_records):
-    """Converts a user_id/group_id into a user_name/group_name while maintaining 
-    a local lookup of previously converted ids to prevent redundant unix database search.
-    Using a local cache or lookup is about twice as fast and prevents unneccesary hammering of
-    the unix user/group database. 'uids' of inactive/deleted users or groups cannot be converted
-    so the uid will be returned as the user/group name. 
-    @param uid <int>:
-        Unique identifer for a user or group.
-    @param uid_type <int>:
-        Type of identifer, either 'user' or 'group'.
-    @params uid_records <dict>:
-        Lookup of previously encountered uid/gid.
-    @return name <str>:
-        Returns the name of the user_id or group_id 
-    """
-    try:
-        # Try searching records/cache of previous lookups
-        # to prevent hammering of unix group database.
-        # This method is about twice as fast as just
-        # converting every id we encounter.
-        name = uid_records[uid]
-    except KeyError:
-        # The uid or gid is not in our records,
-        # search the unix group database and add 
-        # it to the record of encountered ids.
-        name = _name(uid, uid_type) 
-        uid_records[uid] = name
-
-    return name 
-
-
-def file_stats(file, users):
+# Modification dates and ages of files are
+# calculated against the start of the run
+timestamps = Timestamps()
+
+
+def file_stats(file, record=None):
     """Gets detailed information about a file using os.stat(). Returns a list containing
     a file's inode, permissions, owner, group, bytes_size, human_readable_size, 
-    modification_date.
+    modification_date. If the file was already stat-ed while traversing the directory 
+    tree, its stat record is re-used instead of calling os.stat() again.
     @param file <str>:
         Name of file to get detailed information
-    @params users <dict>:
-        Lookup of previously encountered uid/gid.
+    @param record <Record>:
+        Optional stat record of the file from traversed()
     @returns info <list>:
         List containing detailed information about a file:
             0=inode, 1=permissions, 2=owner, 3=group, 4=bsize, 5=hsize, 6=mdate, 7=age
@@ -124,88 +116,400 @@ def file_stats(file, users):
     # get detailed information about the file: 
     # https://docs.python.org/3/library/stat.html
     # Results are similar to the unix cmd stat
-    try:
-        stat_res = os.stat(file)
-    except Exception as e:
-        # Possible errors include permissions
-        # issues or non-existent file 
-        err('WARNING: Failed to get info on "{}" due to "{}" error!'.format(file, e))
-        return []   # cannot get stats
+    if record is None:
+        try:
+            count('stat_calls')
+            throttled('stat')
+            record = recorded(os.stat(file))
+        except Exception as e:
+            # Possible errors include permissions
+            # issues or non-existent file 
+            count('warnings')
+            err('WARNING: Failed to get info on "{}" due to "{}" error!'.format(file, e))
+            return []   # cannot get stats
     # Get the file's permissions, inode reference, 
     # owner and group name, modified timestamp, and 
     # size of the file in bytes and a human readable
     # format.
-    mode = stat_res.st_mode
-    permissions = stat.filemode(mode)
-    inode = stat_res.st_ino
-    owner = name(stat_res.st_uid, 'user', users)
-    group = name(stat_res.st_gid, 'group', users)
-    mdate = datetime.datetime.fromtimestamp(stat_res.st_mtime).strftime('%Y-%m-%d-%H:%M')
-    mtime = datetime.datetime.strptime(mdate, '%Y-%m-%d-%H:%M')
-    age = datetime.datetime.today() - mtime
-    age = round(age.total_seconds() / 86400.0, 4) # convert seconds to days
-    age = int(math.ceil(age))
-    bsize = stat_res.st_size
+    permissions = stat.filemode(record.mode)
+    inode = record.ino
+    owner = names.user(record.uid)
+    group = names.group(record.gid)
+    mdate, age = timestamps.formatted(record.mtime_ns)
+    bsize = record.size
     hsize = readable_size(bsize)
     # Format results before printing to standard 
     # output and convert all values to strings 
-    info = [inode, permissions, owner, group, bsize, hsize, mdate, age]
-    info = [str(val) for val in info]
+    info = [str(inode), permissions, owner, group, str(bsize), hsize, mdate, str(age)]
 
     return info
 
 
-def dereferenced(files):
+def dereferenced(fids, index):
     """Filters a list of files with multiple references
     to the same inode. A list of files with multiple
     hardlinks will be filtered so only one reference 
-    to an inode will be preserved.
-    @params files <list>:
-        A list of files to filter for hardlinks
-    @returns unique_files <list>:
-        A filterfed list of files where only one 
+    to an inode will be preserved. The stat record of
+    each file is used, so no additional stat is needed.
+    @params fids <list[int]>:
+        A list of file ids to filter for hardlinks
+    @params index <FileIndex>:
+        Index of the paths and stat records of each file
+    @returns unique_fids <list[int]>:
+        A filterfed list of file ids where only one 
         reference to an inode is preserved
     """
     # Set to keep track of hard links
-    # {inodeX, inodeY, inodeZ, ...}
+    # {(devX, inodeX), (devY, inodeY), ...}
     inodes = set()
-    unique_files = []
+    unique_fids = []
 
-    for file in files:
-        inode = os.stat(file).st_ino
+    for fid in fids:
+        inode = (index.devices[fid], index.inodes[fid])
         if inode not in inodes:
             # First occurence of inode, preserve
             # only one reference to a file
             inodes.add(inode) 
-            unique_files.append(file)
+            unique_fids.append(fid)
+
+    return unique_fids
+
 
-    return unique_files
+def listed(pdir, skip_links = True, state = None):
+    """Lists the contents of a single directory with os.scandir(). The type of
+    each entry is known without a stat call, so only files are stat-ed. Like 
+    os.walk(), directories that cannot be listed are skipped over. Given the 
+    state of a previous scan, the listing of an unchanged directory is re-used.
+    @param pdir <str>:
+        Absolute path of the directory to list
+    @param skip_links <bool>:
+        Skips over sym-linked files when True 
+    @param state <ScanState>:
+        Optional state of a previous scan, see state.ScanState
+    @return (files, chdirs) <tuple(list[tuple(str, Record)], list[str])>:
+        Files with their stat records, and child directories to descend into
+    """
+    files, chdirs = [], []
+    stat_res = None
+    if state is not None:
+        try:
+            count('stat_calls')
+            throttled('stat')
+            stat_res = os.stat(pdir)
+        except OSError:
+            pass   # list the directory
+        listing = state.get(pdir, stat_res) if stat_res is not None else None
+        if listing is not None:
+            # Directory has not changed 
+            # since the previous scan
+            names, chnames = listing
+            files = [(os.path.join(pdir, n), Record(*r)) for n, r in names]
+            chdirs = [os.path.join(pdir, n) for n in chnames]
+            return files, chdirs
 
+    try:
+        count('scandir_calls')
+        throttled('stat')
+        with os.scandir(pdir) as entries:
+            entries = list(entries)
+    except OSError:
+        # Like os.walk(), directories that 
+        # cannot be listed are skipped over
+        return files, chdirs
 
-def traversed(path, skip_links = True):
+    for entry in entries:
+        try:
+            is_dir = entry.is_dir()
+        except OSError:
+            is_dir = False
+        if is_dir:
+            # Never descend into sym-linked
+            # directories, same as os.walk()
+            if not entry.is_symlink():
+                chdirs.append(entry.path)
+            continue
+        # Check whether to skip over symlinks
+        if skip_links and entry.is_symlink():
+            continue  # Skip over symlink
+        try:
+            count('stat_calls')
+            throttled('stat')
+            record = recorded(entry.stat(follow_symlinks = not skip_links))
+        except Exception as e:
+            # Possible errors include permissions
+            # issues or non-existent file
+            count('warnings')
+            err('WARNING: Failed to get info on "{}" due to "{}" error!'.format(entry.path, e))
+            stat_res = None   # listing is incomplete
+            continue   # goto next file
+        files.append((entry.path, record))
+
+    if stat_res is not None:
+        # Record the listing by name, the
+        # paths are rebuilt when it is re-used
+        start = len(os.path.join(pdir, ''))
+        state.put(pdir, stat_res, (
+            [(f[start:], tuple(r)) for f, r in files], 
+            [d[start:] for d in chdirs]
+        ))
+
+    return files, chdirs
+
+
+def traversed(path, skip_links = True, state = None):
     """Generator to recursively traverse a given directory structure and yields the 
-    absolute path + file name of each file encountered. By default, sym links are 
+    absolute path + file name of each file encountered along with its stat record.
+    Directories are listed with os.scandir(), so the type of an entry is known 
+    without a stat call, and each file is stat-ed exactly once. Directories are 
+    visited in the same top-down order as os.walk(). By default, sym links are 
     skipped over. 
     @param path <str>:
         Path to recusively list directory contents
     @param skip_links <bool>:
         Skips over sym-linked files when True 
+    @param state <ScanState>:
+        Optional state of a previous scan, see state.ScanState
+    @yields (file, record) <tuple(str, Record)>:
+        Absolute path of a file and its stat record
     """
     # Normalize path, coverts to absolute path and 
     # dereferences path alias (like "~" -> "/home") 
     path = normalized(path)
 
     # Recursively descend the directory tree
-    # and list information about its files
-    for pdir, chdirs, files in os.walk(path):
-        for f in files:
-            # Get absolute referece to file  
-            file = os.path.join(pdir, f)
-            # Check whether to skip over symlinks
-            if skip_links and os.path.islink(file):
-                continue  # Skip over symlink
+    # and list information about its files,
+    # the stack of directories left to list
+    pdirs = [path]
+    while pdirs:
+        pdir = pdirs.pop()
+        files, chdirs = listed(pdir, skip_links, state)
+        for file_record in files:
+            yield file_record
+        # Visit child directories in top-down order
+        pdirs.extend(reversed(chdirs))
+
+
+def walked(path, threads = 1, skip_links = True, state = None):
+    """Multi-threaded version of traversed(). Directories are listed concurrently
+    by a pool of worker threads pulling from a shared work queue. On network or 
+    parallel file systems, the latency of listing one directory overlaps with 
+    listing others. Listings are buffered and yielded in the same top-down order 
+    as traversed(), so the output of ls does not depend on the number of threads.
+    @param path <str>:
+        Path to recusively list directory contents
+    @param threads <int>:
+        Number of threads listing directories, 1 falls back to traversed() 
+    @param skip_links <bool>:
+        Skips over sym-linked files when True 
+    @param state <ScanState>:
+        Optional state of a previous scan, see state.ScanState
+    @yields (file, record) <tuple(str, Record)>:
+        Absolute path of a file and its stat record
+    """
+    if threads < 2:
+        # Single-threaded directory walk
+        for file_record in traversed(path, skip_links, state):
+            yield file_record
+        return
 
-            yield file
+    path = normalized(path)
+    # Shared work queue of directories to list, 
+    # a LIFO queue keeps workers close to the
+    # top-down order directories are yielded
+    work = queue.LifoQueue()
+    listings = {}  # {pdir: (files, chdirs), ...}
+    ready = threading.Condition()
+
+    def worker():
+        while True:
+            pdir = work.get()
+            if pdir is None:
+                return   # stop listing directories
+            try:
+                listing = listed(pdir, skip_links, state)
+            except Exception as e:
+                count('warnings')
+                err('WARNING: Failed to list "{}" due to "{}" error!'.format(pdir, e))
+                listing = ([], [])
+            for chdir in reversed(listing[1]):
+                work.put(chdir)
+            with ready:
+                listings[pdir] = listing
+                ready.notify_all()
+
+    workers = [threading.Thread(target = worker, daemon = True) for i in range(threads)]
+    for thread in workers:
+        thread.start()
+
+    try:
+        work.put(path)
+        pdirs = [path]
+        while pdirs:
+            pdir = pdirs.pop()
+            # Wait for a worker to list the
+            # next directory in top-down order
+            with ready:
+                while pdir not in listings:
+                    ready.wait()
+                files, chdirs = listings.pop(pdir)
+            for file_record in files:
+                yield file_record
+            pdirs.extend(reversed(chdirs))
+    finally:
+        # Stop workers, also runs if the 
+        # generator is closed before the 
+        # entire tree has been traversed
+        for thread in workers:
+            work.put(None)
+
+
+def fingerprinted(stage, size, blocksize = 65536):
+    """Gets the offsets of the blocks that make up the fingerprint of a file for a
+    given stage. Available stages include: 'head' for the first block of a file, 
+    'tail' for its last block, and 'sample:N' for N evenly spaced blocks between 
+    its first and last block.
+    @param stage <str>:
+        Name of the fingerprint stage, i.e. head, tail, sample:4
+    @param size <int>:
+        Size of the file in bytes
+    @param blocksize <int>:
+        Size of each block in bytes
+    @return offsets <list[int]>:
+        Offsets of the blocks to read
+    """
+    last = max(size - blocksize, 0)
+    if stage == 'head':
+        return [0]
+    elif stage == 'tail':
+        return [last]
+    # Evenly spaced samples, i.e. sample:N
+    nblocks = int(stage.split(':')[1])
+    return [last * (i + 1) // (nblocks + 1) for i in range(nblocks)]
+
+
+def hashed(candidates, hasher, kind, jobs = 1, cache = None, known = None):
+    """Generator to calculate the checksums of candidate duplicate files with a
+    bounded pool of threads. If a hash cache is provided, the checksum of a file
+    that has not changed since it was last hashed is looked up instead of being
+    re-calculated, and any newly calculated checksums are added to the cache. 
+    @param candidates <iter[tuple(tuple, str, Record, ...)]>:
+        Candidate duplicates, i.e. the key of their group, absolute path, stat record, and file id
+    @param hasher <func>:
+        Function to calculate the checksum of a candidate, i.e. calls checksum()
+    @param kind <str>:
+        Type of checksum in the hash cache, i.e. 'md5:head' or 'md5:full'
+    @param jobs <int>:
+        Number of threads used to calculate checksums
+    @param cache <HashCache>:
+        Optional persistent cache of previously calculated checksums
+    @param known <func>:
+        Optional function that returns the checksum of a candidate if it is
+        already known, i.e. from a previous stage, otherwise None
+    @yields (candidate, digest, error) <tuple>:
+        Candidate duplicate, its checksum or None, and exception or None
+    """
+    def looked_up(candidates):
+        # Cache lookups run in the calling
+        # thread, sqlite connections cannot
+        # be shared across threads
+        for candidate in candidates:
+            digest = None
+            if known is not None:
+                digest = known(candidate)
+                if digest is not None:
+                    yield candidate, digest, False
+                    continue
+            if cache is not None:
+                digest = cache.get(candidate[2], kind)
+            yield candidate, digest, digest is None
+
+    def calculated(item):
+        candidate, digest, missing = item
+        if missing:
+            digest = hasher(candidate)
+        return digest
+
+    try:
+        for (candidate, _, missing), digest, e in pooled(calculated, looked_up(candidates), jobs):
+            if e is None and missing and cache is not None:
+                cache.put(candidate[2], kind, digest)
+            yield candidate, digest, e
+    finally:
+        if cache is not None:
+            cache.flush()
+
+
+def verified(files, size, algorithm = 'md5', blocksize = 65536, read_block = 1048576, max_open = 256):
+    """Splits a group of candidate duplicates into groups of identical files by
+    comparing their contents chunk by chunk in lockstep with compared(). Files 
+    that are not larger than one block were already compared by the digest of 
+    their first block. Groups with more than 'max_open' files fall back to 
+    calculating the checksum of each file to stay within the open file limit.
+    @param files <list[tuple(str, int)]>:
+        Candidate duplicates with the same size and fingerprints, i.e. path and file id
+    @param size <int>:
+        Size of each file in bytes
+    @param algorithm <str>:
+        Hashing algorithm used when falling back to checksums
+    @param blocksize <int>:
+        Size of a fingerprint block in bytes
+    @param read_block <int>:
+        Size of each read in bytes
+    @param max_open <int>:
+        Maximum number of files to open at once
+    @return (groups, errors) <tuple(list[list[tuple(str, int)]], list[tuple(str, Exception)])>:
+        Groups of identical files, and files that could not be read
+    """
+    if size <= blocksize:
+        # Entire file is the first block
+        return [files], []
+
+    if len(files) > max_open:
+        # Group by checksum of each file
+        digests, errors = {}, []
+        for file, fid in files:
+            try:
+                digest = checksum(file, algorithm, blocksize = read_block)
+            except Exception as e:
+                errors.append((file, e))
+                continue
+            if digest not in digests:
+                digests[digest] = []
+            digests[digest].append((file, fid))
+        return list(digests.values()), errors
+
+    groups, errors = compared([f for f, fid in files], read_block)
+    count('compare.groups', len(groups))
+    return [[files[i] for i in group] for group in groups], [(files[i][0], e) for i, e in errors]
+
+
+def reported(files):
+    """Gets the listing of a group of duplicate files. The oldest file is the
+    master copy of the group, and the rest of the files are its duplicates. A
+    group with a single file is listed with an empty string for duplicates.
+    @param files <list[tuple(str, Record)]>:
+        Duplicate files and their stat records
+    @return file_info <list>:
+        Listing of the master copy and its duplicates, see _ls() 
+    """
+    # Find the oldest file to represent the master copy
+    # of all the duplicates, sort files from oldest to newest.
+    # The stat records from traversal are re-used here.
+    files = sorted(files, key=lambda t: modified(t[1]))
+    # Get a list of the duplicate file owners
+    owners = "|".join([names.user(r.uid) for f, r in files[1:]])
+    file, record = files[0]
+    ndups = len(files[1:])
+    duplicates = "|".join([f for f, r in files[1:]])
+    file_info = file_stats(file, record)
+    if not file_info: return file_info   # cannot get info on file
+    duplicated = ndups * int(file_info[4])
+    # mtime = datetime.datetime.strptime(file_info[6], '%Y-%m-%d-%H:%M')
+    # age = datetime.datetime.today() - mtime
+    # age = round(age.total_seconds() / 86400.0, 4) # convert seconds to days
+    file_info.extend([file, str(ndups), str(duplicated), str(readable_size(duplicated)),  owners, duplicates])
+
+    return file_info
 
 
 def scored(age):
@@ -235,7 +539,7 @@ def scored(age):
     return score
 
 
-def _ls(path):
+def _ls(path, walk_threads=1, jobs=1, hash_cache=None, algorithm='md5', fingerprints=('head',), verify='hash', read_block=1048576, two_pass=False, max_memory=None, baseline=None, emit_index=None, checkpoint=None):
     """Generator for spacesavers ls which recursively lists
     information about files and directories for a given path. 
     Any symbolic links or multiple references to the same inode, 
@@ -243,6 +547,41 @@ def _ls(path):
     are skipped over when listing files.
     @param path <str>:
         Path to recusively list directory contents
+    @param walk_threads <int>:
+        Number of threads used to list directories
+    @param jobs <int>:
+        Number of threads used to calculate mini and full hashes
+    @param hash_cache <str>:
+        Optional path to a persistent cache of mini and full hashes
+    @param algorithm <str>:
+        Hashing algorithm used for mini and full hashes, see utils.hashers
+    @param fingerprints <list[str]>:
+        Chain of fingerprints to split candidate groups prior to calculating a 
+        full hash, the first block ('head') is always the first fingerprint, 
+        see fingerprinted() for more information
+    @param verify <str>:
+        Method to verify the final candidates, either 'hash' to calculate the 
+        checksum of each file, or 'compare' to compare their contents in lockstep
+    @param read_block <int>:
+        Size of each read in bytes when reading entire files
+    @param two_pass <bool>:
+        Traverses the directory tree twice to reduce memory usage, the first
+        pass only counts file sizes, so files with a unique size are listed
+        while traversing the tree instead of being kept in memory
+    @param max_memory <int>:
+        Approximate number of bytes used to group files by size and checksums,
+        past this limit groups are spilled to a temporary directory and are
+        regrouped with an external merge, None keeps all groups in memory
+    @param baseline <str>:
+        Optional path to the state of a previous scan, directories that have
+        not changed since the previous scan are not listed again, and the
+        state is replaced with the state of this scan
+    @param emit_index <IndexWriter>:
+        Optional partial index of this scan, each listed file is added with
+        its mini and full hash, see spacesaver merge
+    @param checkpoint <Checkpoint>:
+        Optional journal of an interrupted scan, journaled listings, checksums
+        and comparisons are re-used, and new ones are appended to it
     @yields file_info <list>:
         0=inode, 1=permissions, 2=owner, 3=group, 4=bytes, 5=size, 
         6=mdate, 7=file, 8=nduplicates, 9=bduplicates, 10=sduplicates, 
@@ -251,130 +590,801 @@ def _ls(path):
     # TODO: Refactor this later, rewrite as a class 
     # using the chain of responsibility design pattern
 
-    # Keeps track of previously converte user/group
-    # ids to avoid redundant lookups in the unix 
-    # user/group database, size and 64 KiB hashes 
+    # Keeps track of the size and 64 KiB hashes 
     # of encountered files to reduce search space
-    # of required MD5 calculations.
-    users = {}   # {uid: user_name, gid: group_name, ...}
-    sizes  = {}  # {size_bytes: ['/path/f1.txt', '/path/f2.txt'], ...}
-    mini_hashes = {}  # {(hash64KiB, size_bytes): ['/path/f1.txt', '/path/f2.txt'], ...}
-    full_hashes = {}  # {(hashFile, size_bytes): ['/path/f1.txt', '/path/f2.txt'], ...}
+    # of required MD5 calculations. Hashes are
+    # kept as raw digests of the given algorithm.
+    # Each file is referred to by its integer id
+    # in a compact index of paths and stat records.
+    # Given a memory limit, files are grouped by
+    # size on disk instead, and the groups of mini
+    # and full hashes share the limit, as the
+    # groups of two stages are kept at once.
+    index = FileIndex()
+    sizes  = {}  # {size_bytes: fid1, size_bytes: [fid2, fid3], ...}
+    spilled = SpillingGroups(max_memory) if max_memory else None
+    stage_memory = max_memory // 2 if max_memory else None
+    mini_hashes = SpillingGroups(stage_memory)  # {(size_bytes, hash64KiB, ...): [fid2, fid3], ...}
+    full_hashes = SpillingGroups(stage_memory)  # {(hashFile, size_bytes): [fid2, fid3], ...}
+    blocksize = 65536  # size of a fingerprint block
+    # Checksums of files that have not changed
+    # since a previous run are looked up in the
+    # persistent hash cache instead of re-reading
+    # the entire file.
+    cache = HashCache(hash_cache) if hash_cache else None
+    # Mini and full hashes of each candidate are
+    # kept for the partial index of this scan.
+    heads, fulls = {}, {}  # {fid: digest, ...}
+    # Listings of directories that have not 
+    # changed since the previous scan are
+    # re-used instead of stat-ing each file.
+    state = ScanState(baseline, normalized(path)) if baseline else None
+    # Listings and checksums of an interrupted
+    # scan are looked up in its journal first,
+    # and files are aged against its start.
+    if checkpoint is not None:
+        state = JournaledState(checkpoint, state)
+        cache = JournaledCache(checkpoint, cache)
+        timestamps.rebase(checkpoint.started)
+
+    def listing(file, record, fid = None):
+        # Lists a file that is NOT a
+        # candidate dup file, with an
+        # empty string for duplicates
+        if emit_index is not None:
+            emit_index.add(file, record, heads.get(fid))
+        return reported([(file, record)])
+
+    def unique(fid):
+        return listing(index.path(fid), index.record(fid), fid)
+
+    def candidates(groups):
+        # Candidate dups of groups with more
+        # than one file, paths and records are
+        # only built for files being hashed
+        for key, fids in groups.items():
+            if len(fids) > 1:
+                for fid in fids:
+                    yield key, index.path(fid), index.record(fid), fid
 
 
+    # Optionally count the size of each file in
+    # a first pass over the directory tree. The
+    # counts are kept in a fixed-size sketch, so
+    # only files with a size that is shared by 
+    # other files are kept in the second pass.
+    sketch = None
+    if two_pass:
+        sketch = SizeSketch()
+        with timed('ls.count'):
+            for file, record in walked(path, walk_threads, state = state):
+                sketch.add(record.size)
+
     # Recursively descend the directory tree
     # and list information about its files,
     # symbolic links are skipped over here.
-    for file in traversed(path):
-        # Find files that have the same size.
-        # Duplicate files will always have the 
-        # same size and candidates more checks
-        # like a partial mini-hash of the file 
-        # (first 64KiB MD5) AND calculating an 
-        # MD5 of the entire file.
-        try:
-            filesize = os.path.getsize(file)
+    # Each file is stat-ed once, its record
+    # is re-used in each of following steps.
+    nfiles = 0
+    with timed('ls.traverse'):
+        for file, record in walked(path, walk_threads, state = state):
+            nfiles += 1
+            if nfiles & 1023 == 0:
+                # Counted in batches, so the 
+                # progress of a scan is known
+                count('files.traversed', 1024)
+            if sketch is not None and sketch.count(record.size) < 2:
+                # Skip over mini hash calcualation 
+                # the file size is unique, so it 
+                # is NOT a candidate dup file.
+                count('two_pass.streamed')
+                file_info = listing(file, record)
+                if not file_info: continue   # cannot get info on file
+                yield file_info
+                continue                    # goto the next file
+            if spilled is not None:
+                # Paths and records are kept in groups
+                # that are spilled to disk past the
+                # memory limit instead of the index
+                spilled.add(record.size, (file, record))
+                continue
+            # Find files that have the same size.
+            # Duplicate files will always have the 
+            # same size and candidates more checks
+            # like a partial mini-hash of the file 
+            # (first 64KiB MD5) AND calculating an 
+            # MD5 of the entire file. Most sizes 
+            # are unique, so a list is only created
+            # for sizes shared by multiple files.
+            fid = index.add(file, record)
+            filesize = record.size
             if filesize not in sizes: 
-                sizes[filesize] = []
-            sizes[filesize].append(file)
-        except Exception as e:
-            # Possible errors include permissions
-            # issues or non-existent file
-            err('WARNING: Failed to get info on "{}" due to "{}" error!'.format(file, e))
-            continue   # goto next file
+                sizes[filesize] = fid
+            elif isinstance(sizes[filesize], int):
+                sizes[filesize] = [sizes[filesize], fid]
+            else:
+                sizes[filesize].append(fid)
+    count('files.traversed', nfiles & 1023)
+
+    if state is not None:
+        # Every directory has been listed,
+        # replace the previous scan's state
+        state.close()
+
+    # Filter hardlinks for files with the same
+    # filesize. These are candidate dups that
+    # can be further filtered with fingerprints.
+    buckets = 0
+    with timed('ls.group'):
+        groups = sizes.items() if spilled is None else spilled.items()
+        for size, fids in groups:
+            buckets += 1
+            if spilled is not None:
+                # Groups were merged from disk, only 
+                # candidate dups are added to the index
+                if len(fids) < 2:
+                    file_info = listing(*fids[0])
+                    if not file_info: continue   # cannot get info on file
+                    yield file_info
+                    continue                    # goto the next file
+                fids = [index.add(file, record) for file, record in fids]
+            if isinstance(fids, int):
+                # Skip over mini hash calcualation 
+                # the file size is unique, so it 
+                # is NOT a candidate dup file.
+                file_info = unique(fids)
+                if not file_info: continue   # cannot get info on file
+                yield file_info
+                continue                    # goto the next file
+            # Filter files with multiple references 
+            # to the same inode, i.e. multiple hardlinks.
+            # Keeps only one reference to a set of hardlinks.
+            fids = dereferenced(fids, index)
+            if len(fids) < 2:
+                file_info = unique(fids[0])
+                if not file_info: continue   # cannot get info on file
+                yield file_info
+                continue                    # goto the next file
+            for fid in fids:
+                mini_hashes.add((size,), fid)
+    count('size.buckets', buckets)
+    sizes = None  # groups are now kept in mini_hashes
+    if spilled is not None:
+        spilled.close()
+
+    # Progressively split candidate groups with a
+    # chain of cheap fingerprints, i.e. a mini hash
+    # of the first 64 KiB block, the last block, or
+    # N evenly spaced blocks of the file. Each stage
+    # appends its fingerprint to the key of a group.
+    previous = 'size'
+    for stage in fingerprints:
+        with timed('ls.fingerprint.{}'.format(stage)):
+            groups, mini_hashes = mini_hashes, SpillingGroups(stage_memory)
+            # Bytes read for each candidate, so the
+            # remaining bytes can be reported
+            weight = lambda size: min(size, len(fingerprinted(stage, size, blocksize)) * blocksize)
+            planned = 0
+            for key, fids in groups.items():
+                if len(fids) > 1:
+                    planned += weight(key[0]) * len(fids)
+                if len(fids) < 2:
+                    # Skip over the next fingerprint,
+                    # the previous fingerprint is unique,
+                    # so it is NOT a candidate dup file.
+                    count('fingerprint.{}.pruned'.format(previous))
+                    file_info = unique(fids[0])
+                    if not file_info: continue   # cannot get info on file
+                    yield file_info
+            count('candidates.planned_bytes', planned)
+
+            # Candidate dups are hashed by a pool of
+            # threads, results are returned in the same
+            # order as the candidates, so the groups are
+            # identical to calculating hashes serially.
+            # Unchanged files are found in the cache.
+            # The first block of a file that is not 
+            # larger than one block is the entire file,
+            # so it is only fingerprinted once.
+            for (key, file, record, fid), digest, e in hashed(candidates(groups), 
+                    lambda c: sampled(c[1], fingerprinted(stage, c[0][0], blocksize), algorithm, blocksize),
+                    '{}:{}'.format(algorithm, stage), jobs, cache,
+                    known = lambda c: c[0][-1] if stage != 'head' and c[0][0] <= blocksize else None):
+                count('candidates.hashed_bytes', weight(key[0]))
+                if e is not None:
+                    # Possible errors include permissions
+                    # issues or non-existent file
+                    count('warnings')
+                    err('WARNING: Failed to get info on "{}" due to "{}" error!'.format(file, e))
+                    continue   # goto next file
+                count('fingerprint.{}.candidates'.format(stage))
+                if emit_index is not None and stage == 'head':
+                    heads[fid] = digest
+                mini_hashes.add(key + (digest,), fid)
+            groups.close()
+            previous = stage
+    
+    # Calculate a full hash for files with 
+    # the same fingerprints. These are the final 
+    # candidates for duplication.
+    with timed('ls.compare' if verify == 'compare' else 'ls.full'):
+        planned = 0
+        for hash_tuple, fids in mini_hashes.items():
+            if len(fids) > 1 and hash_tuple[0] > blocksize:
+                # Files that are not larger than
+                # one block are not read again
+                planned += hash_tuple[0] * len(fids)
+            if len(fids) < 2:
+                # Skip over full hash calcualation 
+                # the mini hash is unique, so it 
+                # is NOT a candidate dup file.
+                count('fingerprint.{}.pruned'.format(previous))
+                file_info = unique(fids[0])
+                if not file_info: continue   # cannot get info on file
+                yield file_info
+                continue                    # goto the next file
+        count('candidates.planned_bytes', planned)
+
+        if verify == 'compare':
+            # Compare the contents of each group of 
+            # candidate dups chunk by chunk, a group
+            # is split as soon as its chunks differ.
+            # Groups are compared by a pool of threads.
+            groups = (
+                (hash_tuple, [(index.path(fid), fid) for fid in fids], [index.record(fid) for fid in fids]) 
+                for hash_tuple, fids in mini_hashes.items() if len(fids) > 1
+            )
+
+            def compare(group):
+                # Groups compared before the scan
+                # was interrupted are not re-read
+                hash_tuple, files, records = group
+                if checkpoint is not None:
+                    subgroups = checkpoint.comparison(hash_tuple, records)
+                    if subgroups is not None:
+                        return [[files[i] for i in subgroup] for subgroup in subgroups], [], True
+                return verified(files, hash_tuple[0], algorithm, blocksize, read_block) + (False,)
+
+            for (hash_tuple, files, records), verification, e in pooled(compare, groups, jobs):
+                if hash_tuple[0] > blocksize:
+                    count('candidates.hashed_bytes', hash_tuple[0] * len(files))
+                if e is not None:
+                    count('warnings')
+                    err('WARNING: Failed to get info on "{}" due to "{}" error!'.format(
+                        [f for f, fid in files], e))
+                    continue   # goto next group
+                subgroups, errors, journaled = verification
+                for file, e in errors:
+                    # Possible errors include permissions
+                    # issues or non-existent file
+                    count('warnings')
+                    err('WARNING: Failed to get info on "{}" due to "{}" error!'.format(file, e))
+                count('compare.candidates', len(files))
+                if checkpoint is not None and not (errors or journaled) and hash_tuple[0] > blocksize:
+                    position = {fid: i for i, (file, fid) in enumerate(files)}
+                    checkpoint.compared(hash_tuple, records, 
+                        [[position[fid] for file, fid in subgroup] for subgroup in subgroups])
+                for i, subgroup in enumerate(subgroups):
+                    for file, fid in subgroup:
+                        full_hashes.add((hash_tuple, i), fid)
+        else:
+            # Files that are not larger than one block
+            # re-use the digest of their first block as
+            # their full hash instead of being read twice.
+            for (hash_tuple, file, record, fid), full_hash, e in hashed(candidates(mini_hashes), 
+                    lambda c: checksum(c[1], algorithm, blocksize = read_block), 
+                    '{}:full'.format(algorithm), jobs, cache,
+                    known = lambda c: c[0][1] if c[0][0] <= blocksize else None):
+                if hash_tuple[0] > blocksize:
+                    count('candidates.hashed_bytes', hash_tuple[0])
+                if e is not None:
+                    # Possible errors include permissions
+                    # issues or non-existent file
+                    count('warnings')
+                    err('WARNING: Failed to get info on "{}" due to "{}" error!'.format(file, e))
+                    continue   # goto next file
+                # Calculate a full hash for files with 
+                # the same mini hash.             
+                size = hash_tuple[0]
+                count('full.candidates')
+                if size <= blocksize:
+                    count('full.reused')
+                if emit_index is not None:
+                    fulls[fid] = full_hash
+                full_hashes.add((full_hash, size), fid)
+
+    mini_hashes.close()
+    if cache is not None:
+        cache.close()
+
+    # Final link in chain of responsibilty.  
+    # Display information for duplicate files.
+    # Each group of duplicates gets an id in
+    # the partial index, so merge re-uses the
+    # groups of byte by byte comparisons too.
+    with timed('ls.report'):
+        dup_groups = 0
+        for hash_tuple, fids in full_hashes.items():
+            dup_group = 0
+            if len(fids) < 2:
+                count('full.pruned')
+            else:
+                dup_groups += 1
+                dup_group = dup_groups
+            files = []
+            for fid in fids:
+                file, record = index.path(fid), index.record(fid)
+                if emit_index is not None:
+                    emit_index.add(file, record, heads.get(fid), fulls.get(fid), dup_group)
+                files.append((file, record))
+            file_info = reported(files)
+            if not file_info: continue   # cannot get info on file
+            yield file_info
+    full_hashes.close()
+
 
-    # Calculate a mini hash for files with 
-    # the same filesize. These are candidate
-    # dups that can be further filtered. The mini 
-    # hash is calcualted from the first 64 KiB
-    # of the file.
-    for size, files in sizes.items():
+def _merge(indexes, jobs=1, hash_cache=None, read_block=1048576):
+    """Generator for spacesavers merge which combines the partial indexes 
+    of many ls jobs, i.e. one per child directory, to find duplicate files 
+    across each of their paths. Partial indexes are sorted by file size, so 
+    they are combined with a streaming k-way merge and only files of one size
+    are kept in memory at once. Mini and full hashes calculated by each ls
+    job are re-used, and so are the groups of duplicates each job resolved,
+    whether it compared files by their checksums or byte by byte, so only one
+    file of each group that shares its mini hash with a file in another index
+    is hashed.
+    @param indexes <list[str]>:
+        Partial indexes written by spacesaver ls --emit-index
+    @param jobs <int>:
+        Number of threads used to calculate mini and full hashes
+    @param hash_cache <str>:
+        Optional path to a persistent cache of mini and full hashes
+    @param read_block <int>:
+        Size of each read in bytes when reading entire files
+    @yields file_info <list>:
+        Same columns as _ls(), files are listed in order of their size
+    """
+    # Digests of each index must be created
+    # by the same hashing algorithm
+    infos = [header(index) for index in indexes]
+    algorithms = sorted(set(info['algorithm'] for info in infos))
+    blocksizes = sorted(set(info['blocksize'] for info in infos))
+    if len(algorithms) > 1 or len(blocksizes) > 1:
+        fatal('Fatal: Partial indexes were created with different hashing algorithms or blocks: {} {}'.format(
+            algorithms, blocksizes))
+    algorithm, blocksize = algorithms[0], blocksizes[0]
+    cache = HashCache(hash_cache) if hash_cache else None
+    # Files are aged against the start of the
+    # earliest scan, like a single ls of every
+    # path, if each index recorded its start
+    scanned = started(indexes)
+    if scanned is not None:
+        timestamps.rebase(datetime.datetime.fromtimestamp(scanned / 1e9))
+
+    # Each file is tagged with the number
+    # of the index, i.e. shard, it is from
+    shards = [zip(indexed(index), repeat(n)) for n, index in enumerate(indexes)]
+    for size, entries in groupby(heapq.merge(*shards, key=lambda e: e[0][1].size), key=lambda e: e[0][1].size):
         # Filter files with multiple references 
-        # to the same inode, i.e. multiple hardlinks.
-        # Keeps only one reference to a set of hardlinks.
-        files = dereferenced(files)
+        # to the same inode, i.e. hardlinks or
+        # overlapping paths in different indexes
+        inodes = set()
+        files, heads, fulls, resolved = [], [], [], []
+        for (file, record, head, full, dup_group), n in entries:
+            if (record.dev, record.ino) in inodes:
+                continue
+            inodes.add((record.dev, record.ino))
+            # Files of a shard with the same group
+            # are duplicates, and files of a shard
+            # in different groups are not, unless
+            # the shard did not record its groups
+            if dup_group is None:
+                resolved.append(None)
+            elif dup_group:
+                resolved.append((n, dup_group))
+            else:
+                resolved.append((n, 0, len(files)))
+            files.append((file, record))
+            heads.append(head)
+            fulls.append(full)
         if len(files) < 2:
             # Skip over mini hash calcualation 
             # the file size is unique, so it 
             # is NOT a candidate dup file.
-            file = files[0]
-            file_info = file_stats(file, users)
+            file_info = reported(files)
             if not file_info: continue   # cannot get info on file
-            file_info.extend([file, '0', '0', '0 B', '', '']) # empty string for duplicates
             yield file_info
             continue                    # goto the next file
 
-        for file in files:
-            try:
-                # Calculate a mini hash of the first
-                # 64 KiB chunk/block of the file. Files
-                # with the same mini hash will be candidates
-                # for an MD5 checksum of the entire file.
-                mini_hash = md5sum(file, first_block_only = True)
-                if (mini_hash, size) not in mini_hashes:
-                    mini_hashes[(mini_hash, size)] = []
-                mini_hashes[(mini_hash, size)].append(file)
-            except Exception as e:
+        # Calculate mini hashes that were never
+        # calculated, files of this size were 
+        # unique within their own index
+        count('merge.head.candidates', len(files))
+        count('merge.head.missing', sum(h is None for h in heads))
+        candidates = (((size,), file, record, i) for i, (file, record) in enumerate(files))
+        mini_hashes = {}   # {hash64KiB: [i1, i2, ...], ...}
+        for (key, file, record, i), digest, e in hashed(candidates,
+                lambda c: sampled(c[1], fingerprinted('head', size, blocksize), algorithm, blocksize),
+                '{}:head'.format(algorithm), jobs, cache, known = lambda c: heads[c[3]]):
+            if e is not None:
                 # Possible errors include permissions
                 # issues or non-existent file
+                count('warnings')
                 err('WARNING: Failed to get info on "{}" due to "{}" error!'.format(file, e))
                 continue   # goto next file
-    
-    # Calculate a full hash for files with 
-    # the same mini hash. These are the final 
-    # candidates for duplication.
-    for hash_tuple, files in mini_hashes.items():
-        if len(files) < 2:
-            # Skip over full hash calcualation 
-            # the mini hash is unique, so it 
-            # is NOT a candidate dup file.
-            file = files[0]
-            file_info = file_stats(file, users)
+            if digest not in mini_hashes:
+                mini_hashes[digest] = []
+            mini_hashes[digest].append(i)
+
+        # Groups of files that were all resolved 
+        # by the same shard are final, otherwise
+        # only one file of each group of a shard 
+        # is hashed to compare it to other shards
+        pending = []   # [(hash64KiB, [i1, i2, ...]), ...]
+        for digest, group in mini_hashes.items():
+            if len(group) < 2:
+                file_info = reported([files[group[0]]])
+                if not file_info: continue   # cannot get info on file
+                yield file_info
+                continue
+            dup_groups = {}   # {(shard, dup_group): [i1, i2, ...], ...}
+            for i in group:
+                dup_groups.setdefault(resolved[i] or (None, i), []).append(i)
+            shards_of = set(key[0] for key in dup_groups)
+            if len(shards_of) == 1 and None not in shards_of:
+                count('merge.resolved', len(group))
+                for members in dup_groups.values():
+                    file_info = reported([files[i] for i in members])
+                    if not file_info: continue   # cannot get info on file
+                    yield file_info
+                continue
+            pending.extend((digest, members) for members in dup_groups.values())
+
+        # Calculate full hashes that were never
+        # calculated, only for files with the 
+        # same mini hash as a file of another
+        # shard, files of its group are added
+        # to the group of its full hash
+        candidates = (
+            (digest, files[members[0]][0], files[members[0]][1], members) 
+            for digest, members in pending
+        )
+        full_hashes = {}   # {hashFile: [i1, i2, ...], ...}
+        for (digest, file, record, members), full_hash, e in hashed(candidates,
+                lambda c: checksum(c[1], algorithm, blocksize = read_block),
+                '{}:full'.format(algorithm), jobs, cache,
+                known = lambda c: fulls[c[3][0]] or (c[0] if size <= blocksize else None)):
+            if e is not None:
+                count('warnings')
+                err('WARNING: Failed to get info on "{}" due to "{}" error!'.format(file, e))
+                # Rest of its group are 
+                # still duplicates
+                if len(members) < 2: continue
+                file_info = reported([files[i] for i in members[1:]])
+                if not file_info: continue   # cannot get info on file
+                yield file_info
+                continue   # goto next file
+            count('merge.full.candidates')
+            if fulls[members[0]] is None:
+                count('merge.full.missing')
+            count('merge.resolved', len(members) - 1)
+            if full_hash not in full_hashes:
+                full_hashes[full_hash] = []
+            full_hashes[full_hash].extend(members)
+
+        for full_hash, group in full_hashes.items():
+            file_info = reported([files[i] for i in group])
             if not file_info: continue   # cannot get info on file
-            file_info.extend([file, '0', '0', '0 B', '', '']) # empty string for duplicates
             yield file_info
-            continue                    # goto the next file
 
-        size = hash_tuple[1]
-        for file in files:
+    if cache is not None:
+        cache.close()
+
+class Usage(object):
+    """Running totals of the disk space used by the files of a directory, i.e.
+    the size of its duplicated and total files, the total size of the files of
+    each owner, and the sum of the age score of each file. Only these totals 
+    are kept, so the memory of a directory does not grow with its files.
+    @param owner <str>:
+        Owner of the directory
+    """
+    __slots__ = ('owner', 'duplicated', 'available', 'per_user', 'age_total', 'nfiles')
+
+    def __init__(self, owner):
+        self.owner = owner
+        self.duplicated = 0
+        self.available = 0
+        self.per_user = {owner: 0}
+        self.age_total = 0.0
+        self.nfiles = 0
+
+    def add(self, filesize, ncopies, fowner, age_score):
+        """Adds a file of a listing of ls to the totals.
+        @param filesize <int>:
+            Size of the file in bytes
+        @param ncopies <int>:
+            Number of redundant copies of the file
+        @param fowner <str>:
+            Owner of the file
+        @param age_score <float>:
+            Age score of the file, see aged()
+        """
+        self.duplicated += filesize * ncopies        # duplication size of files
+        self.available += filesize * (ncopies + 1)   # total size of files
+        try:
+            self.per_user[fowner] += filesize * (ncopies + 1)
+        except KeyError:
+            self.per_user[fowner] = filesize * (ncopies + 1)
+        self.age_total += age_score
+        self.nfiles += 1
+
+    def extend(self, owners, sizes, ncopies, ages):
+        """Adds a batch of files of a listing of ls to the totals. The batch is
+        vectorized with NumPy if it is installed, the totals are identical to
+        adding each file in order with add().
+        @param owners <list[str]>:
+            Owner of each file
+        @param sizes <list[int|str]>:
+            Size of each file in bytes
+        @param ncopies <list[int|str]>:
+            Number of redundant copies of each file
+        @param ages <list[int|str]>:
+            Age of each file in days
+        """
+        if numpy is None:
+            for fowner, filesize, ncopy, age in zip(owners, sizes, ncopies, ages):
+                filesize = int(filesize)
+                age = int(float(age))
+                self.add(filesize, int(ncopy), fowner, aged(filesize, age))
+            return
+
+        nfiles = len(sizes)
+        sizes = vectorized(sizes, numpy.int64, int)
+        ncopies = vectorized(ncopies, numpy.int64, int)
+        ages = vectorized(ages, numpy.float64, float).astype(numpy.int64)
+        used = sizes * (ncopies + 1)
+        self.duplicated += int((sizes * ncopies).sum())
+        self.available += int(used.sum())
+        # Owners are coded in the order
+        # they first appear in the batch
+        codes = {}
+        inverse = numpy.array([codes.setdefault(fowner, len(codes)) for fowner in owners])
+        totals = numpy.zeros(len(codes), dtype = numpy.int64)
+        numpy.add.at(totals, inverse, used)
+        for fowner, i in codes.items():
+            self.per_user[fowner] = self.per_user.get(fowner, 0) + int(totals[i])
+        # Cumulative sum adds the age scores
+        # one at a time, i.e. like add()
+        scores = numpy.concatenate(([self.age_total], vaged(sizes, ages)))
+        self.age_total = float(numpy.cumsum(scores)[-1])
+        self.nfiles += nfiles
+
+    def summary(self, path, quota=200):
+        """Calculates the disk space usage and score of the directory.
+        @param path <str>:
+            Path of the directory
+        @param quota <int:
+            Diskspace quota of a given area in TiB
+        @return df_info <list[str]>:
+            0=path, 1=owner, 2=file_owners, 3=duplicated, 4=duplicated_bytes,
+            5=used, 6=used_bytes, 7=%duplicated, 8=wAgeS, 9=wDupS, 10=wOccS, 11=score
+        """
+        # Calculate a path's age-weighted score.
+        # PathScore is the weighted sum of three
+        # scores pertaining to the average file's 
+        # age and size, the duplication rate of a 
+        # given path, and overall occupancy/footprint
+        # of a path against a defined quota threshold
+        # where PathScore = 100 - (100 * (wAge*AgeScore + wDup*DupScore + wOcc*OccScore))
+        duplicated = self.duplicated
+        available = self.available
+        # Weights for AgeScore, DupScore, and OccScore
+        # where wAge + wDup + wOcc = 1 
+        wAge = 0.25
+        wDup = 0.45
+        wOcc = 0.35
+
+        # sort list by poweruser
+        filesize_per_user = dict(sorted(self.per_user.items(), key=lambda item: item[1], reverse=True))
+        
+        fowner_str_list = []
+        for fowner,fused in filesize_per_user.items():
             try:
-                # Calculate a full hash for files with 
-                # the same mini hash.             
-                full_hash = md5sum(file)
-                if (full_hash, size) not in full_hashes:
-                    full_hashes[(full_hash, size)] = []
-                full_hashes[(full_hash, size)].append(file)
-            except Exception as e:
-                # Possible errors include permissions
-                # issues or non-existent file
-                err('WARNING: Failed to get info on "{}" due to "{}" error!'.format(file, e))
-                continue   # goto next file
+                frac = fused / float(available)
+            except ZeroDivisionError:
+                frac = 0
+            fowner_str_list.append("{0}[{1}%]".format(fowner,round(frac * 100, 1)))
 
-    # Final link in chain of responsibilty.  
-    # Display information for duplicate files.
-    for hash_tuple, files in full_hashes.items():
+        # create string for pipe separated file owners in the folder
+        fowner_str = "|".join(fowner_str_list)
+
+        # Age Score is the average age score of all files,
+        # where age is scaled via the scored() function.
+        # AgeScore = sum(bytesPerFiles * scored(ageScorePerFile)) / len(Nfiles)
         try:
-            # Find the oldest file to represent the master copy
-            # of all the duplicates, sort files from oldest to newest.
-            files = sorted(files, key=lambda t: os.stat(t).st_mtime)
-            # Get a list of the duplicate file owners
-            owners = "|".join([name(os.stat(f).st_uid, 'user', users) for f in files[1:]])
-        except Exception as e:
-            # Possible errors include permissions
-            # issues or non-existent file
-            err('WARNING: Failed to get info on "{}" due to "{}" error!'.format(files, e))
-            continue   # goto next file
-        file = files[0]
-        ndups = len(files[1:])
-        duplicates = "|".join(files[1:])
-        file_info = file_stats(file, users)
-        if not file_info: continue   # cannot get info on file
-        duplicated = ndups * int(file_info[4])
-        # mtime = datetime.datetime.strptime(file_info[6], '%Y-%m-%d-%H:%M')
-        # age = datetime.datetime.today() - mtime
-        # age = round(age.total_seconds() / 86400.0, 4) # convert seconds to days
-        file_info.extend([file, str(ndups), str(duplicated), str(readable_size(duplicated)),  owners, duplicates])
-        yield file_info
+            AgeScore = self.age_total / self.nfiles
+        except ZeroDivisionError:
+            # Edge case where there are no files in a directory.
+            # Meaning, the directory is empty or only contains 
+            # symlinks.
+            return [path, self.owner, fowner_str, readable_size(duplicated), str(duplicated),  readable_size(available), str(available), '0.0%', '0.0', '0.0', '0.0', '100.0']
+
+        # DupScore = DuplicatedBytes / TotalBytes
+        try:
+            DupScore = duplicated / float(available)   # 0 indicates no duplicated files 
+        except ZeroDivisionError:
+            # Edge case where a directory is composed of a
+            # set of empty files. Meaning, all the encountered
+            # files are 0 bytes in size. Penalize with the worst
+            # DupScore, so it gets flagged for deletion later.
+            DupScore = 1.0
+
+        percent_duplicates = "{}%".format(round(DupScore * 100, 3))
+        
+        # OccScore = totalBytes / (0.05 * quota) if totalBytes is less than 5% of 
+        # quota. If a directory is greater than 5% of the quota, DupScore gets the
+        # worst possible score.
+        OccScore = 1.0
+        quota_bytes = quota * (2**40) # convert TiB to bytes
+        if float(available) <= (0.05*float(quota_bytes)):
+            OccScore = float(available) / (0.05 * quota_bytes)
+        
+        # Calculate the final weighted score of a path
+        Score = str(round(100 - (100 * ((wAge*AgeScore) + (wDup*DupScore) + (wOcc*OccScore))), 1))
+        # Calculate the individual weighted components
+        AgeC = str(round(100 * (wAge*AgeScore), 1))
+        DupC = str(round(100 * (wDup*DupScore), 1))
+        OccC = str(round(100 * (wOcc*OccScore), 1))
+
+        return [path, self.owner, fowner_str, readable_size(duplicated), str(duplicated), readable_size(available), str(available), percent_duplicates, AgeC, DupC, OccC, Score]
+
+
+def aged(filesize, age):
+    """Calculates the age score of a file in a listing of ls.
+    @param filesize <int>:
+        Size of the file in bytes
+    @param age <int>:
+        Age of the file in days
+    @return age_score <float>:
+        Age score of the file, see scored()
+    """
+    try:
+        return (filesize * scored(age)) / (filesize)
+    except ZeroDivisionError:
+        # File size is 0 bytes, add contribution of scaled age
+        if age == 0:
+            # Empty file modified today,
+            # scored(0) is already 0.0
+            return 0.0
+        return scored(age) / age
+
+
+def vectorized(values, dtype, parse):
+    """Converts a column of a batch of files into a NumPy array. Text is parsed
+    in a single call, and other values are converted one by one.
+    @param values <list[str|int]>:
+        Values of a column
+    @param dtype <numpy.dtype>:
+        Type of the array, i.e. numpy.int64
+    @param parse <function>:
+        Converts one value, i.e. int or float
+    @return array <numpy.ndarray>:
+        Values of the column
+    """
+    if values and isinstance(values[0], str):
+        array = numpy.fromstring(' '.join(values), dtype = dtype, sep = ' ')
+        if len(array) == len(values):
+            return array
+    # Values are not text, or text that
+    # could not be parsed in one call
+    return numpy.fromiter(map(parse, values), dtype, len(values))
+
+
+def vaged(sizes, ages):
+    """Vectorized aged() over arrays of files with NumPy. The age score of each
+    file is calculated with the same floating point operations as scored(), so
+    the results are identical.
+    @param sizes <numpy.ndarray>:
+        Size of each file in bytes
+    @param ages <numpy.ndarray>:
+        Age of each file in days
+    @return age_scores <numpy.ndarray>:
+        Age score of each file
+    """
+    s1 = 0.1    # scaling factor 1
+    s2 = 0.8    # scaling factor 2 
+    age = ages.astype(numpy.float64)
+    score = numpy.ones(len(age))
+    young = ages <= 30*6
+    score[young] = age[young] / (30*6) * s1
+    middle = (ages > 30*6) & (ages <= 30*24)
+    score[middle] = s1 + (age[middle] - (30*6)) / (30*(24-6)) * s2
+    old = (ages > 30*24) & (ages <= 1000)
+    score[old] = s1 + s2 + (age[old] - (30*24)) / (1000-(30*24)) * (1-(s1 + s2))
+    filesize = sizes.astype(numpy.float64)
+    with numpy.errstate(divide = 'ignore', invalid = 'ignore'):
+        return numpy.where(sizes != 0, (filesize * score) / filesize,
+            numpy.where(ages != 0, score / age, 0.0))
+
+
+def chunked(handler, size=8388608, nlines=65536):
+    """Generator that reads text in large blocks of complete lines. File 
+    objects, i.e. standard input, are read in blocks of a given size, and 
+    other iterables of lines are joined in blocks of a given number of lines.
+    @param handler <iter>:
+        File object or iterable of lines
+    @param size <int>:
+        Number of characters in each read of a file object
+    @param nlines <int>:
+        Number of lines in each block of an iterable
+    @yields block <str>:
+        Lines of text, each ending with a newline
+    """
+    if hasattr(handler, 'read'):
+        rest = ''
+        while True:
+            chunk = handler.read(size)
+            if not chunk:
+                if rest:
+                    yield rest + '\n'
+                return
+            chunk = rest + chunk
+            end = chunk.rfind('\n') + 1
+            rest = chunk[end:]
+            if end:
+                yield chunk[:end]
+    handler = iter(handler)
+    while True:
+        lines = list(islice(handler, nlines))
+        if not lines:
+            return
+        block = ''.join(lines)
+        if not block.endswith('\n'):
+            block += '\n'
+        yield block
+
+
+def batched(handler, split=False, size=65536, columns=(2, 4, 9, 7, 8)):
+    """Generator that reads a listing of ls in batches of files. Only the 
+    given columns are kept, each batch is returned as a list per column.
+    Text is split in large blocks rather than line by line, so reading the 
+    listing is not limited by the overhead of each line.
+    @param handler <iter>:
+        A iterable object containing the out from the ls command
+    @param split <bool>:
+        Split iterable contents into a list, set True with standard input
+    @param size <int>:
+        Number of files in a batch
+    @param columns <tuple(int)>:
+        Index of each column to keep, defaults to the owner, size, number of
+        redundant copies, age and path of each file
+    @yields (columns, row) <tuple(list[list], function)>:
+        Values of each column in the batch, and a function returning all 
+        columns of the i-th file of the batch
+    """
+    if split:
+        # Needed when standard input is provided
+        # to parse _ls() input, every line has 
+        # 14 columns, so each block is split in
+        # one call and columns are sliced out 
+        for block in chunked(handler, nlines = size):
+            nrows = block.count('\n')
+            fields = block.replace('\n', '\t').split('\t')
+            if len(fields) == 14 * nrows + 1:
+                yield [fields[c::14] for c in columns], lambda i, fields = fields: fields[i*14:(i+1)*14]
+                continue
+            # Block with a malformed or empty 
+            # line, split it line by line
+            rows = [line.split('\t') for line in block.split('\n')[:-1] if line.strip()]
+            yield [[r[c] for r in rows] for c in columns], rows.__getitem__
+        return
+
+    handler = iter(handler)
+    while True:
+        rows = list(islice(handler, size))
+        if not rows:
+            return
+        yield [[r[c] for r in rows] for c in columns], rows.__getitem__
 
 
 def _df(handler, path, split=False, quota=200):
@@ -397,118 +1407,337 @@ def _df(handler, path, split=False, quota=200):
     @yields df_info <list>:
         0=mount, 1=duplicated, 2=available, 3=%duplicated, 4=score
     """
-    # Calculate a path's age-weighted score.
-    # PathScore is the weighted sum of three
-    # scores pertaining to the average file's 
-    # age and size, the duplication rate of a 
-    # given path, and overall occupancy/footprint
-    # of a path against a defined quota threshold
-    # where PathScore = 100 - (100 * (wAge*AgeScore + wDup*DupScore + wOcc*OccScore))
-    duplicated = 0
-    available = 0
-    score = 0.0
-    # Weights for AgeScore, DupScore, and OccScore
-    # where wAge + wDup + wOcc = 1 
-    wAge = 0.25
-    wDup = 0.45
-    wOcc = 0.35
-    # List to aggregate per file age scores
-    # AgeScore is the average per file age_score
-    age_scores = []
-    age_bytes = []
-    
     # Owner of the provided path
-    owner = _name(os.stat(path).st_uid, 'user')
-    filesize_per_user = dict()
-    filesize_per_user[owner] = 0
+    usage = Usage(names.user(os.stat(path).st_uid))
 
-    for file_listing in handler:
-        # Contents of file listing
-        # 0=inode, 1=permissions, 2=owner,
-        # 3=group, 4=bytes, 5=size, 6=mdate, 7=age,
-        # 8=file, 9=nduplicates, 10=bduplicates,
-        # 11=sduplicates, 12=downers, 13=duplicates
-        if split:
-            # Needed when standard input is provided
-            # to parse _ls() input
-            file_listing = file_listing.strip().split('\t')
-
-        # Caculate size of duplicated diskspace and total diskspace
-        filesize = int(file_listing[4])         # size of file in bytes
-        ncopies  = int(file_listing[9])         # number of redundant copies
-        duplicated += filesize * ncopies        # duplication size of files
-        available += filesize * (ncopies + 1)   # total size of files
-        fowner = file_listing[2]                # file owner
-        if not fowner in filesize_per_user:
-            filesize_per_user[fowner] = 0
-        filesize_per_user[fowner] += filesize * (ncopies + 1)
-
-        # mtime = datetime.datetime.strptime(file_listing[6], '%Y-%m-%d-%H:%M')
-        # age = datetime.datetime.today() - mtime
-        # age = round(age.total_seconds() / 86400.0, 4) # convert seconds to days
-        age = int(float(file_listing[7]))
-        try:
-            age_scores.append((filesize * scored(age)) / (filesize))
-        except ZeroDivisionError:
-            # File size is 0 bytes, add contribution of scaled age
-            age_scores.append(scored(age) / age)
-        
-    # sort list by poweruser
-    filesize_per_user = dict(sorted(filesize_per_user.items(), key=lambda item: item[1], reverse=True))
-    
-    fowner_str_list = []
-    for fowner,fused in filesize_per_user.items():
+    # Contents of file listing
+    # 0=inode, 1=permissions, 2=owner,
+    # 3=group, 4=bytes, 5=size, 6=mdate, 7=age,
+    # 8=file, 9=nduplicates, 10=bduplicates,
+    # 11=sduplicates, 12=downers, 13=duplicates
+    with timed('df.totals'):
+        for (owners, sizes, ncopies, ages, files), row in batched(handler, split):
+            # Caculate size of duplicated diskspace and total diskspace
+            usage.extend(owners, sizes, ncopies, ages)
+            count('df.files', len(files))
+
+    return usage.summary(path, quota)
+
+
+def _rollup(handler, path, depth=1, split=False, quota=200):
+    """Generator for spacesavers df --rollup-depth which reports the disk 
+    space usage of a path and of each of its sub directories down to a given
+    depth from a single listing of ls. Each file is added to the totals of 
+    every directory between the path and the directory of the file, so the 
+    listing is only read once and memory only grows with the number of 
+    directories. Files are attributed to the directory of their master copy,
+    i.e. the File column of ls, as if the listing was filtered by path and 
+    piped into spacesaver df. Directories without any listed files are not
+    reported, except for the path itself.
+    @param handler <iter>:
+        A iterable object containing the out from the ls command,
+        see _df() for more information
+    @param path <str>:
+        Path that was listed by ls
+    @param depth <int>:
+        Maximum depth of the reported sub directories, 0 only reports the path
+    @param split <bool>:
+        Split iterable contents into a list, set True with standard input
+    @param quota <int:
+        Diskspace quota of a given area 
+    @yields df_info <list>:
+        Disk space usage of each directory, see Usage.summary(), parent
+        directories are reported before their sub directories
+    """
+    root = normalized(path)
+    prefix = os.path.join(root, '')
+    # Totals of each directory keyed by
+    # its path relative to root as tuple
+    tree = {(): Usage(names.user(os.stat(path).st_uid))}
+
+    with timed('df.rollup'):
+        for batch, row in batched(handler, split):
+            count('df.files', len(batch[0]))
+            for fowner, filesize, ncopies, age, file in zip(*batch):
+                filesize = int(filesize)         # size of file in bytes
+                ncopies  = int(ncopies)          # number of redundant copies
+                age_score = aged(filesize, int(float(age)))
+
+                # Directories between root and the
+                # file, files outside of root only
+                # count towards the root itself
+                parts = ()
+                if depth > 0 and file.startswith(prefix):
+                    parts = tuple(file[len(prefix):].split(os.sep)[:-1][:depth])
+                for i in range(len(parts) + 1):
+                    key = parts[:i]
+                    try:
+                        usage = tree[key]
+                    except KeyError:
+                        directory = os.path.join(root, *key)
+                        try:
+                            owner = names.user(os.stat(directory).st_uid)
+                        except OSError as e:
+                            # Directory was removed 
+                            # after it was listed
+                            count('warnings')
+                            err('WARNING: Failed to get info on "{}" due to "{}" error!'.format(directory, e))
+                            owner = ''
+                        usage = tree[key] = Usage(owner)
+                    usage.add(filesize, ncopies, fowner, age_score)
+
+    for key in sorted(tree):
+        yield tree[key].summary(os.path.join(path, *key) if key else path, quota)
+
+
+class UserStats(object):
+    """Running totals of the disk space used by each user in a listing of ls,
+    i.e. the size of the files they own or co-own through a duplicate, and the
+    number and size of their files by age. Each duplicate of a file counts 
+    towards the owner of the duplicate, see the DOwners column of ls. Only 
+    the totals of each user and age are kept in memory.
+    """
+    def __init__(self):
+        self.owners = {}      # owners in order of their first file
+        self.others = {}      # owners of duplicates only
+        self.total = {}       # {user: bytes, ...}
+        self.duplicated = {}  # {user: bytes, ...}
+        self.ages = {}        # {user: {age: [count, bytes], ...}, ...}
+
+    def _add(self, user, age, nfiles, nbytes, duplicate):
+        # Adds files of a user and
+        # age to the running totals
+        self.total[user] = self.total.get(user, 0) + nbytes
+        if duplicate:
+            self.duplicated[user] = self.duplicated.get(user, 0) + nbytes
         try:
-            frac = fused / float(available)
-        except ZeroDivisionError:
-            frac = 0
-        fowner_str_list.append("{0}[{1}%]".format(fowner,round(frac * 100, 1)))
+            counts = self.ages[user][age]
+            counts[0] += nfiles
+            counts[1] += nbytes
+        except KeyError:
+            self.ages.setdefault(user, {})[age] = [nfiles, nbytes]
+
+    def extend(self, owners, sizes, ages, bduplicates, downers):
+        """Adds a batch of files of a listing of ls to the totals. Empty files 
+        are skipped. The batch is vectorized with NumPy if it is installed.
+        @param owners <list[str]>:
+            Owner of each file
+        @param sizes <list[int|str]>:
+            Size of each file in bytes
+        @param ages <list[int|str]>:
+            Age of each file in days
+        @param bduplicates <list[int|str]>:
+            Size of the redundant copies of each file in bytes
+        @param downers <list[str]>:
+            Pipe separated owners of the redundant copies of each file
+        """
+        if numpy is None:
+            for fowner, filesize, age, bdup, downer in zip(owners, sizes, ages, bduplicates, downers):
+                filesize = int(filesize)
+                if filesize <= 0:
+                    continue
+                age = int(float(age))
+                self.owners.setdefault(fowner)
+                self._add(fowner, age, 1, filesize, False)
+                if int(bdup) != 0 and downer:
+                    for user in downer.split('|'):
+                        self.others.setdefault(user)
+                        self._add(user, age, 1, filesize, True)
+            return
+
+        sizes = vectorized(sizes, numpy.int64, int)
+        ages = vectorized(ages, numpy.float64, float).astype(numpy.int64)
+        bduplicates = vectorized(bduplicates, numpy.int64, int)
+        kept = sizes > 0
+        users = [fowner for fowner, keep in zip(owners, kept.tolist()) if keep]
+        nowned = len(users)
+        self.owners.update(dict.fromkeys(users))
+        # Explode the owners of the 
+        # duplicates of each file
+        duplicates = numpy.flatnonzero(kept & (bduplicates != 0))
+        nowners = []
+        for i in duplicates.tolist():
+            exploded = downers[i].split('|') if downers[i] else []
+            users.extend(exploded)
+            nowners.append(len(exploded))
+        self.others.update(dict.fromkeys(users[nowned:]))
+        sizes = numpy.concatenate((sizes[kept], numpy.repeat(sizes[duplicates], nowners)))
+        ages = numpy.concatenate((ages[kept], numpy.repeat(ages[duplicates], nowners)))
+        if not len(sizes):
+            return
+
+        # Group by user and age
+        codes = {}
+        coded = numpy.array([codes.setdefault(user, len(codes)) for user in users], dtype = numpy.int64)
+        names = list(codes)
+        youngest = int(ages.min())
+        span = int(ages.max()) - youngest + 1
+        keys, inverse = numpy.unique(coded * span + (ages - youngest), return_inverse = True)
+        inverse = inverse.ravel()
+        counts = numpy.bincount(inverse, minlength = len(keys))
+        nbytes = numpy.zeros(len(keys), dtype = numpy.int64)
+        numpy.add.at(nbytes, inverse, sizes)
+        duplicated = numpy.zeros(len(codes), dtype = numpy.int64)
+        numpy.add.at(duplicated, coded[nowned:], sizes[nowned:])
+        for key, nfiles, size in zip(keys.tolist(), counts.tolist(), nbytes.tolist()):
+            code, age = divmod(key, span)
+            self._add(names[code], age + youngest, nfiles, size, False)
+        for code in numpy.flatnonzero(duplicated).tolist():
+            user = names[code]
+            self.duplicated[user] = self.duplicated.get(user, 0) + int(duplicated[code])
+
+    def users(self):
+        """Returns each user in order of their first file, followed by the 
+        users that only own duplicates.
+        @return users <list[str]>:
+            Names of each user
+        """
+        return list(self.owners) + [user for user in self.others if user not in self.owners]
+
+    def totals(self):
+        """Generator of the total and duplicated size of each user, sorted by
+        total size in ascending order.
+        @yields (user, total, duplicated) <tuple(str, int, int)>:
+            Name of the user, and the size of their files and duplicates
+        """
+        users = sorted(self.users(), key = lambda user: self.total[user])
+        for user in users:
+            yield user, self.total[user], self.duplicated.get(user, 0)
+
+    def distribution(self):
+        """Generator of the number and size of the files of each user by age,
+        from 0 days to the age of their oldest file.
+        @yields (user, age, count, bytes) <tuple(str, int, int, int)>:
+            Name of the user, age in days, and the number and size of their
+            files of that age
+        """
+        for user in self.users():
+            ages = self.ages[user]
+            for age in range(0, max(ages) + 1):
+                count, nbytes = ages.get(age, (0, 0))
+                yield user, age, count, nbytes
+
+
+def _users(handler, stats, split=False, large=104857600):
+    """Generator for spacesavers users which reads a listing of ls in batches
+    to calculate the disk space used by each user, see UserStats. Files with
+    large duplicates are yielded while the listing is read.
+    @param handler <iter>:
+        A iterable object containing the out from the ls command,
+        see _df() for more information
+    @param stats <UserStats>:
+        Running totals of each user, updated with each batch of files
+    @param split <bool>:
+        Split iterable contents into a list, set True with standard input
+    @param large <int>:
+        Minimum size of the duplicates of a file to yield it, exclusive
+    @yields (index, file_listing) <tuple(int, list)>:
+        Position of the file in the listing, and its columns
+    """
+    index = 0
+    # Contents of file listing
+    # 2=owner, 4=bytes, 7=age,
+    # 10=bduplicates, 12=downers
+    for columns, row in batched(handler, split, columns = (2, 4, 7, 10, 12)):
+        stats.extend(*columns)
+        owners, sizes, ages, bduplicates, downers = columns
+        for i, bdup in enumerate(bduplicates):
+            if int(bdup) > large and int(sizes[i]) > 0:
+                yield index + i, row(i)
+        index += len(sizes)
 
-    # create string for pipe separated file owners in the folder
-    fowner_str = "|".join(fowner_str_list)
 
-    # Age Score is the average age score of all files,
-    # where age is scaled via the scored() function.
-    # AgeScore = sum(bytesPerFiles * scored(ageScorePerFile)) / len(Nfiles)
+def listings(filename):
+    """Generator to read the listing of spacesaver ls from a file, so files are
+    not listed and hashed again. The listing can be tab separated text, gzip
+    compressed if it ends with '.gz', a columnar listing, or a partial index
+    written by ls --emit-index. The files of a partial index are grouped into
+    duplicates like spacesaver merge, re-using their mini and full hashes.
+    @param filename <str>:
+        Path to the listing or partial index
+    @yields file_info <list>:
+        Same columns as _ls(), integer columns of a columnar listing are ints
+    """
     try:
-        AgeScore = sum(age_scores) / len(age_scores) 
-    except ZeroDivisionError:
-        # Edge case where there are no files in a directory.
-        # Meaning, the directory is empty or only contains 
-        # symlinks.
-        return [path, readable_size(duplicated), str(duplicated),  readable_size(available), str(available), '0.0%', '0.0', '0.0', '0.0', '100.0']
+        header(filename)
+    except ValueError:
+        pass   # not a partial index
+    else:
+        for file_info in _merge([filename]):
+            yield file_info
+        return
 
-    # DupScore = DuplicatedBytes / TotalBytes
+    if is_columnar_file(filename):
+        with open(filename, 'rb') as fh:
+            info = read_header(fh)
+            if info['kind'] != 'ls':
+                raise ValueError('"{}" is not a listing of spacesaver ls'.format(filename))
+            for row in read_rows(fh, info):
+                yield row
+        return
+
+    with opened(filename, 'rt') as fh:
+        if next(fh, '').split('\t', 1)[0] != 'Inode':
+            raise ValueError('"{}" is not a listing of spacesaver ls'.format(filename))
+        for line in fh:
+            yield line.rstrip('\n').split('\t')
+
+
+def located(filename):
+    """Looks up the stat records of files in a partial index written by 
+    ls --emit-index, so files can be re-validated exactly. Files are looked
+    up in order of their size, like the listing of spacesaver merge, so the
+    index is read once and only files of one size are kept in memory.
+    @param filename <str>:
+        Path to a listing or partial index
+    @return lookup <function>:
+        Gets the stat records of the files of a size, {path: Record}, sizes
+        must not decrease between calls, or None if the file is not a partial
+        index
+    """
     try:
-        DupScore = duplicated / float(available)   # 0 indicates no duplicated files 
-    except ZeroDivisionError:
-        # Edge case where a directory is composed of a
-        # set of empty files. Meaning, all the encountered
-        # files are 0 bytes in size. Penalize with the worst
-        # DupScore, so it gets flagged for deletion later.
-        DupScore = 1.0
+        header(filename)
+    except ValueError:
+        return None   # not a partial index
+    files = indexed(filename)
+    current = [None, {}, next(files, None)]   # size, its records, next file
+
+    def lookup(size):
+        if size == current[0]:
+            return current[1]
+        records, entry = {}, current[2]
+        while entry is not None and entry[1].size <= size:
+            if entry[1].size == size:
+                records[entry[0]] = entry[1]
+            entry = next(files, None)
+        current[:] = [size, records, entry]
+        return records
+    return lookup
 
-    percent_duplicates = "{}%".format(round(DupScore * 100, 3))
-    
-    # OccScore = totalBytes / (0.05 * quota) if totalBytes is less than 5% of 
-    # quota. If a directory is greater than 5% of the quota, DupScore gets the
-    # worst possible score.
-    OccScore = 1.0
-    quota_bytes = quota * (2**40) # convert TiB to bytes
-    if float(available) <= (0.05*float(quota_bytes)):
-        OccScore = float(available) / (0.05 * quota_bytes)
-    
-    # Calculate the final weighted score of a path
-    Score = str(round(100 - (100 * ((wAge*AgeScore) + (wDup*DupScore) + (wOcc*OccScore))), 1))
-    # Calculate the individual weighted components
-    AgeC = str(round(100 * (wAge*AgeScore), 1))
-    DupC = str(round(100 * (wDup*DupScore), 1))
-    OccC = str(round(100 * (wOcc*OccScore), 1))
 
-    return [path, owner, fowner_str, readable_size(duplicated), str(duplicated), readable_size(available), str(available), percent_duplicates, AgeC, DupC, OccC, Score]
+def scanned(filename):
+    """Gets the start of the scan of a listing of spacesaver ls, so files that
+    were modified after it are not trusted. Partial indexes and columnar
+    listings record it. Tab separated listings do not, their files are only
+    checked against their listed modification date, see relinked().
+    @param filename <str>:
+        Path to the listing or partial index
+    @return scanned <int>:
+        Nanoseconds since the epoch, or None if it is unknown
+    """
+    try:
+        return header(filename).get('scanned')
+    except ValueError:
+        pass   # not a partial index
+    if is_columnar_file(filename):
+        with open(filename, 'rb') as fh:
+            meta = read_header(fh)['meta']
+        if 'scanned' in meta:
+            return int(meta['scanned'])
+    return None
 
 
-def _ln(path, minimum_size=10485760):
+def _ln(path, minimum_size=10485760, listing=None):
     """Generator for spacesavers ln which recursively replaces
     duplicated files with hardlink in a given path.
     Any symbolic links or multiple references to the same inode, 
@@ -524,8 +1753,12 @@ def _ln(path, minimum_size=10485760):
         be passed over, helps reduce the chance of unintentionally
         introducing an alias effect with small files. This option
         can be overridden through a command-line option.
+    @param listing <iter>:
+        Optional listing of a previous ls, see listings(), instead of
+        listing path again, only files within path are yielded
     @yields ln_info <list>:
-        0=target, 1=newlink
+        0=target, 1=newlink, 2=listed inode of target or None, 3=bytes,
+        4=listed modification date of target or None
     """
     # Finds duplicated files and a create a hard link 
     # if the user running the script has at least two 
@@ -535,29 +1768,33 @@ def _ln(path, minimum_size=10485760):
     # will only be created from duplicated files the user
     # owns! This reduces the chance of introducing any
     # undesired results.
-    for file_listing in _ls(path):
+    # Get username of user running the script
+    # to compare against the owner of the old 
+    # copy of the file (master copy)
+    user = str(names.user(os.getuid()))
+    root = os.path.join(normalized(path), '')
+    if listing is None:
+        listing = _ls(path)
+    for file_listing in listing:
         # Contents of file listing
         # 0=inode, 1=permissions, 2=owner,
         # 3=group, 4=bytes, 5=size, 6=mdate, 
-        # 7=file, 8=nduplicates, 9=bduplicates,
-        # 10=sduplicates, 11=downers, 12=duplicates
+        # 7=age, 8=file, 9=nduplicates,
+        # 10=bduplicates, 11=sduplicates, 
+        # 12=downers, 13=duplicates
         
         # Check for duplicated files and see if file
         # meets threshold for minimum size
-        nduplicates = int(file_listing[8])
+        nduplicates = int(file_listing[9])
         fsize = int(file_listing[4])
         if nduplicates == 0 or fsize <= minimum_size:
             # File is unique or does not meet minimum size
             # goto next file listing
             continue
 
-        # Get username of user running the script
-        # to compare against the owner of the old 
-        # copy of the file (master copy)
-        user = str(_name(os.getuid(), 'user'))
         owner = str(file_listing[2])
-        dup_owners = str(file_listing[11]).split('|')
-        dup_files = str(file_listing[12]).split('|')
+        dup_owners = str(file_listing[12]).split('|')
+        dup_files = str(file_listing[13]).split('|')
 
         # Safety measure: skip over processes run
         # as root or duplicate files owned by root
@@ -568,18 +1805,21 @@ def _ln(path, minimum_size=10485760):
         # files owned by root to help sanitize
         # any erroneous user input. This will
         # also filter any files from the dup
-        # list that we do not own! Remember 
+        # list that we do not own, or that are
+        # outside of the given path! Remember 
         # we only want to create hard links
         # from files we actually own.
-        for i in range(len(dup_owners)):
-            if str(dup_owners[i]) != user:
-                rm = dup_owners[i].pop(i)
-                rm = dup_files[i].pop(i)
+        dup_files = [
+            f for f, o in zip(dup_files, dup_owners) 
+            if o == user and f.startswith(root)
+        ]
         
         # Oldest duplicate file from which
         # the other hard links will be
         # created from.
-        mastercopy = str(file_listing[7])
+        mastercopy = str(file_listing[8])
+        inode = int(file_listing[0])
+        mdate = str(file_listing[6])
         # Index of where to start finding
         # duplicate files. The index is set
         # to 1 when the user running the script
@@ -587,7 +1827,7 @@ def _ln(path, minimum_size=10485760):
         # the user owns at least two of the
         # duplicates. 
         dindex = 0
-        if user != owner:
+        if user != owner or not mastercopy.startswith(root):
             if len(dup_files) < 2:
                 # User only own one of the
                 # duplicated files, a user
@@ -600,10 +1840,158 @@ def _ln(path, minimum_size=10485760):
             # oldest file that is owned 
             # by the user.
             mastercopy = str(dup_files[0])
+            inode = mdate = None   # not listed
             dindex = 1   # reset duplicate index
         
         for dup in dup_files[dindex:]:
-            yield [mastercopy, dup]
+            yield [mastercopy, dup, inode, fsize, mdate]
+
+
+def relinked(mastercopy, duplicates, size, inode=None, mdate=None, records=None, since=None, offsets=None):
+    """Replaces duplicates of a master copy with hard links. Files are cheaply
+    re-validated before they are touched, as they may have changed since they
+    were listed: the master copy and each duplicate must still be a regular
+    file of the listed size on the same device, owned by the user running the
+    script, and not modified after the listing was scanned. The master copy
+    must still have its listed inode and modification date (to the minute).
+    Given the stat records of a partial index, the inode and modification
+    time (ns) of each file must match exactly. Optionally, a quick fingerprint of a few blocks of each
+    duplicate must match the master copy. Duplicates that are already hard
+    links of the master copy are skipped over.
+    @param mastercopy <str>:
+        Oldest file of a set of duplicates, hard links are created from it
+    @param duplicates list[<str>]:
+        Duplicates of the master copy to replace with hard links
+    @param size <int>:
+        Listed size of the files in bytes
+    @param inode <int>:
+        Listed inode of the master copy, or None
+    @param mdate <str>:
+        Listed modification date of the master copy as YYYY-MM-DD-HH:MM, or None
+    @param records <dict>:
+        Optional stat records of files listed in a partial index, {path: Record}
+    @param since <int>:
+        Start of the scan of the listing in nanoseconds since the epoch, files
+        modified after it are skipped over, see scanned()
+    @param offsets list[<int>]:
+        Offsets of the blocks of the quick fingerprint, None skips it
+    @return nlinked <int>:
+        Number of duplicates replaced with hard links
+    """
+    uid = os.getuid()
+
+    def changed(file, stat_res, listed_inode = None, listed_mdate = None):
+        # Reason a file cannot be linked, 
+        # or None if it is unchanged
+        if not stat.S_ISREG(stat_res.st_mode):
+            return 'is not a regular file'
+        if stat_res.st_uid != uid:
+            return 'is not owned by the user'
+        if stat_res.st_size != size:
+            return 'changed size since it was listed'
+        if listed_inode is not None and stat_res.st_ino != listed_inode:
+            return 'changed inode since it was listed'
+        if listed_mdate is not None and timestamps.formatted(stat_res.st_mtime_ns)[0] != listed_mdate:
+            return 'was modified after it was listed'
+        record = (records or {}).get(file)
+        if record is not None and (stat_res.st_ino, stat_res.st_mtime_ns) != (record.ino, record.mtime_ns):
+            return 'changed since it was listed'
+        if since is not None and stat_res.st_mtime_ns > since:
+            return 'was modified after it was listed'
+        return None
+
+    def skipped(file, reason):
+        count('ln.skipped')
+        count('warnings')
+        err('WARNING: Skipping "{}" as it {}!'.format(file, reason))
+
+    try:
+        count('stat_calls')
+        master = os.lstat(mastercopy)
+    except OSError as e:
+        count('warnings')
+        err('WARNING: Failed to get info on "{}" due to "{}" error!'.format(mastercopy, e))
+        return 0
+    reason = changed(mastercopy, master, inode, mdate)
+    if reason is not None:
+        skipped(mastercopy, reason)
+        return 0
+
+    nlinked = 0
+    fingerprint = None
+    for duplicate in duplicates:
+        try:
+            count('stat_calls')
+            dup = os.lstat(duplicate)
+        except OSError as e:
+            count('warnings')
+            err('WARNING: Failed to get info on "{}" due to "{}" error!'.format(duplicate, e))
+            continue
+        if (dup.st_dev, dup.st_ino) == (master.st_dev, master.st_ino):
+            count('ln.already_linked')
+            continue   # already a hard link
+        reason = changed(duplicate, dup)
+        if reason is None and dup.st_dev != master.st_dev:
+            reason = 'is on another device'
+        if reason is None and offsets is not None:
+            try:
+                if fingerprint is None:
+                    fingerprint = sampled(mastercopy, offsets)
+                if sampled(duplicate, offsets) != fingerprint:
+                    reason = 'changed contents since it was listed'
+            except OSError as e:
+                count('warnings')
+                err('WARNING: Failed to get info on "{}" due to "{}" error!'.format(duplicate, e))
+                continue
+        if reason is not None:
+            skipped(duplicate, reason)
+            continue
+
+        # Keeps track of the status of linking
+        # step in the deduplication process.
+        renamed = linked = False
+        dup_tmp = "{}.spacesaver_ln.{}".format(duplicate, uuid.uuid4())
+        try:
+            # Rename the dest of the symlink, i.e. 
+            # the duplicate file prior to creating
+            # the hard link. This enables a quick
+            # restoring method if an error occurs
+            # and avoids filename collisions.
+            # Example: a.dup.txt -> a.dup.txt.spacesaver_ln.12abc34-ae42nnn
+            os.rename(duplicate, dup_tmp)
+            renamed = True
+            # Create a hardlink from the master
+            # copy with the original file name 
+            # of the duplicate file, it is now 
+            # possible after renaming the dup
+            # file as there are no collisions
+            # between the originial duplicate
+            # filename and the destination
+            # of the hard link.
+            os.link(mastercopy, duplicate)
+            linked = True
+            # Delete the tmp renamed duplicate 
+            # file, the newly created hard link
+            # replaces this file. 
+            os.remove(dup_tmp)
+            count('ln.linked')
+            nlinked += 1
+        except Exception as e:
+            # Restore the originial duplicated file
+            # from the renamed tmp duplicate file, i.e. 
+            # Example: a.dup.txt.spacesaver_ln.12abc34-ae42nnn -> a.dup.txt
+            if renamed:
+                if linked:
+                    # Remove hard link from master copy 
+                    os.unlink(duplicate)
+                # Restore the original duplicate file 
+                # to its originial state.
+                os.rename(dup_tmp, duplicate)
+            count('warnings')
+            err('WARNING: Failed to create hard link "{} -> {}" due to "{}" error!'.format(
+                duplicate, mastercopy, e))
+
+    return nlinked
 
 
 if __name__ == '__main__':
@@ -0,0 +1,364 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+# Python standard library
+from __future__ import print_function
+from collections import namedtuple
+from array import array
+import os
+
+# Local imports
+from utils import opened
+from spill import SpillingGroups
+from columnar import ColumnarWriter, is_columnar_file, read_header, read_rows
+
+
+# Stat record of a file, each file is only stat-ed
+# once while traversing the directory tree and this
+# record is carried through every stage of ls.
+Record = namedtuple('Record', ['ino', 'dev', 'size', 'mtime_ns', 'uid', 'gid', 'mode'])
+
+
+class FileIndex(object):
+    """Compact in-memory index of the files encountered while traversing a
+    directory tree. Each file is referred to by an integer file id. Instead of
+    storing a python string per absolute path and a python object per stat
+    record, paths are split into a table of directories and a packed buffer of
+    encoded basenames, and each field of a stat record is stored in its own
+    array-backed column. For trees with tens of millions of files, this uses a
+    fraction of the memory of lists of paths and stat records.
+    """
+    def __init__(self):
+        # Table of directories, each file
+        # refers to its parent directory id
+        self.dirs = []      # [pdir0, pdir1, ...]
+        self._dir_ids = {}  # {pdir: id, ...}
+        self.parents = array('q')
+        # Encoded basenames are packed into one
+        # buffer, offsets[fid] is the start of a
+        # file's name and offsets[fid+1] its end
+        self.names = bytearray()
+        self.offsets = array('Q', [0])
+        # Columns of each file's stat record
+        self.inodes = array('Q')
+        self.devices = array('Q')
+        self.sizes = array('q')
+        self.mtimes = array('q')
+        self.uids = array('I')
+        self.gids = array('I')
+        self.modes = array('I')
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def add(self, file, record):
+        """Adds a file and its stat record to the index.
+        @param file <str>:
+            Absolute path of the file
+        @param record <Record>:
+            Stat record of the file
+        @return fid <int>:
+            File id of the file in the index
+        """
+        pdir, _, basename = file.rpartition(os.sep)
+        pdir = pdir or os.sep   # file in root directory
+        try:
+            pid = self._dir_ids[pdir]
+        except KeyError:
+            pid = self._dir_ids[pdir] = len(self.dirs)
+            self.dirs.append(pdir)
+        fid = len(self.sizes)
+        self.parents.append(pid)
+        self.names += os.fsencode(basename)
+        self.offsets.append(len(self.names))
+        self.inodes.append(record.ino)
+        self.devices.append(record.dev)
+        self.sizes.append(record.size)
+        self.mtimes.append(record.mtime_ns)
+        self.uids.append(record.uid)
+        self.gids.append(record.gid)
+        self.modes.append(record.mode)
+
+        return fid
+
+    def path(self, fid):
+        """Gets the absolute path of a file.
+        @param fid <int>:
+            File id of the file in the index
+        @return file <str>:
+            Absolute path of the file
+        """
+        basename = os.fsdecode(bytes(self.names[self.offsets[fid]:self.offsets[fid+1]]))
+        return os.path.join(self.dirs[self.parents[fid]], basename)
+
+    def record(self, fid):
+        """Gets the stat record of a file.
+        @param fid <int>:
+            File id of the file in the index
+        @return record <Record>:
+            Stat record of the file
+        """
+        return Record(self.inodes[fid], self.devices[fid], self.sizes[fid],
+            self.mtimes[fid], self.uids[fid], self.gids[fid], self.modes[fid])
+
+
+class SizeSketch(object):
+    """Count-min sketch of file sizes. Each size is counted in one array-backed
+    row of counters per hash function, and the count of a size is the minimum
+    of its counters. Counts are never under-estimated, so a size with a count
+    of one is guaranteed to be unique. Collisions can only over-estimate the
+    count of a size. Counters saturate at 'limit' to fit in one byte each. By
+    default, the sketch uses 64 MiB and about 3% of 10 million unique sizes 
+    are over-counted.
+    @param width <int>:
+        Number of counters in each row, rounded up to a power of 2
+    @param depth <int>:
+        Number of rows, i.e. hash functions
+    @param limit <int>:
+        Maximum value of each counter
+    """
+    # Odd 64-bit multipliers for multiply-shift hashing
+    multipliers = (
+        0x9E3779B97F4A7C15, 0xC2B2AE3D27D4EB4F, 
+        0x165667B19E3779F9, 0xD6E8FEB86659FD93,
+        0xFF51AFD7ED558CCD, 0xC4CEB9FE1A85EC53,
+    )
+
+    def __init__(self, width = 1 << 24, depth = 4, limit = 2):
+        if not 0 < depth <= len(self.multipliers):
+            raise ValueError('depth must be between 1 and {}'.format(len(self.multipliers)))
+        self.bits = max(int(width - 1).bit_length(), 1)
+        self.width = 1 << self.bits
+        self.depth = depth
+        self.limit = limit
+        self.rows = [array('B', bytes(self.width)) for i in range(depth)]
+
+    def _slots(self, size):
+        # Top bits of each product are 
+        # the slot of a size in each row
+        shift = 64 - self.bits
+        return [((size * m) & 0xFFFFFFFFFFFFFFFF) >> shift for m in self.multipliers[:self.depth]]
+
+    def add(self, size):
+        """Counts one file of a given size.
+        @param size <int>:
+            Size of the file in bytes
+        """
+        for row, slot in zip(self.rows, self._slots(size)):
+            if row[slot] < self.limit:
+                row[slot] += 1
+
+    def count(self, size):
+        """Gets the estimated number of files of a given size.
+        @param size <int>:
+            Size of a file in bytes
+        @return n <int>:
+            Estimated number of files, at most 'limit'
+        """
+        return min(row[slot] for row, slot in zip(self.rows, self._slots(size)))
+
+
+# Columns of a partial index written by ls
+# --emit-index, digests are hex encoded and
+# left empty if a shard never calculated them,
+# files with the same DupGroup are duplicates
+# found by the shard, and a DupGroup of 0 is a
+# file without duplicates in the shard
+INDEX_COLUMNS = ['Size', 'Device', 'Inode', 'MTimeNs', 'Uid', 'Gid', 'Mode', 'HeadHash', 'FullHash', 'DupGroup', 'File']
+# Types of each column in a columnar index, 
+# digests are stored as raw bytes
+INDEX_TYPES = ['uint', 'uint', 'uint', 'int', 'uint', 'uint', 'uint', 'bytes', 'bytes', 'uint', 'str']
+# Default number of bytes of entries an index
+# keeps in memory before spilling them to disk
+INDEX_MEMORY = 268435456
+
+
+class IndexWriter(object):
+    """Writes a partial index of the files listed by ls, i.e. a shard of a
+    larger scan. Each file is written with its stat record, and the checksum
+    of its first block (mini hash) and of the entire file (full hash), if the
+    shard calculated them, and the group of duplicates it belongs to within
+    the shard. Every file listed by ls is resolved by the shard, whether it 
+    was compared by its checksums or byte by byte, or pruned by any of its
+    fingerprints, so the groups are re-used by spacesaver merge instead of 
+    hashing the files again. Files are sorted by size, so many partial indexes
+    can be combined with a streaming k-way merge by spacesaver merge. The 
+    first line records the hashing algorithm and block size of the digests. 
+    Indexes ending with '.gz' are gzip compressed. Columnar indexes are stored
+    as a binary table with typed columns, see columnar.ColumnarWriter.
+    @param filename <str>:
+        Path of the partial index to write
+    @param algorithm <str>:
+        Hashing algorithm of the digests, see utils.hashers
+    @param blocksize <int>:
+        Size of the first block of a file in bytes
+    @param max_memory <int>:
+        Approximate number of bytes to keep in memory before spilling to disk,
+        defaults to INDEX_MEMORY
+    @param format <str>:
+        Format of the partial index, i.e. tsv or columnar
+    @param scanned <int>:
+        Start of the scan in nanoseconds since the epoch, if it is known
+    """
+    def __init__(self, filename, algorithm = 'md5', blocksize = 65536, max_memory = None, format = 'tsv', scanned = None):
+        self.filename = filename
+        self.algorithm = algorithm
+        self.blocksize = blocksize
+        self.format = format
+        self.scanned = scanned
+        self.entries = SpillingGroups(max_memory or INDEX_MEMORY)
+
+    def add(self, file, record, head = None, full = None, dup_group = 0):
+        """Adds a file to the partial index.
+        @param file <str>:
+            Absolute path of the file
+        @param record <Record>:
+            Stat record of the file
+        @param head <bytes>:
+            Checksum of the first block of the file, if it was calculated
+        @param full <bytes>:
+            Checksum of the entire file, if it was calculated
+        @param dup_group <int>:
+            Id of the group of duplicates of the file in the shard, or 0 if
+            the file has no duplicates in the shard
+        """
+        self.entries.add(record.size, (file, tuple(record), head, full, dup_group))
+
+    def close(self):
+        """Writes the partial index sorted by file size."""
+        if self.format == 'columnar':
+            with open(self.filename, 'wb') as fh:
+                meta = {'version': '2', 'algorithm': self.algorithm, 'blocksize': self.blocksize}
+                if self.scanned is not None:
+                    meta['scanned'] = self.scanned
+                table = ColumnarWriter(fh, 'index', zip(INDEX_COLUMNS, INDEX_TYPES), meta)
+                for size, entries in self.entries.sorted_items():
+                    for file, fields, head, full, dup_group in entries:
+                        record = Record(*fields)
+                        table.add([record.size, record.dev, record.ino, record.mtime_ns, 
+                            record.uid, record.gid, record.mode, head, full, dup_group, file])
+                table.close()
+            self.entries.close()
+            return
+        with opened(self.filename, 'wt') as fh:
+            fh.write(banner(self.algorithm, self.blocksize, self.scanned))
+            for size, entries in self.entries.sorted_items():
+                for file, fields, head, full, dup_group in entries:
+                    fh.write(formatted(file, Record(*fields), head, full, dup_group))
+        self.entries.close()
+
+
+def banner(algorithm, blocksize, scanned = None):
+    """Formats the first two lines of a partial index in TSV format, i.e. its
+    header and its column names.
+    @param algorithm <str>:
+        Hashing algorithm of the digests
+    @param blocksize <int>:
+        Size of the first block of a file in bytes
+    @param scanned <int>:
+        Start of the scan in nanoseconds since the epoch, or None if it is unknown
+    @return lines <str>:
+        Header and column names of the partial index
+    """
+    started = '\tscanned={}'.format(scanned) if scanned is not None else ''
+    return '#spacesaver-index\tversion=2\talgorithm={}\tblocksize={}{}\n{}\n'.format(
+        algorithm, blocksize, started, '\t'.join(INDEX_COLUMNS))
+
+
+def formatted(file, record, head, full, dup_group):
+    """Formats a file of a partial index as a line in TSV format.
+    @param file <str>:
+        Absolute path of the file
+    @param record <Record>:
+        Stat record of the file
+    @param head <bytes>:
+        Checksum of the first block of the file or None
+    @param full <bytes>:
+        Checksum of the entire file or None
+    @param dup_group <int>:
+        Id of the group of duplicates of the file in its shard, 0 if it has 
+        none, or None if the shard did not record it, i.e. an index of version 1
+    @return line <str>:
+        Tab separated columns of the file, see INDEX_COLUMNS
+    """
+    return '{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\n'.format(
+        record.size, record.dev, record.ino, record.mtime_ns, 
+        record.uid, record.gid, record.mode, 
+        head.hex() if head is not None else '', 
+        full.hex() if full is not None else '', 
+        dup_group if dup_group is not None else '', file)
+
+
+def header(filename):
+    """Reads the header of a partial index written by IndexWriter.
+    @param filename <str>:
+        Path of the partial index
+    @return info <dict>:
+        Version, hashing algorithm, block size, and start of the scan of the 
+        partial index, if it was recorded
+    """
+    if is_columnar_file(filename):
+        with open(filename, 'rb') as fh:
+            info = read_header(fh)
+        if info['kind'] != 'index':
+            raise ValueError('"{}" is not a partial index written by spacesaver ls --emit-index'.format(filename))
+        info = dict(info['meta'])
+        info['blocksize'] = int(info['blocksize'])
+        if 'scanned' in info:
+            info['scanned'] = int(info['scanned'])
+        return info
+    with opened(filename, 'rt') as fh:
+        line = fh.readline().rstrip('\n').split('\t')
+    if line[0] != '#spacesaver-index':
+        raise ValueError('"{}" is not a partial index written by spacesaver ls --emit-index'.format(filename))
+    info = dict(field.split('=', 1) for field in line[1:])
+    info['blocksize'] = int(info['blocksize'])
+    if 'scanned' in info:
+        info['scanned'] = int(info['scanned'])
+    return info
+
+
+def started(filenames):
+    """Gets the start of the earliest scan of many partial indexes.
+    @param filenames list[<str>]:
+        Paths of the partial indexes
+    @return scanned <int>:
+        Nanoseconds since the epoch, or None if an index did not record it
+    """
+    scans = [header(filename).get('scanned') for filename in filenames]
+    if not scans or None in scans:
+        return None
+    return min(scans)
+
+
+def indexed(filename):
+    """Generator to read the files of a partial index in order of their size.
+    Indexes of version 1 did not record the groups of duplicates of a shard,
+    their files are read with a group of None.
+    @param filename <str>:
+        Path of the partial index
+    @yields (file, record, head, full, dup_group) <tuple(str, Record, bytes, bytes, int)>:
+        Absolute path, stat record, checksums of a file or None, and the id
+        of its group of duplicates in the shard or None
+    """
+    if is_columnar_file(filename):
+        with open(filename, 'rb') as fh:
+            info = read_header(fh)
+            grouped = 'DupGroup' in (name for name, kind in info['columns'])
+            for row in read_rows(fh, info):
+                size, dev, ino, mtime_ns, uid, gid, mode, head, full = row[:9]
+                dup_group = row[9] if grouped else None
+                yield row[-1], Record(ino, dev, size, mtime_ns, uid, gid, mode), head, full, dup_group
+        return
+    with opened(filename, 'rt') as fh:
+        next(fh)  # header
+        columns = next(fh).rstrip('\n').split('\t')
+        grouped = 'DupGroup' in columns
+        for line in fh:
+            fields = line.rstrip('\n').split('\t', len(columns) - 1)
+            size, dev, ino, mtime_ns, uid, gid, mode = [int(v) for v in fields[:7]]
+            record = Record(ino, dev, size, mtime_ns, uid, gid, mode)
+            head = bytes.fromhex(fields[7]) if fields[7] else None
+            full = bytes.fromhex(fields[8]) if fields[8] else None
+            dup_group = int(fields[9]) if grouped and fields[9] else None
+            yield fields[-1], record, head, full, dup_group
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+# Python standard library
+from __future__ import print_function
+import io, sys, gzip, datetime
+
+# Naive local datetimes are converted into
+# integer microseconds since this epoch
+EPOCH = datetime.datetime(1970, 1, 1)
+_DAY = 86400000000           # microseconds in a day
+_TIE = _DAY // 20000         # half of 1e-4 days in microseconds
+_MINUTE = 60000000000        # nanoseconds in a minute
+
+
+def microseconds(dt):
+    """Converts a naive datetime into integer microseconds since the epoch.
+    @param dt <datetime.datetime>:
+        Naive datetime, i.e. local wall clock time
+    @return us <int>:
+        Microseconds since the epoch
+    """
+    delta = dt - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def elapsed_days(mdate, now):
+    """Calculates the age of a file in days, rounded up, from its modification
+    date truncated to the minute. The result is identical to rounding the
+    number of elapsed days to four decimals and taking its ceiling.
+    @param mdate <datetime.datetime>:
+        Modification date of the file, truncated to the minute
+    @param now <datetime.datetime>:
+        Current date and time
+    @return age <int>:
+        Age of the file in days
+    """
+    days, rem = divmod(microseconds(now) - microseconds(mdate), _DAY)
+    if abs(rem - _TIE) <= 1:
+        # Ties of round() depend on the
+        # float representation of the
+        # elapsed days, defer to it
+        age = (now - mdate).total_seconds() / 86400.0
+        return int(-(-round(age, 4) // 1))
+    return days + (rem > _TIE)
+
+
+class Timestamps(object):
+    """Formats the modification date and age of files. The current time is
+    read once, so every file of a listing is aged against the same "now".
+    Files modified within the same minute share a modification date and an
+    age, so both are calculated once per minute and cached. Files modified in
+    the last microsecond of a minute, and minutes of time zones with offsets
+    that are not whole minutes, are formatted one at a time, as their local
+    minute depends on the rounding of datetime.fromtimestamp().
+    @param now <datetime.datetime>:
+        Current date and time, defaults to datetime.today()
+    @param max_entries <int>:
+        Maximum number of cached minutes
+    """
+    def __init__(self, now = None, max_entries = 65536):
+        self.now = now if now is not None else datetime.datetime.today()
+        self.max_entries = max_entries
+        self.minutes = {}   # {minute: (mdate, age), ...}
+
+    def rebase(self, now):
+        """Ages files against another current time, i.e. the start of an
+        interrupted scan. Cached minutes are dropped if the time changed.
+        @param now <datetime.datetime>:
+            Current date and time
+        """
+        if now != self.now:
+            self.now = now
+            self.minutes = {}
+
+    def _formatted(self, mtime):
+        # Formats a modification
+        # time in seconds, like
+        # file_stats() always did
+        mdate = datetime.datetime.fromtimestamp(mtime).replace(second = 0, microsecond = 0)
+        return mdate.strftime('%Y-%m-%d-%H:%M'), elapsed_days(mdate, self.now)
+
+    def formatted(self, mtime_ns):
+        """Gets the modification date and age of a file.
+        @param mtime_ns <int>:
+            Modification time of the file in nanoseconds
+        @return (mdate, age) <tuple(str, int)>:
+            Modification date as YYYY-MM-DD-HH:MM and age in days
+        """
+        minute, offset = divmod(mtime_ns, _MINUTE)
+        sec, nsec = divmod(mtime_ns, 1000000000)
+        if offset >= _MINUTE - 1000:
+            return self._formatted(sec + nsec * 1e-9)
+        try:
+            cached = self.minutes[minute]
+        except KeyError:
+            if len(self.minutes) >= self.max_entries:
+                self.minutes.clear()
+            start = datetime.datetime.fromtimestamp(minute * 60)
+            cached = self._formatted(minute * 60) if start.second == 0 else None
+            self.minutes[minute] = cached
+        if cached is None:
+            return self._formatted(sec + nsec * 1e-9)
+        return cached
+
+
+class TableWriter(object):
+    """Writes rows of tab separated text in large batches instead of printing
+    each row. Rows are joined and written once per batch, optionally through
+    gzip. Text is encoded like the given stream, so the output is identical to
+    printing each row to it.
+    @param stream <file>:
+        Text stream to write to, defaults to sys.stdout
+    @param compress <bool>:
+        Compress the output with gzip
+    @param batch_rows <int>:
+        Number of rows to buffer before writing them
+    """
+    def __init__(self, stream = None, compress = False, batch_rows = 8192):
+        stream = stream if stream is not None else sys.stdout
+        self.stream = stream
+        self.gzipped = None
+        if compress:
+            # Timestamp is not stored, so
+            # the output is reproducible,
+            # like gzip -n
+            self.gzipped = gzip.GzipFile(fileobj = stream.buffer, mode = 'wb', mtime = 0)
+            self.stream = io.TextIOWrapper(self.gzipped, encoding = stream.encoding,
+                errors = stream.errors, newline = '\n')
+        self.batch_rows = batch_rows
+        self.rows = []
+
+    def write(self, row):
+        """Adds a row to the output.
+        @param row <list[str]>:
+            Values of each column
+        """
+        self.rows.append('\t'.join(row))
+        if len(self.rows) >= self.batch_rows:
+            self.flush()
+
+    def flush(self):
+        """Writes any buffered rows."""
+        if self.rows:
+            self.rows.append('')
+            self.stream.write('\n'.join(self.rows))
+            self.rows = []
+        self.stream.flush()
+
+    def close(self):
+        """Writes any buffered rows and ends the gzip stream."""
+        self.flush()
+        if self.gzipped is not None:
+            fh = self.gzipped.fileobj
+            self.stream.detach()
+            self.gzipped.close()
+            fh.flush()
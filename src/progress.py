@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+# Python standard library
+from __future__ import print_function
+import os, json, time, signal, datetime, threading
+
+# Local imports
+from utils import err
+from benchmark import tallied, phase, bytes_read
+from throttle import waited
+
+
+class Progress(object):
+    """Reports the progress and throughput of a running sub command, so a slow
+    but progressing scan can be told apart from a hung one. A heartbeat is
+    written every interval seconds by a daemon thread, and on SIGUSR1, with
+    the current stage, the number of files and directories listed and their
+    rates, the rate of bytes read, i.e. hashed, and the bytes of candidate
+    duplicates that remain to be hashed with an estimated time to finish, and
+    the time spent throttled by rate limits.
+    Rates are calculated over the time since the previous heartbeat. Counters
+    are only read, so the overhead is one snapshot per heartbeat.
+    @param interval <float>:
+        Seconds between each heartbeat, None only reports on SIGUSR1
+    @param status <str>:
+        Optional path of a status file, it is replaced with a JSON snapshot
+        on each heartbeat instead of writing to standard error
+    """
+    def __init__(self, interval = None, status = None):
+        self.interval = interval
+        self.status = status
+        self.started = time.time()
+        self.stopped = False
+        self.wakeup = threading.Event()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.previous = self._sampled()
+
+    def _sampled(self):
+        # Snapshot of the counters
+        # summed across threads
+        counters = tallied()
+        return {
+            'time': time.time(),
+            'files': counters.get('files.traversed', 0),
+            'directories': counters.get('scandir_calls', 0),
+            'read_bytes': bytes_read() or 0,
+            'planned_bytes': counters.get('candidates.planned_bytes', 0),
+            'hashed_bytes': counters.get('candidates.hashed_bytes', 0)
+        }
+
+    def snapshot(self):
+        """Gets the progress of the sub command since it started, and its
+        rates since the previous snapshot.
+        @return progress <dict>:
+            Stage, counts, rates, remaining bytes and estimated time to finish
+        """
+        with self.lock:
+            current, previous = self._sampled(), self.previous
+            self.previous = current
+        elapsed = max(current['time'] - previous['time'], 1e-9)
+        read_rate = (current['read_bytes'] - previous['read_bytes']) / elapsed
+        hashed_rate = (current['hashed_bytes'] - previous['hashed_bytes']) / elapsed
+        remaining = max(current['planned_bytes'] - current['hashed_bytes'], 0)
+        eta = None
+        if remaining and hashed_rate > 0:
+            eta = int(remaining / hashed_rate)
+        return {
+            'time': datetime.datetime.fromtimestamp(current['time']).strftime('%Y-%m-%d %H:%M:%S'),
+            'pid': os.getpid(),
+            'phase': phase() or ('finished' if self.stopped else 'starting'),
+            'elapsed_s': int(current['time'] - self.started),
+            'files': current['files'],
+            'files_per_s': round((current['files'] - previous['files']) / elapsed, 1),
+            'directories': current['directories'],
+            'directories_per_s': round((current['directories'] - previous['directories']) / elapsed, 1),
+            'read_mb_per_s': round(read_rate / 1e6, 1),
+            'hashed_mb_per_s': round(hashed_rate / 1e6, 1),
+            'remaining_mb': round(remaining / 1e6, 1),
+            'eta_s': eta,
+            'throttled_s': round(sum(t['waited_s'] for t in waited().values()), 1)
+        }
+
+    def report(self):
+        """Writes a heartbeat to the status file or standard error."""
+        progress = self.snapshot()
+        if self.status:
+            # Replaced atomically, readers
+            # never see a partial status
+            tmp = '{}.tmp'.format(self.status)
+            try:
+                with open(tmp, 'w') as fh:
+                    json.dump(progress, fh)
+                    fh.write('\n')
+                os.replace(tmp, self.status)
+            except OSError as e:
+                err('WARNING: Failed to write status file "{}" due to "{}" error!'.format(self.status, e))
+            return
+        eta = progress['eta_s']
+        err('progress\t{time}\tphase={phase}\telapsed={elapsed_s}s\tfiles={files}\tfiles/s={files_per_s}'
+            '\tdirs={directories}\tdirs/s={directories_per_s}\tread={read_mb_per_s} MB/s'
+            '\thashed={hashed_mb_per_s} MB/s\tremaining={remaining_mb} MB\teta={eta}\tthrottled={throttled_s}s'.format(
+            eta = str(datetime.timedelta(seconds = eta)) if eta is not None else 'unknown', **progress))
+
+    def _run(self):
+        # Heartbeat of the daemon thread, it
+        # is woken early by SIGUSR1, so the
+        # signal handler never writes itself
+        while True:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            if self.stopped:
+                return
+            self.report()
+
+    def start(self):
+        """Starts the heartbeat and reports on SIGUSR1. The signal handler can
+        only be installed from the main thread."""
+        try:
+            signal.signal(signal.SIGUSR1, lambda signum, frame: self.wakeup.set())
+        except (AttributeError, ValueError):
+            pass   # not available or not the main thread
+        self.thread = threading.Thread(target = self._run, name = 'progress', daemon = True)
+        self.thread.start()
+
+    def stop(self):
+        """Stops the heartbeat, a final heartbeat is written to the status
+        file, so it shows the scan finished."""
+        self.stopped = True
+        self.wakeup.set()
+        if self.thread is not None:
+            self.thread.join()
+        if self.status:
+            self.report()
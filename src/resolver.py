@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+# Python standard library
+from __future__ import print_function
+import pwd, grp, threading
+
+# Local imports
+from benchmark import count
+
+
+class Resolver(object):
+    """Process-wide lookup of user and group names. The user and group
+    databases are bulk-loaded with getpwall() and getgrall() on the first
+    lookup, and kept in separate tables, so a uid and a gid with the same
+    number never collide. Ids that were not loaded, i.e. on LDAP or SSSD
+    backed nodes where enumeration is disabled, are looked up one at a time
+    and added to the tables. Ids of inactive or deleted users or groups
+    cannot be converted, so the id itself is returned as its name. Hits and
+    misses of each table are counted, see benchmark.report().
+    @param preload <bool>:
+        Bulk-load the user and group databases on the first lookup
+    """
+    def __init__(self, preload = True):
+        self.preload = preload
+        self.tables = None
+        self.lock = threading.Lock()
+
+    def _load(self):
+        # Loads each database once, the first
+        # entry of a duplicated id is kept, i.e.
+        # like getpwuid() and getgrgid()
+        with self.lock:
+            if self.tables is not None:
+                return self.tables
+            users, groups = {}, {}
+            if self.preload:
+                for entry in pwd.getpwall():
+                    users.setdefault(entry.pw_uid, entry.pw_name)
+                for entry in grp.getgrall():
+                    groups.setdefault(entry.gr_gid, entry.gr_name)
+                count('names.user.preloaded', len(users))
+                count('names.group.preloaded', len(groups))
+            self.tables = {'user': users, 'group': groups}
+        return self.tables
+
+    def name(self, uid, uid_type):
+        """Converts a user_id/group_id into a user_name/group_name.
+        @param uid <int>:
+            Unique identifer for a user or group.
+        @param uid_type <str>:
+            Type of identifer, either 'user' or 'group'.
+        @return name <str>:
+            Returns the name of the user_id or group_id
+        """
+        table = (self.tables or self._load())[uid_type]
+        try:
+            name = table[uid]
+            count('names.{}.hits'.format(uid_type))
+        except KeyError:
+            # The id was not bulk-loaded,
+            # search the unix database for
+            # it and add it to the table
+            count('names.{}.misses'.format(uid_type))
+            try:
+                if uid_type == 'user':
+                    name = pwd.getpwuid(uid).pw_name
+                else:
+                    name = grp.getgrgid(uid).gr_name
+            except KeyError:
+                # The uid or gid does not exist in unix database.
+                # This could be an old user or group that does not
+                # exist anymore; however, the file will still
+                # will use the uid or gid in listings with ls.
+                # Example:
+                # -rw-rw---- 1 39452 CCBR 24931746426 Feb  5  2020 ./rawdata/file.bam
+                name = str(uid)  # convert potential int to string
+            table[uid] = name
+        return name
+
+    def user(self, uid):
+        """Converts a uid into a user name, see name().
+        @param uid <int>:
+            Unique identifer of a user
+        @return name <str>:
+            Name of the user
+        """
+        return self.name(uid, 'user')
+
+    def group(self, gid):
+        """Converts a gid into a group name, see name().
+        @param gid <int>:
+            Unique identifer of a group
+        @return name <str>:
+            Name of the group
+        """
+        return self.name(gid, 'group')
+
+
+# Shared by every sub command, names
+# are only loaded once per process
+names = Resolver()
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+# Python standard library
+from __future__ import print_function
+from operator import itemgetter
+from itertools import groupby
+import os, sys, heapq, pickle, shutil, tempfile
+
+# Local imports
+from benchmark import count
+
+
+def _sizeof(obj):
+    """Approximates the memory used by an object. Tuples, i.e. stat records,
+    are followed down to their elements.
+    @param obj <object>:
+        Key or item of a group
+    @return size <int>:
+        Approximate size in bytes
+    """
+    size = sys.getsizeof(obj)
+    if isinstance(obj, tuple):
+        size += sum(_sizeof(o) for o in obj)
+    return size
+
+
+class SpillingGroups(object):
+    """Groups of items that are kept in memory until they use more than a given
+    amount of memory. Past that point, the groups are spilled to a temporary
+    directory as runs sorted by key, and they are regrouped with an external
+    merge when the groups are iterated over. Groups are always returned in the
+    order their key was first added, and the items of a group in the order they
+    were added, so the results are identical to grouping items in a dictionary.
+    @param max_memory <int>:
+        Approximate number of bytes to keep in memory, None never spills to disk
+    @param tmpdir <str>:
+        Parent of the temporary directory, defaults to $TMPDIR or /tmp
+    @param batch <int>:
+        Number of groups written to a run at once
+    @param max_runs <int>:
+        Maximum number of runs to merge at once, i.e. open files
+    """
+    def __init__(self, max_memory = None, tmpdir = None, batch = 4096, max_runs = 128):
+        self.max_memory = max_memory
+        self.tmpdir = tmpdir
+        self.batch = batch
+        self.max_runs = max_runs
+        self.groups = {}     # {key: (seq, [item1, item2, ...]), ...}
+        self.nbytes = 0      # estimate of memory used by groups
+        self.nitems = 0      # number of items added
+        self.total = 0       # estimate of memory used by all items
+        self.runs = []       # sorted runs spilled to disk
+        self.nruns = 0       # number of runs ever written
+        self.workdir = None
+
+    def __len__(self):
+        return self.nitems
+
+    def add(self, key, item):
+        """Adds an item to the group of a given key.
+        @param key <object>:
+            Key of the group, keys of a group must be comparable to each other
+        @param item <object>:
+            Item to add to the group, must be picklable
+        """
+        nbytes = _sizeof(item) + 8  # list slot
+        try:
+            self.groups[key][1].append(item)
+        except KeyError:
+            self.groups[key] = (self.nitems, [item])
+            nbytes += _sizeof(key) + 160  # dict entry, tuple, and list
+        self.nitems += 1
+        self.nbytes += nbytes
+        self.total += nbytes
+        if self.max_memory is not None and self.nbytes > self.max_memory:
+            self._spill()
+
+    def _run(self):
+        # Creates the temporary directory
+        # on the first spill to disk
+        if self.workdir is None:
+            self.workdir = tempfile.mkdtemp(prefix = 'spacesaver.', dir = self.tmpdir)
+        self.nruns += 1
+        return os.path.join(self.workdir, 'run{}.pkl'.format(self.nruns))
+
+    def _write(self, run, chunks):
+        # Writes chunks of groups to a run
+        # in batches, which also shares the
+        # pickled class of a stat record
+        with open(run, 'wb') as fh:
+            batch = []
+            for chunk in chunks:
+                batch.append(chunk)
+                if len(batch) >= self.batch:
+                    pickle.dump(batch, fh, pickle.HIGHEST_PROTOCOL)
+                    batch = []
+            if batch:
+                pickle.dump(batch, fh, pickle.HIGHEST_PROTOCOL)
+        count('spill.runs')
+        count('spill.bytes', os.path.getsize(run))
+
+    def _read(self, run):
+        # Reads chunks of groups from a run
+        with open(run, 'rb') as fh:
+            while True:
+                try:
+                    batch = pickle.load(fh)
+                except EOFError:
+                    return
+                for chunk in batch:
+                    yield chunk
+
+    def _spill(self):
+        """Writes the groups in memory to disk as a run sorted by key. Each
+        chunk of a group is stored as (key, seq, items), where seq is the
+        order in which the key was first added to the chunk.
+        """
+        if not self.groups:
+            return
+        run = self._run()
+        self._write(run, ((key, self.groups[key][0], self.groups[key][1]) for key in sorted(self.groups)))
+        self.runs.append(run)
+        self.groups = {}
+        self.nbytes = 0
+        if len(self.runs) >= self.max_runs:
+            # Merge runs into a single run to
+            # stay within the open file limit
+            run = self._run()
+            self._write(run, self._merged(self.runs))
+            for r in self.runs:
+                os.remove(r)
+            self.runs = [run]
+
+    def _merged(self, runs):
+        # Chunks of all runs sorted by key,
+        # chunks with the same key stay in
+        # the order they were spilled, the
+        # merge of heapq is stable
+        return heapq.merge(*[self._read(run) for run in runs], key = itemgetter(0))
+
+    def _grouped(self):
+        # Groups of all runs sorted by key,
+        # chunks of a group are concatenated
+        self._spill()
+        for key, chunks in groupby(self._merged(self.runs), key = itemgetter(0)):
+            chunks = list(chunks)
+            seq, items = chunks[0][1], chunks[0][2]
+            for chunk in chunks[1:]:
+                items.extend(chunk[2])
+            yield seq, key, items
+
+    def sorted_items(self):
+        """Iterates over each group in the order of its key.
+        @yields (key, items) <tuple(object, list)>:
+            Key of a group and its items in the order they were added
+        """
+        if not self.runs:
+            # Groups fit in memory
+            for key in sorted(self.groups):
+                yield key, self.groups[key][1]
+            return
+        for seq, key, items in self._grouped():
+            yield key, items
+
+    def items(self):
+        """Iterates over each group in the order its key was first added.
+        Groups spilled to disk are merged by key, and then sorted by the
+        order their key was first added, spilling to disk again if needed.
+        @yields (key, items) <tuple(object, list)>:
+            Key of a group and its items in the order they were added
+        """
+        if not self.runs:
+            # Groups fit in memory
+            for key, (seq, items) in self.groups.items():
+                yield key, items
+            return
+
+        # Average size of an item, used to
+        # estimate the memory of each group
+        average = self.total / max(self.nitems, 1)
+        buffered, nbytes, ordered = [], 0, []
+        try:
+            for seq, key, items in self._grouped():
+                buffered.append((seq, key, items))
+                nbytes += len(items) * average + 160
+                if nbytes > self.max_memory:
+                    # Spill groups sorted by the
+                    # order of their first item
+                    run = self._run()
+                    buffered.sort(key = itemgetter(0))
+                    self._write(run, buffered)
+                    ordered.append(run)
+                    buffered, nbytes = [], 0
+            buffered.sort(key = itemgetter(0))
+            if not ordered:
+                for seq, key, items in buffered:
+                    yield key, items
+                return
+            run = self._run()
+            self._write(run, buffered)
+            ordered.append(run)
+            buffered = []
+            for seq, key, items in heapq.merge(*[self._read(run) for run in ordered], key = itemgetter(0)):
+                yield key, items
+        finally:
+            for run in ordered:
+                os.remove(run)
+
+    def close(self):
+        """Removes any runs that were spilled to disk."""
+        self.groups = {}
+        self.runs = []
+        if self.workdir is not None:
+            shutil.rmtree(self.workdir, ignore_errors = True)
+            self.workdir = None
+
+    def __del__(self):
+        self.close()
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+# Python standard library
+from __future__ import print_function
+import os, pickle, sqlite3, threading, zlib
+
+# Local imports
+from utils import err
+from benchmark import count
+
+
+class ScanState(object):
+    """Persistent state of a previous scan backed by SQLite. The listing of
+    each directory, i.e. the stat records of its files and the names of its
+    child directories, is stored along with the directory's inode, number of
+    links, and modification time (ns). Adding, removing or renaming an entry
+    of a directory changes its modification time, and adding or removing a
+    child directory changes its number of links. If none of these changed, the
+    recorded listing is re-used instead of listing and stat-ing its contents.
+    A new state is written next to the previous one, and it replaces the
+    previous state once the scan is complete. Listings of directories outside
+    of the scanned path are carried over, so one state can be shared by each
+    path given to ls.
+    @param path <str>:
+        Path to the SQLite database, created if it does not exist
+    @param root <str>:
+        Absolute path of the directory being scanned
+    @param batch <int>:
+        Number of new listings to buffer before writing them to disk
+    """
+    def __init__(self, path, root, batch = 1000):
+        self.path = path
+        self.root = root
+        self.batch = batch
+        self.pending = []
+        self.closed = False
+        self.lock = threading.Lock()
+        self.partial = '{}.{}.tmp'.format(path, os.getpid())
+        # Directories are listed by worker
+        # threads, connections are shared
+        # and access is serialized by a lock
+        self.previous = None
+        if os.path.exists(path):
+            self.previous = sqlite3.connect(path, check_same_thread = False)
+        if os.path.exists(self.partial):
+            os.remove(self.partial)
+        self.connection = sqlite3.connect(self.partial, check_same_thread = False)
+        with self.connection:
+            self.connection.execute(
+                """CREATE TABLE IF NOT EXISTS dirs (
+                    path BLOB PRIMARY KEY,
+                    ino INTEGER NOT NULL,
+                    nlink INTEGER NOT NULL,
+                    mtime_ns INTEGER NOT NULL,
+                    listing BLOB NOT NULL
+                )"""
+            )
+
+    def get(self, pdir, stat_res):
+        """Looks up the listing of a directory from the previous scan.
+        @param pdir <str>:
+            Absolute path of the directory
+        @param stat_res <os.stat_result>:
+            Results of stat-ing the directory
+        @return listing <tuple(list[tuple(str, tuple)], list[str])>:
+            Names and stat fields of its files, and names of its child
+            directories, or None if the directory was never listed or has changed
+        """
+        if self.previous is None:
+            return None
+        key = (os.fsencode(pdir), stat_res.st_ino, stat_res.st_nlink, stat_res.st_mtime_ns)
+        with self.lock:
+            row = self.previous.execute(
+                "SELECT listing FROM dirs WHERE path = ? AND ino = ? AND nlink = ? AND mtime_ns = ?", key
+            ).fetchone()
+            if row is not None:
+                # Carry over the listing
+                # to the new state as is
+                self.pending.append(key + (row[0],))
+                if len(self.pending) >= self.batch:
+                    self._flush()
+        if row is None:
+            count('baseline.changed')
+            return None
+        count('baseline.unchanged')
+        return pickle.loads(zlib.decompress(row[0]))
+
+    def put(self, pdir, stat_res, listing):
+        """Records the listing of a directory in the new state.
+        @param pdir <str>:
+            Absolute path of the directory
+        @param stat_res <os.stat_result>:
+            Results of stat-ing the directory before it was listed
+        @param listing <tuple(list[tuple(str, tuple)], list[str])>:
+            Names and stat fields of its files, and names of its child directories
+        """
+        blob = zlib.compress(pickle.dumps(listing, pickle.HIGHEST_PROTOCOL))
+        with self.lock:
+            self.pending.append((os.fsencode(pdir), stat_res.st_ino,
+                stat_res.st_nlink, stat_res.st_mtime_ns, blob))
+            if len(self.pending) >= self.batch:
+                self._flush()
+
+    def _flush(self):
+        # Writes buffered listings
+        # in a single transaction
+        if not self.pending:
+            return
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO dirs VALUES (?, ?, ?, ?, ?)",
+                self.pending
+            )
+        self.pending = []
+
+    def close(self, complete = True):
+        """Writes any buffered listings and closes the database. If the scan
+        is complete, the listings of directories outside of the scanned path
+        are carried over and the new state replaces the previous state.
+        Otherwise, the previous state is left untouched.
+        @param complete <bool>:
+            True if every directory of the scanned path was listed
+        """
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            with self.lock:
+                self._flush()
+                if complete and self.previous is not None:
+                    # Carry over listings of
+                    # other scanned paths
+                    root = os.fsencode(os.path.join(self.root, ''))
+                    rows = self.previous.execute(
+                        "SELECT * FROM dirs WHERE path != ? AND substr(path, 1, ?) != ?",
+                        (os.fsencode(self.root), len(root), root)
+                    )
+                    with self.connection:
+                        self.connection.executemany(
+                            "INSERT OR IGNORE INTO dirs VALUES (?, ?, ?, ?, ?)", rows
+                        )
+            self.connection.close()
+            if self.previous is not None:
+                self.previous.close()
+            if complete:
+                os.replace(self.partial, self.path)
+            else:
+                os.remove(self.partial)
+        except (sqlite3.Error, OSError) as e:
+            # A baseline that cannot be updated
+            # only costs a full scan next time
+            err('WARNING: Failed to update baseline "{}" due to "{}" error!'.format(self.path, e))
+
+    def __del__(self):
+        # Scan was interrupted, i.e. ls
+        # did not list every directory
+        self.close(complete = False)
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+# Python standard library
+from __future__ import print_function, division
+import os, json, time, threading
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows,
+    # limits are per process
+    fcntl = None
+
+
+class TokenBucket(object):
+    """Limits the rate of an operation, i.e. bytes read or stat calls, across
+    every thread of the process. Tokens are refilled at a constant rate up to
+    one second of burst. A caller that takes more tokens than are available
+    takes them anyway and sleeps until they would have been refilled, so the
+    bucket goes into debt and callers that arrive later sleep for longer, i.e.
+    callers are served in order without holding a lock while sleeping.
+    Optionally, the bucket is shared by many processes through a file. Each
+    process leases a small batch of tokens from the file at a time, under an
+    exclusive lock, so processes on different nodes of a shared file system
+    are limited to the rate in total, as long as their clocks are in sync.
+    The number of seconds spent sleeping is recorded, see benchmark.metrics().
+    @param name <str>:
+        Name of the limited operation, i.e. read or stat
+    @param rate <float>:
+        Maximum number of tokens per second
+    @param shared <str>:
+        Optional path of a file to share the bucket with other processes
+    @param lease <float>:
+        Seconds worth of tokens leased from the shared file at a time
+    """
+    def __init__(self, name, rate, shared = None, lease = 0.05):
+        self.name = name
+        self.rate = float(rate)
+        self.burst = self.rate
+        self.shared = shared if fcntl is not None else None
+        self.lease = max(self.rate * lease, 1.0)
+        self.lock = threading.Lock()
+        self.level = self.burst   # tokens in the bucket
+        self.last = time.time()
+        self.tokens = 0.0         # leased from the shared bucket
+        self.waited = 0.0
+        self.waits = 0
+        self.fd = None
+        if self.shared:
+            self.fd = os.open(self.shared, os.O_RDWR | os.O_CREAT, 0o666)
+
+    def _refilled(self, level, last, now):
+        # Clocks of other nodes can be
+        # behind, never refill backwards
+        return min(self.burst, level + max(now - last, 0.0) * self.rate)
+
+    def _reserved(self, n):
+        # Takes n tokens from the bucket,
+        # returns the seconds to sleep
+        now = time.time()
+        if self.fd is None:
+            self.level = self._refilled(self.level, self.last, now) - n
+            self.last = now
+            return max(-self.level / self.rate, 0.0)
+        # Buckets of every limited operation
+        # are kept in the same shared file
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            try:
+                buckets = json.loads(os.pread(self.fd, 65536, 0).decode() or '{}')
+            except ValueError:
+                buckets = {}   # reset a corrupt file
+            level, last = buckets.get(self.name, (self.burst, now))
+            level = self._refilled(level, last, now) - n
+            buckets[self.name] = (level, now)
+            data = json.dumps(buckets, sort_keys = True).encode()
+            os.pwrite(self.fd, data, 0)
+            os.ftruncate(self.fd, len(data))
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        return max(-level / self.rate, 0.0)
+
+    def acquire(self, n = 1):
+        """Takes tokens from the bucket, and sleeps if the rate was exceeded.
+        @param n <float>:
+            Number of tokens, i.e. bytes read or number of stat calls
+        """
+        with self.lock:
+            if self.fd is None:
+                wait = self._reserved(n)
+            elif self.tokens >= n:
+                self.tokens -= n
+                return
+            else:
+                lease = max(n - self.tokens, self.lease)
+                wait = self._reserved(lease)
+                self.tokens += lease - n
+            if wait <= 0:
+                return
+            self.waited += wait
+            self.waits += 1
+        time.sleep(wait)
+
+    def close(self):
+        """Closes the shared file, leased tokens that were not used are lost."""
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+# Process-wide limits of each operation,
+# see limit(), operations without a limit
+# are not throttled
+buckets = {}
+
+
+def limit(name, rate, shared = None):
+    """Sets or removes the process-wide limit of an operation.
+    @param name <str>:
+        Name of the limited operation, i.e. read or stat
+    @param rate <float>:
+        Maximum number of operations or bytes per second, None removes the limit
+    @param shared <str>:
+        Optional path of a file to share the limit with other processes
+    """
+    bucket = buckets.pop(name, None)
+    if bucket is not None:
+        bucket.close()
+    if rate:
+        buckets[name] = TokenBucket(name, rate, shared)
+
+
+def throttled(name, n = 1):
+    """Waits until an operation is allowed by its limit, see limit().
+    @param name <str>:
+        Name of the limited operation, i.e. read or stat
+    @param n <float>:
+        Number of operations, or bytes read
+    """
+    bucket = buckets.get(name)
+    if bucket is not None:
+        bucket.acquire(n)
+
+
+def waited():
+    """Gets the limit of each operation and the time spent throttled by it.
+    @return limits <dict>:
+        Rate, number of waits and seconds spent waiting of each operation
+    """
+    return {
+        name: {
+            'rate': bucket.rate,
+            'shared': bucket.shared,
+            'waits': bucket.waits,
+            'waited_s': round(bucket.waited, 4)
+        } for name, bucket in sorted(buckets.items())
+    }
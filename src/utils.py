@@ -4,7 +4,277 @@
 # Python standard library
 from __future__ import print_function
 from shutil import copytree
-import os, sys, hashlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import os, sys, gzip, hashlib, threading
+
+# Local imports
+from throttle import throttled
+
+# Registry of hashing algorithms that can be used to
+# find duplicate files, xxhash is an optional pypi 
+# dependency and is only available if it is installed
+hashers = {
+    'md5': hashlib.md5,
+    'sha1': hashlib.sha1,
+    'blake2b': hashlib.blake2b,
+}
+try:
+    import xxhash
+    hashers['xxh64'] = xxhash.xxh64
+except ImportError:
+    pass
+
+# Read buffers are allocated once per thread and 
+# re-used for every file hashed by that thread
+_buffers = threading.local()
+
+
+def fadvised(fd, offset, length, advice):
+    """Declares an access pattern for a file's data to the kernel with 
+    posix_fadvise(), i.e. SEQUENTIAL to increase read-ahead or DONTNEED to 
+    drop data that was already read from the page cache. This is a no-op on
+    platforms without posix_fadvise, like macOS.
+    @param fd <int>:
+        File descriptor of an open file
+    @param offset <int>:
+        Start of the region in bytes
+    @param length <int>:
+        Length of the region in bytes, 0 extends to the end of the file
+    @param advice <str>:
+        Name of the advice, i.e. SEQUENTIAL or DONTNEED
+    """
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    try:
+        os.posix_fadvise(fd, offset, length, getattr(os, 'POSIX_FADV_{}'.format(advice)))
+    except OSError:
+        # Hints are advisory, i.e. not 
+        # supported by some file systems
+        pass
+
+
+def blocks(filename, blocksize = 1048576, drop_cache = True, window = 67108864):
+    """Generator that sequentially reads a file into a pre-allocated buffer with
+    readinto(). Each block is yielded as a memoryview of the buffer, so no new bytes
+    objects are allocated per read, and each block must be consumed before the next
+    one is read. The kernel is told the file is read sequentially, and data that 
+    was already read is dropped from the page cache to avoid evicting the cached 
+    data of other users on shared nodes.
+    @param filename <str>:
+        Input file on local filesystem to read
+    @param blocksize <int>:
+        Size of each read in bytes
+    @param drop_cache <bool>:
+        Drop data that was read from the page cache
+    @param window <int>:
+        Number of bytes to read between dropping the page cache
+    @yields block <memoryview>:
+        View of the next block of the file
+    """
+    buf = getattr(_buffers, 'buf', None)
+    if buf is None or len(buf) != blocksize:
+        buf = _buffers.buf = bytearray(blocksize)
+    view = memoryview(buf)
+    with open(filename, 'rb', buffering = 0) as fh:
+        fd = fh.fileno()
+        fadvised(fd, 0, 0, 'SEQUENTIAL')
+        offset = dropped = 0
+        try:
+            while True:
+                nbytes = fh.readinto(buf)
+                if not nbytes:
+                    break
+                throttled('read', nbytes)
+                yield view[:nbytes]
+                offset += nbytes
+                if drop_cache and offset - dropped >= window:
+                    fadvised(fd, dropped, offset - dropped, 'DONTNEED')
+                    dropped = offset
+        finally:
+            if drop_cache:
+                fadvised(fd, dropped, 0, 'DONTNEED')
+
+
+def checksum(filename, algorithm = 'md5', first_block_only = False, blocksize = 65536):
+    """Gets the checksum of a file in memory-safe manner with a given hashing 
+    algorithm from the hashers registry. The file is read in blocks/chunks defined
+    by the blocksize parameter. The raw digest is returned, it is smaller than a 
+    hex string and it should only be hex encoded when it is displayed.
+    @param filename <str>:
+        Input file on local filesystem to find checksum
+    @param algorithm <str>:
+        Name of a hashing algorithm in hashers, i.e. md5, sha1, blake2b, xxh64
+    @param first_block_only <bool>:
+        Calculate checksum of the first block/chunk only
+    @param blocksize <int>:
+        Blocksize of reading N chunks of data to reduce memory profile
+    @return hasher.digest() <bytes>:
+        Raw digest of the file's contents
+    """
+    hasher = hashers[algorithm]()
+    if first_block_only:
+        # Calculate checksum of first block or 
+        # chunck of file. This is a useful heuristic
+        # for when potentially calculating a checksum
+        # of thousand or millions of file.
+        with open(filename, 'rb') as fh:
+            block = fh.read(blocksize)
+        throttled('read', len(block))
+        hasher.update(block)
+        return hasher.digest()
+
+    # Calculate checksum of entire file,
+    # blocks are read into a re-used buffer
+    for block in blocks(filename, blocksize):
+        hasher.update(block)
+
+    return hasher.digest()
+
+
+def sampled(filename, offsets, algorithm = 'md5', blocksize = 65536):
+    """Gets the checksum of a set of blocks in a file. This is a cheap fingerprint
+    of a file, i.e. its first block, its last block, or N evenly spaced blocks. 
+    @param filename <str>:
+        Input file on local filesystem to fingerprint
+    @param offsets list[<int>]:
+        Offsets in bytes of each block to read
+    @param algorithm <str>:
+        Name of a hashing algorithm in hashers, i.e. md5, sha1, blake2b, xxh64
+    @param blocksize <int>:
+        Size of each block in bytes
+    @return hasher.digest() <bytes>:
+        Raw digest of the sampled blocks
+    """
+    hasher = hashers[algorithm]()
+    with open(filename, 'rb') as fh:
+        for offset in offsets:
+            fh.seek(offset)
+            block = fh.read(blocksize)
+            throttled('read', len(block))
+            hasher.update(block)
+
+    return hasher.digest()
+
+
+def compared(filenames, blocksize = 1048576):
+    """Splits a group of same-size files into groups of identical files by reading
+    every file chunk by chunk in lockstep. A group is split as soon as its chunks 
+    differ, and a file that no longer matches any other file is not read any 
+    further. Files that really are duplicates are read to the end, but groups
+    of near duplicates are rejected after reading a fraction of each file. Only
+    one chunk per sub-group is held in memory at a time; however, every file in
+    the group is opened at once.
+    @param filenames list[<str>]:
+        Input files on local filesystem with the same size
+    @param blocksize <int>:
+        Size of each chunk in bytes
+    @return (groups, errors) <tuple(list[list[int]], list[tuple(int, Exception)])>:
+        Groups of identical files as indices into filenames, in order of their 
+        first file, and files that could not be read
+    """
+    groups, errors, handles = [], [], {}
+    try:
+        active = []
+        for i, filename in enumerate(filenames):
+            try:
+                handles[i] = open(filename, 'rb', buffering = 0)
+                fadvised(handles[i].fileno(), 0, 0, 'SEQUENTIAL')
+                active.append(i)
+            except Exception as e:
+                errors.append((i, e))
+        pending = [active] if len(active) > 1 else []
+        while pending:
+            group = pending.pop(0)
+            # Sub-groups with the same chunk, compares
+            # each file's chunk against the first chunk
+            # of every sub-group, i.e. [(chunk, [i, j])]
+            splits = []
+            for i in group:
+                try:
+                    chunk = handles[i].read(blocksize)
+                except Exception as e:
+                    errors.append((i, e))
+                    continue
+                throttled('read', len(chunk))
+                for first, members in splits:
+                    if chunk == first:
+                        members.append(i)
+                        break
+                else:
+                    splits.append((chunk, [i]))
+            for chunk, members in splits:
+                if len(members) < 2:
+                    # Unique chunk, stop reading file
+                    handles.pop(members[0]).close()
+                    groups.append(members)
+                elif not chunk:
+                    # Reached end of identical files
+                    groups.append(members)
+                else:
+                    pending.append(members)
+    finally:
+        for fh in handles.values():
+            fh.close()
+
+    # Order groups by their first file
+    groups.sort(key = lambda members: members[0])
+    return groups, errors
+
+
+def sized(parser, size):
+    """Converts a human readable size into bytes. Sizes are in units based 
+    on powers of 2, i.e. 4K = 4096 bytes, and 4M = 4 MiB.
+    @param parser <argparse.ArgumentParser() object>:
+        Argparse parser object
+    @param size <str>:
+        Human readable size, i.e. 65536, 64K, 4M, 4MiB, 8G
+    @return nbytes <int>:
+        Size in bytes
+    """
+    units = {'': 0, 'B': 0, 'K': 1, 'M': 2, 'G': 3, 'T': 4}
+    value = size.strip().upper()
+    for suffix in ('IB', 'B'):
+        if value.endswith(suffix) and value[:-len(suffix)][-1:].isalpha():
+            value = value[:-len(suffix)]
+            break
+    unit = value[-1:] if value[-1:].isalpha() else ''
+    number = value[:-1] if unit else value
+    try:
+        nbytes = int(float(number) * 1024 ** units[unit])
+    except (KeyError, ValueError):
+        parser.error("Size '{}' is not valid! Please use a size like 65536, 64K, 4M, or 8G.".format(size))
+    if nbytes <= 0:
+        parser.error("Size '{}' is not valid! Please provide a size greater than 0.".format(size))
+
+    return nbytes
+
+
+def fingerprints(parser, stages):
+    """Checks a comma separated chain of fingerprint stages. The first block 
+    of a file, 'head', is always the first fingerprint in the chain.
+    @param parser <argparse.ArgumentParser() object>:
+        Argparse parser object
+    @param stages <str>:
+        Comma separated list of stages, i.e. head,tail,sample:4
+    @return chain list[<str>]:
+        List of fingerprint stages
+    """
+    chain = ['head']
+    for stage in stages.split(','):
+        stage = stage.strip()
+        if stage in ('', 'head'):
+            continue
+        valid = stage == 'tail'
+        if stage.startswith('sample:'):
+            nblocks = stage.split(':', 1)[1]
+            valid = nblocks.isdigit() and int(nblocks) > 0
+        if not valid:
+            parser.error("Fingerprint '{}' is not valid! Please use head, tail, or sample:N.".format(stage))
+        if stage not in chain:
+            chain.append(stage)
+
+    return chain
 
 
 def md5sum(filename, first_block_only = False, blocksize = 65536):
@@ -20,22 +290,50 @@ def md5sum(filename, first_block_only = False, blocksize = 65536):
     @return hasher.hexdigest() <str>:
         MD5 checksum of the file's contents
     """
-    hasher = hashlib.md5()
-    with open(filename, 'rb') as fh:
-        buf = fh.read(blocksize)
-        if first_block_only:
-            # Calculate MD5 of first block or chunck of file.
-            # This is a useful heuristic for when potentially 
-            # calculating an MD5 checksum of thousand or 
-            # millions of file.
-            hasher.update(buf)
-            return hasher.hexdigest()
-        while len(buf) > 0:
-            # Calculate MD5 checksum of entire file
-            hasher.update(buf)
-            buf = fh.read(blocksize)
-
-    return hasher.hexdigest()
+    return checksum(filename, 'md5', first_block_only, blocksize).hex()
+
+
+def pooled(func, items, jobs = 1, window = None):
+    """Generator that applies a function to each item with a bounded pool of
+    threads. Results are yielded in the same order as the input items, so the 
+    results are identical to applying the function serially. At most 'window' 
+    items are submitted to the pool at any given time, which keeps memory usage
+    bounded for very large iterables. Any exceptions raised by the function are 
+    yielded rather than raised, so a single failure does not stop the pool.
+    @param func <func>:
+        Function to apply to each item, i.e. md5sum()
+    @param items <iter>:
+        Iterable of items to process
+    @param jobs <int>:
+        Number of threads, 1 applies the function in the calling thread
+    @param window <int>:
+        Maximum number of pending items [default: 2 * jobs]
+    @yields (item, result, error) <tuple>:
+        Input item, result of the function or None, and exception or None
+    """
+    if jobs < 2:
+        # Serially apply the function
+        for item in items:
+            try:
+                yield item, func(item), None
+            except Exception as e:
+                yield item, None, e
+        return
+
+    window = window or 2 * jobs
+    with ThreadPoolExecutor(max_workers = jobs) as pool:
+        pending = deque()
+        for item in items:
+            pending.append((item, pool.submit(func, item)))
+            if len(pending) < window:
+                continue
+            item, future = pending.popleft()
+            e = future.exception()
+            yield item, (future.result() if e is None else None), e
+        while pending:
+            item, future = pending.popleft()
+            e = future.exception()
+            yield item, (future.result() if e is None else None), e
 
 
 def permissions(parser, path, *args, **kwargs):
@@ -95,6 +393,21 @@ def exists(testpath):
     return does_exist
 
 
+def opened(filename, mode = 'rt'):
+    """Opens a text file, files ending with '.gz' are gzip compressed. Paths
+    that cannot be decoded as UTF-8 are written and read back as is.
+    @param filename <str>:
+        Name of file to open
+    @param mode <str>:
+        Mode to open the file, i.e. 'rt' or 'wt'
+    @return fh <file object>:
+        Handle of the opened file
+    """
+    if filename.endswith('.gz'):
+        return gzip.open(filename, mode, encoding = 'utf-8', errors = 'surrogateescape')
+    return open(filename, mode, encoding = 'utf-8', errors = 'surrogateescape')
+
+
 def ln(files, outdir):
     """Creates symlinks for files to an output directory.
     @param files list[<str>]:
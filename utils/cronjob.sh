@@ -62,6 +62,8 @@ do_ls=1
 do_df=1
 do_report=1
 do_cleanup=1
+# day of the week of the full scan (1 ... Monday, 7 ... Sunday)
+full_scan_day=7
 
 
 # actual runs
@@ -69,10 +71,19 @@ do_cleanup=1
 if [ "$do_ls" == "1" ]; then
 # do ls
     # create a swarm job and submit it to sbatch... wait till it ends
+    # each swarm job keeps the state of its own folder
+    # each swarm job journals its scan, so a job that hits its walltime resumes
+    mkdir -p ${spacesaver_dir}/baselines ${spacesaver_dir}/checkpoints
+    # files modified in place keep their old size and modification time
+    # in a baseline until their folder changes, so the baselines are
+    # rotated once a week and every folder is fully scanned again
+    if [ "$(date +%u)" == "$full_scan_day" ];then
+        rm -f ${spacesaver_dir}/baselines/*.db
+    fi
     for folder in $folders;do
         for f in $(find $folder -maxdepth 1 -mindepth 1 -type d);do 
             g=$(echo $f|tr '/' '_')
-            echo "${spacesaver_exe} ls $f 1>${outdir}/${g}_ls.tsv 2>${outdir}/${g}_ls.err"
+            echo "${spacesaver_exe} ls --progress 600 --walk-threads 8 --hash-cache ${spacesaver_dir}/hashes.db --baseline ${spacesaver_dir}/baselines/${g}.db --checkpoint ${spacesaver_dir}/checkpoints/${g} --emit-index ${outdir}/${g}_index.tsv.gz $f 1>${outdir}/${g}_ls.tsv 2>${outdir}/${g}_ls.err"
         done
     done > do_ls_swarm
     njobs=$(wc -l do_ls_swarm|awk '{print $1}')
@@ -81,7 +92,8 @@ if [ "$do_ls" == "1" ]; then
         echo "RUNNING: swarm -f do_ls_swarm -t 2 -g 200 --partition=ccr,norm --time=48:00:00 --sbatch \"--wait\""
         swarm -f do_ls_swarm -t 2 -g 200 --partition=ccr,norm --time=48:00:00 --sbatch "--wait"
 
-# # after swarm job has ended ... concatenate the "ls.tsv" files into a single file named "all_lss.tsv"
+# # after swarm job has ended ... merge the partial indexes of each "ls" job into 
+# # a single file named "all_lss.tsv", this also finds duplicates across folders
 
 cat <<EOF > ${outdir}/do_ls_concat
 #!/bin/bash
@@ -91,16 +103,8 @@ cat <<EOF > ${outdir}/do_ls_concat
 #SBATCH --time=12:00:00
 #SBATCH --cpus-per-task=2
 
-n=1
-for f in \$(find $outdir -maxdepth 1 -name "*_ls.tsv")
-do
-if [[ "\$n" == "1" ]]
-then
-head -n1 \$f
-fi
-n=\$((n+1))
-tail -n +2 \$f
-done | awk -F"\t" '{if (NF==14) {print}}' > ${outdir}/all_lss.tsv
+${spacesaver_exe} merge --jobs 2 --hash-cache ${spacesaver_dir}/hashes.db \$(find $outdir -maxdepth 1 -name "*_index.tsv.gz") \\
+ | awk -F"\t" '{if (NF==14) {print}}' > ${outdir}/all_lss.tsv
 EOF
         echo "RUNNING: sbatch --wait ${outdir}/do_ls_concat"
         sbatch --wait ${outdir}/do_ls_concat
@@ -110,15 +114,15 @@ EOF
 cat <<EOF > ${outdir}/do_get_stats_per_user
 #!/bin/bash
 #SBATCH --job-name="spacesavers get_stats"
-#SBATCH --mem=200g
+#SBATCH --mem=8g
 #SBATCH --partition="ccr,norm"
-#SBATCH --time=12:00:00
+#SBATCH --time=4:00:00
 #SBATCH --cpus-per-task=2
-${spacesaver_dir}/utils/get_stats_per_user.py \\
- --ls ${outdir}/all_lss.tsv \\
+${spacesaver_exe} users \\
  --peruserbytes ${outdir}/bytes_per_user.tsv \\
  --largedups ${outdir}/large_duplicates.tsv \\
- --dist ${outdir}/age_distribution_per_user.tsv
+ --dist ${outdir}/age_distribution_per_user.tsv \\
+ ${outdir}/all_lss.tsv
 EOF
 
         echo "RUNNING: sbatch --wait ${outdir}/do_get_stats_per_user"
@@ -195,6 +199,7 @@ if [ "$do_cleanup" == "1" ];then
     cd $outdir
     rm -rf *_ls.tsv
     rm -rf *_ls.err
+    rm -rf *_index.tsv.gz
     rm -rf *_df.tsv
     rm -rf *_df.err
     gzip -n all_lss.tsv
@@ -157,8 +157,10 @@ function jobscript(){
         if [ $i -eq 0 ]; then 
             outscript="${outdir}/spacesavers.sh"
         fi
-        # Output file prefix is child directory name
-        echo "${gitdir}/spacesaver ls $chdir 1> ${outdir}/${prefix}.tsv 2> ${outdir}/${prefix}.err" \
+        # Output file prefix is child directory name,
+        # progress is reported to the .err file every
+        # 10 minutes, or on demand with kill -USR1 PID
+        echo "${gitdir}/spacesaver ls --progress 600 $chdir 1> ${outdir}/${prefix}.tsv 2> ${outdir}/${prefix}.err" \
             >> "${outscript}"
         i=$((i+1)) # increment counter, add to swarm file 
     done < <(find "${inputdir}" -maxdepth 1 -type d)